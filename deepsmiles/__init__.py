@@ -27,4 +27,6 @@ __license__ = "MIT"
 __copyright__ = "NextMove Software 2018"
 
 from .converter import Converter
-from .exceptions import DecodeError
+from .exceptions import DecodeError, EncodeError
+from .decode import Limits
+from .lexer import tokenize
@@ -0,0 +1,103 @@
+# Copyright 2018 NextMove Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Command-line conversion of SMILES files to DeepSMILES and back
+
+Input is read line by line from a .smi file, a gzipped .smi.gz file, or
+stdin. The first whitespace-separated field of each line is converted
+and the rest of the line (the title or ID columns) is kept as is.
+"""
+import argparse
+import sys
+
+from .converter import Converter
+from .fileio import convert_file, open_file
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="deepsmiles",
+            description="Convert SMILES to DeepSMILES (or back with --decode)")
+    parser.add_argument("input", nargs="?", default="-",
+            help="a .smi or .smi.gz file (default: stdin)")
+    parser.add_argument("-o", "--output", default="-",
+            help="output file, gzipped if it ends in .gz (default: stdout)")
+    parser.add_argument("-d", "--decode", action="store_true",
+            help="decode DeepSMILES to SMILES instead of encoding")
+    parser.add_argument("-r", "--rings", action="store_true",
+            help="use the DeepSMILES ring syntax")
+    parser.add_argument("-b", "--branches", action="store_true",
+            help="use the DeepSMILES branch syntax")
+    parser.add_argument("--reuse-digits", action="store_true",
+            help="when decoding, reuse ring-closure digits once they are free")
+    parser.add_argument("-e", "--errors",
+            help="write lines that cannot be converted to this file")
+    parser.add_argument("-j", "--processes", type=int, default=1,
+            help="number of worker processes (default: 1)")
+    parser.add_argument("--chunksize", type=int, default=1000,
+            help="number of lines per unit of work (default: 1000)")
+    parser.add_argument("--progress", type=int, default=0, metavar="N",
+            help="report progress every N lines")
+    parser.add_argument("-q", "--quiet", action="store_true",
+            help="do not report the conversion rate")
+    parser.add_argument("--stats",
+            help="write timings and input statistics as JSON to this file")
+    parser.add_argument("--shards", type=int, metavar="N",
+            help="split the input file into N shards, converted in parallel "
+                 "by a job that can be resumed if it is interrupted")
+    parser.add_argument("--workdir",
+            help="working directory for --shards (default: the output name plus .shards)")
+    args = parser.parse_args(args)
+    if not args.rings and not args.branches:
+        parser.error("at least one of --rings and --branches is required")
+    if args.shards is not None:
+        if args.input == "-" or args.input.endswith(".gz") or args.output == "-":
+            parser.error("--shards needs an uncompressed input file and an output file")
+        if args.stats:
+            parser.error("--stats cannot be used with --shards")
+        from .jobs import Job
+        converter = Converter(rings=args.rings, branches=args.branches,
+                              reuse_digits=args.reuse_digits)
+        job = Job(args.input, args.output, converter,
+                  decode=args.decode, errors=args.errors, workdir=args.workdir,
+                  shards=args.shards, processes=args.processes)
+        job.run(log=None if args.quiet else sys.stderr)
+        return 0
+
+    converter = Converter(rings=args.rings, branches=args.branches,
+                          instrument=args.stats is not None, reuse_digits=args.reuse_digits)
+    inp = open_file(args.input, "r")
+    out = open_file(args.output, "w")
+    errout = open_file(args.errors, "w") if args.errors else None
+    try:
+        convert_file(inp, out, converter, decode=args.decode, errout=errout,
+                     processes=args.processes, chunksize=args.chunksize,
+                     progress=None if args.quiet else args.progress)
+    finally:
+        for f in [inp, out, errout]:
+            if f is sys.stdout:
+                f.flush()
+            elif f is not None and f is not sys.stdin:
+                f.close()
+    if args.stats:
+        with open(args.stats, "w") as f:
+            f.write(converter.stats.to_json(indent=2, sort_keys=True) + "\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
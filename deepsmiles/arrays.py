@@ -0,0 +1,127 @@
+# Copyright 2018 NextMove Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Conversion between SMILES and padded NumPy matrices of DeepSMILES token IDs
+
+NumPy is only needed for this module; the rest of the package does not
+use it.
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import lexer
+from .vocab import Vocabulary
+
+def _check_numpy():
+    if np is None:
+        raise ImportError("NumPy is required for deepsmiles.arrays")
+
+def encode(converter, smiles, vocab=None, width=None, out=None, truncate=False, errors="raise"):
+    """Encode a batch of SMILES as a padded int32 matrix of DeepSMILES token IDs
+
+    Each SMILES string is encoded with the given Converter and its tokens
+    are written as IDs from 'vocab' (by default, Vocabulary.default())
+    into one row of the matrix. The rest of the row is filled with the
+    padding ID. Tokens that are not in the vocabulary get the unknown ID.
+
+    The width of the matrix is taken from 'out' if a preallocated matrix
+    is given, otherwise from 'width', otherwise it is the length of the
+    longest row. A row that does not fit raises a ValueError unless
+    'truncate' is True.
+
+    'errors' is the policy for a SMILES string that cannot be encoded:
+    "raise" raises the exception and "none" leaves the row empty.
+
+    Returns a tuple of (matrix, lengths), where lengths is an int32 vector
+    of the number of tokens in each row.
+    """
+    _check_numpy()
+    if errors not in ("raise", "none"):
+        raise ValueError("errors should be one of raise, none")
+    if vocab is None:
+        vocab = Vocabulary.default()
+    get = vocab.index.get
+    unk_id = vocab.unk_id
+
+    def ids(smi):
+        try:
+            encoded = converter.encode(smi)
+        except Exception:
+            if errors == "raise":
+                raise
+            return []
+        return [get(token, unk_id) for token in lexer.token_re.findall(encoded)]
+
+    if out is None:
+        rows = [ids(smi) for smi in smiles]
+        if width is None:
+            width = max([len(row) for row in rows] or [0])
+        out = np.empty((len(rows), width), dtype=np.int32)
+    else:
+        rows = (ids(smi) for smi in smiles)
+    out.fill(vocab.pad_id)
+    width = out.shape[1]
+
+    lengths = np.zeros(out.shape[0], dtype=np.int32)
+    for i, row in enumerate(rows):
+        if i >= out.shape[0]:
+            raise ValueError("There are more SMILES than rows in the matrix")
+        if len(row) > width:
+            if not truncate:
+                raise ValueError("Row %d has %d tokens but the width of the matrix is %d" % (i, len(row), width))
+            row = row[:width]
+        out[i, :len(row)] = row
+        lengths[i] = len(row)
+    return out, lengths
+
+def decode(converter, matrix, lengths=None, vocab=None, errors="raise"):
+    """Decode each row of a matrix of DeepSMILES token IDs back to SMILES
+
+    A row ends at its length in 'lengths' (if given) or otherwise at the
+    first padding ID. 'vocab' should be the Vocabulary that was used for
+    encoding (by default, Vocabulary.default()).
+
+    'errors' is the policy for a row that cannot be decoded (including
+    one that contains the unknown ID): "raise" raises the exception and
+    "none" gives None in its place.
+
+    Returns a list of SMILES strings.
+    """
+    _check_numpy()
+    if errors not in ("raise", "none"):
+        raise ValueError("errors should be one of raise, none")
+    if vocab is None:
+        vocab = Vocabulary.default()
+    matrix = np.asarray(matrix)
+    ans = []
+    for i, row in enumerate(matrix.tolist()):
+        if lengths is not None:
+            row = row[:lengths[i]]
+        elif vocab.pad_id in row:
+            row = row[:row.index(vocab.pad_id)]
+        try:
+            ans.append(converter.decode(vocab.text(row)))
+        except Exception:
+            if errors == "raise":
+                raise
+            ans.append(None)
+    return ans
@@ -0,0 +1,336 @@
+# Copyright 2018 NextMove Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Write a molecule as many different (randomised) DeepSMILES strings
+
+A SMILES string is read once into a Graph of atoms and bonds, from which
+each randomised string is written directly: a random atom of each
+component is chosen as the root, and the neighbours of each atom are
+visited in a random order. This is useful for augmenting the training
+data of machine-learning models.
+
+The strings are the same as those that encode.encode() would give for
+the corresponding randomised SMILES, in which the ring openings at each
+atom are in the order that the rings are closed. The tetrahedral stereo
+(@ and @@) of each atom is adjusted for its new order of neighbours, and
+a directional bond ('/' or '\\') is inverted when it is written in the
+opposite direction.
+"""
+import random
+import re
+
+from . import encode
+from . import exceptions
+from . import lexer
+
+# The chirality and hydrogen count of a bracket atom. Only the tetrahedral
+# '@' and '@@' are adjusted.
+bracket_re = re.compile(r"\[[0-9]*(?:[A-Z][a-z]?|[a-z][a-z]?|\*)(@@?(?!TH|AL|SP|TB|OH))?(H[0-9]*)?")
+
+IMPLICIT_H = -1 # stands for the implicit hydrogen of an atom such as [C@H] in a neighbour list
+
+def flip(bondchar):
+    """Return the bond symbol for the same bond written in the other direction"""
+    if bondchar == "/":
+        return "\\"
+    if bondchar == "\\":
+        return "/"
+    return bondchar
+
+def is_odd_permutation(before, after):
+    """Return whether 'after' is an odd permutation of 'before'"""
+    position = dict((x, i) for i, x in enumerate(before))
+    return encode.isOddPermutation([position[x] for x in after])
+
+class Graph:
+    """A molecule read from SMILES
+
+    atoms -- the text of each atom
+    bonds -- (from atom, to atom, bond symbol) for each bond, where the
+             bond symbol applies in the direction 'from' to 'to'
+    neighbours -- for each atom, a list of (atom, bond) for its neighbours
+    components -- a list of the atoms in each connected component
+    stereo -- for each atom with tetrahedral stereo, its neighbours in
+              the order of the SMILES (including IMPLICIT_H)
+    """
+    def __init__(self, smiles):
+        """Read a SMILES string, raising an EncodeError if it is invalid"""
+        self.atoms = []
+        self.bonds = []
+        self.neighbours = []
+        self.stereo = {}
+        order = [] # the neighbours of each atom in SMILES order
+
+        prev = -1
+        branches = []
+        ringopenings = {} # ring number -> (atom, idx in order[atom], bondchar, position)
+        bondchar = ""
+        pos = 0
+        for x in lexer.token_re.findall(smiles):
+            i = pos
+            pos += len(x)
+            kind = lexer.kinds.get(x[0])
+            if kind is None: # an atom
+                if x == '[':
+                    raise exceptions.EncodeError(smiles, i, "There is a '[' without the corresponding ']'")
+                if x == '.':
+                    prev = -1
+                    bondchar = ""
+                    continue
+                atom = len(self.atoms)
+                self.atoms.append(x)
+                self.neighbours.append([])
+                order.append([])
+                match = bracket_re.match(x)
+                if match and match.group(1):
+                    self.stereo[atom] = None
+                if prev >= 0:
+                    self.add_bond(prev, atom, bondchar)
+                    order[prev].append(atom)
+                    order[atom].append(prev)
+                if match and match.group(2):
+                    order[atom].append(IMPLICIT_H)
+                prev = atom
+            elif kind == lexer.BOND:
+                bondchar = x
+                continue
+            elif kind == lexer.OPEN:
+                branches.append(prev)
+            elif kind == lexer.CLOSE:
+                if not branches:
+                    raise exceptions.EncodeError(smiles, i, "Too many close parentheses - there is no corresponding open parenthesis")
+                prev = branches.pop()
+            elif kind == lexer.RING:
+                if x == '%':
+                    raise exceptions.EncodeError(smiles, i, "'%' should be followed by two digits or by a number in parentheses")
+                if prev < 0:
+                    raise exceptions.EncodeError(smiles, i, "Ring closure symbol must be preceded by an atom")
+                number = lexer.ring_number(x)
+                if number in ringopenings:
+                    atom, idx, openchar, openpos = ringopenings.pop(number)
+                    if openchar:
+                        self.add_bond(atom, prev, openchar)
+                    else:
+                        self.add_bond(prev, atom, bondchar)
+                    order[atom][idx] = prev
+                    order[prev].append(atom)
+                else:
+                    ringopenings[number] = (prev, len(order[prev]), bondchar, i)
+                    order[prev].append(None)
+            bondchar = ""
+        if ringopenings:
+            openpos = min(x[3] for x in ringopenings.values())
+            raise exceptions.EncodeError(smiles, openpos, "This ring closure symbol is never closed")
+        for atom in self.stereo:
+            self.stereo[atom] = order[atom]
+
+        # Find the connected components
+        self.components = []
+        seen = [False] * len(self.atoms)
+        for start in range(len(self.atoms)):
+            if seen[start]:
+                continue
+            seen[start] = True
+            component = [start]
+            for atom in component:
+                for nbr, bond in self.neighbours[atom]:
+                    if not seen[nbr]:
+                        seen[nbr] = True
+                        component.append(nbr)
+            self.components.append(component)
+
+    def add_bond(self, a, b, bondchar):
+        self.neighbours[a].append((b, len(self.bonds)))
+        self.neighbours[b].append((a, len(self.bonds)))
+        self.bonds.append((a, b, bondchar))
+
+    def bond_symbol(self, bond, start):
+        """Return the symbol for a bond written from atom 'start'"""
+        a, b, bondchar = self.bonds[bond]
+        return bondchar if a == start else flip(bondchar)
+
+    def write(self, converter, rng=random):
+        """Write the molecule in a random order, as DeepSMILES (or SMILES)
+
+        The variant is that of 'converter'. 'rng' is a random.Random
+        (or the random module itself) used to choose the order.
+        """
+        N = len(self.atoms)
+        neighbours = self.neighbours
+        shuffle = rng.shuffle
+        parent = [-1] * N
+        parent_bond = [-1] * N
+        depth = [0] * N
+        state = [0] * N # 0 = not yet visited, 1 = on the path, 2 = finished
+        preorder = [0] * N
+        children = [[] for i in range(N)]
+        closures = {} # atom -> (ring opening atom, bond) for each ring closed there
+        openings = {} # atom -> (preorder of closing atom, idx in closures, closing atom, bond)
+        roots = []
+
+        # A depth-first search from a random root in each component. The
+        # order of the neighbours only matters if there are two or more
+        # besides the parent.
+        components = self.components
+        if len(components) > 1:
+            components = components[:]
+            shuffle(components)
+        count = 0
+        for component in components:
+            root = component[rng.randrange(len(component))]
+            roots.append(root)
+            state[root] = 1
+            depth[root] = 1
+            preorder[root] = count
+            count += 1
+            nbrs = neighbours[root]
+            if len(nbrs) > 1:
+                nbrs = nbrs[:]
+                shuffle(nbrs)
+            stack = [(root, iter(nbrs))]
+            while stack:
+                atom, it = stack[-1]
+                for nbr, bond in it:
+                    if bond == parent_bond[atom]:
+                        continue
+                    if state[nbr] == 0:
+                        parent[nbr] = atom
+                        parent_bond[nbr] = bond
+                        depth[nbr] = depth[atom] + 1
+                        state[nbr] = 1
+                        preorder[nbr] = count
+                        count += 1
+                        children[atom].append(nbr)
+                        nbrs = neighbours[nbr]
+                        if len(nbrs) > 2:
+                            nbrs = nbrs[:]
+                            shuffle(nbrs)
+                        stack.append((nbr, iter(nbrs)))
+                        break
+                    if state[nbr] == 1: # a ring closure back to an atom on the path
+                        closed = closures.setdefault(atom, [])
+                        openings.setdefault(nbr, []).append((preorder[atom], len(closed), atom, bond))
+                        closed.append((nbr, bond))
+                else:
+                    state[atom] = 2
+                    stack.pop()
+        for x in openings.values():
+            x.sort()
+
+        # Invert the stereo of the atoms whose neighbours are now in an odd
+        # permutation of their order in the original SMILES
+        inverted = set()
+        for atom, before in self.stereo.items():
+            after = [parent[atom]] if parent[atom] >= 0 else []
+            if IMPLICIT_H in before:
+                after.append(IMPLICIT_H)
+            after.extend(nbr for nbr, bond in closures.get(atom, []))
+            after.extend(x[2] for x in openings.get(atom, []))
+            after.extend(children[atom])
+            if is_odd_permutation(before, after):
+                inverted.add(atom)
+
+        rings = converter.rings
+        branches = converter.branches
+        atoms = self.atoms
+        bonds = self.bonds
+        ans = []
+        digits = {} # bond -> ring closure digit (when writing SMILES ring closures)
+        in_use = set()
+        for root in roots:
+            if ans:
+                ans.append(".")
+            stack = [root]
+            while stack:
+                atom = stack.pop()
+                if atom.__class__ is str:
+                    ans.append(atom)
+                    continue
+                bond = parent_bond[atom]
+                if bond >= 0 and bonds[bond][2]:
+                    ans.append(self.bond_symbol(bond, parent[atom]))
+                ans.append(encode.invertStereo(atoms[atom]) if atom in inverted else atoms[atom])
+                released = () # digits closed at this atom, which are not reused until the next
+                if atom in closures:
+                    released = []
+                    for nbr, bond in closures[atom]:
+                        bondchar = self.bond_symbol(bond, atom)
+                        if rings:
+                            ans.append(bondchar + lexer.ring_symbol(depth[atom] - depth[nbr] + 1))
+                        else:
+                            digit = digits.pop(bond)
+                            released.append(digit)
+                            ans.append(bondchar + lexer.ring_symbol(digit))
+                    in_use.difference_update(released)
+                if atom in openings and not rings:
+                    for x in openings[atom]:
+                        digit = 1
+                        while digit in in_use or digit in released:
+                            digit += 1
+                        in_use.add(digit)
+                        digits[x[3]] = digit
+                        ans.append(lexer.ring_symbol(digit))
+                kids = children[atom]
+                if kids:
+                    stack.append(kids[-1])
+                    for child in reversed(kids[:-1]):
+                        if branches:
+                            stack.append(")" * chain_length(child, children))
+                            stack.append(child)
+                        else:
+                            stack.append(")")
+                            stack.append(child)
+                            stack.append("(")
+        return "".join(ans)
+
+def chain_length(atom, children):
+    """Return the number of atoms in the branch that starts at 'atom'
+
+    This counts the atom itself and the chain of last children from it.
+    """
+    ans = 1
+    while children[atom]:
+        atom = children[atom][-1]
+        ans += 1
+    return ans
+
+def augment(smiles, converter, n, seed=None, max_tries=None):
+    """Return a list of up to n different randomised DeepSMILES for a SMILES string
+
+    The SMILES is read only once. The variant of DeepSMILES is that of
+    'converter'. 'seed' is the seed for the random number generator (or
+    a random.Random to use). As there may be fewer than n different
+    strings for a small molecule, at most 'max_tries' (by default, 10*n)
+    strings are written.
+    """
+    graph = Graph(smiles)
+    rng = seed if isinstance(seed, random.Random) else random.Random(seed)
+    if max_tries is None:
+        max_tries = 10 * n
+    ans = []
+    seen = set()
+    for i in range(max_tries):
+        if len(ans) == n:
+            break
+        text = graph.write(converter, rng)
+        if text not in seen:
+            seen.add(text)
+            ans.append(text)
+    return ans
@@ -0,0 +1,241 @@
+# Copyright 2018 NextMove Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Length-bucketed batches of padded DeepSMILES token IDs, for training
+
+BatchIterator encodes and tokenizes a stream of SMILES in the background
+and groups sequences of similar length into batches, so that little of
+each padded matrix is padding. Like deepsmiles.arrays, it requires NumPy.
+"""
+import bisect
+import functools
+import queue
+import random
+import threading
+from collections import namedtuple
+
+from . import lexer
+from .arrays import _check_numpy, np
+from .converter import _chunks, _convert_in_pool
+from .encode import encode
+from .vocab import Vocabulary
+
+# A batch of padded sequences
+#   ids -- an int32 matrix of token IDs, one row per sequence
+#   lengths -- an int32 vector of the number of tokens in each row
+#   indices -- an int64 vector of the position of each SMILES in the input
+Batch = namedtuple("Batch", ["ids", "lengths", "indices"])
+
+_END = object()
+
+class _Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+def _chunk_ids(chunk, encoder, vocab, errors):
+    """Encode and tokenize a list of (index, SMILES) pairs
+
+    Returns a tuple of a list of (index, token IDs) pairs and the number
+    of SMILES that could not be encoded (and so were left out).
+    """
+    get = vocab.index.get
+    unk_id = vocab.unk_id
+    ans = []
+    for index, smi in chunk:
+        try:
+            encoded = encoder(smi)
+        except Exception:
+            if errors == "raise":
+                raise
+            continue
+        ans.append((index, [get(token, unk_id) for token in lexer.token_re.findall(encoded)]))
+    return ans, len(chunk) - len(ans)
+
+def _add(batches, batch, length, item, tokens_per_batch):
+    """Add an item to a batch, first moving the batch to 'batches' if it is full
+
+    Returns the new batch and the length of its longest sequence.
+    """
+    if batch and (len(batch) + 1) * max(length, len(item[1])) > tokens_per_batch:
+        batches.append(batch)
+        batch, length = [], 0
+    batch.append(item)
+    return batch, max(length, len(item[1]))
+
+class BatchIterator:
+    """Iterate over length-bucketed batches of encoded SMILES
+
+    The SMILES (any iterable of strings) are encoded with 'converter' and
+    tokenized with 'vocab' (by default, Vocabulary.default()) in a
+    background thread, which keeps up to 'prefetch' batches ready. If
+    'processes' is more than 1, the encoding is shared out across a pool
+    of worker processes, 'chunksize' SMILES at a time.
+
+    The sequences are read a 'window' at a time. If 'boundaries' is None,
+    each window is sorted by length and cut into batches; otherwise each
+    sequence is put in the bucket given by the first boundary that its
+    length does not exceed (or in a last bucket for longer sequences),
+    and a bucket becomes a batch when it is full. Partly-filled buckets
+    carry over to the next window, and are yielded at the end. A batch
+    holds as many sequences as fit into 'tokens_per_batch' once padded
+    to the longest, but always at least one.
+
+    If 'shuffle' is True, each window is shuffled before bucketing and
+    its batches are shuffled before they are yielded. This uses a
+    random.Random with the given 'seed', so that the order is the same
+    each time (whatever the number of processes).
+
+    'errors' is the policy for a SMILES string that cannot be encoded:
+    "skip" leaves it out (the default) and "raise" raises the exception
+    when the batch that would have held it is requested. 'skipped' is
+    the number left out so far; 'tokens' and 'padding' are the number of
+    token IDs and padding IDs in the batches so far.
+
+    Each batch is a Batch tuple of (ids, lengths, indices).
+    """
+    def __init__(self, converter, smiles, vocab=None, tokens_per_batch=4096,
+                 boundaries=None, window=10000, shuffle=True, seed=None,
+                 processes=1, chunksize=1000, errors="skip", prefetch=8):
+        _check_numpy()
+        if errors not in ("raise", "skip"):
+            raise ValueError("errors should be one of raise, skip")
+        if tokens_per_batch < 1 or window < 1 or prefetch < 1:
+            raise ValueError("tokens_per_batch, window and prefetch should be at least 1")
+        if boundaries is not None:
+            boundaries = sorted(boundaries)
+        self.vocab = Vocabulary.default() if vocab is None else vocab
+        self.tokens_per_batch = tokens_per_batch
+        self.boundaries = boundaries
+        self.window = window
+        self.rng = random.Random(seed) if shuffle else None
+        self.skipped = self.tokens = self.padding = 0
+
+        chunks = _chunks(enumerate(smiles), chunksize)
+        if processes == 1:
+            func = functools.partial(_chunk_ids, encoder=converter.encode, vocab=self.vocab, errors=errors)
+            self._results = map(func, chunks)
+        else:
+            encoder = functools.partial(encode, rings=converter.rings, branches=converter.branches)
+            func = functools.partial(_chunk_ids, encoder=encoder, vocab=self.vocab, errors=errors)
+            # Each unit of work is a whole chunk
+            self._results = _convert_in_pool(func, ([chunk] for chunk in chunks), "raise", processes)
+
+        self._queue = queue.Queue(prefetch)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _sequences(self):
+        for ans, skipped in self._results:
+            self.skipped += skipped
+            for item in ans:
+                yield item
+
+    def _batches(self):
+        """Yield the batches as lists of (index, token IDs) pairs"""
+        rng = self.rng
+        tokens_per_batch = self.tokens_per_batch
+        boundaries = self.boundaries
+        if boundaries is not None:
+            buckets = [[[], 0] for i in range(len(boundaries) + 1)] # each is [batch, length]
+        for window in _chunks(self._sequences(), self.window):
+            if rng is not None:
+                rng.shuffle(window)
+            batches = []
+            if boundaries is None:
+                window.sort(key=lambda item: len(item[1]))
+                batch, length = [], 0
+                for item in window:
+                    batch, length = _add(batches, batch, length, item, tokens_per_batch)
+                batches.append(batch)
+            else:
+                for item in window:
+                    bucket = buckets[bisect.bisect_left(boundaries, len(item[1]))]
+                    bucket[:] = _add(batches, bucket[0], bucket[1], item, tokens_per_batch)
+            if rng is not None:
+                rng.shuffle(batches)
+            for batch in batches:
+                yield batch
+        if boundaries is not None:
+            for batch, length in buckets:
+                if batch:
+                    yield batch
+
+    def _pad(self, batch):
+        lengths = np.array([len(ids) for index, ids in batch], dtype=np.int32)
+        width = int(lengths.max())
+        matrix = np.full((len(batch), width), self.vocab.pad_id, dtype=np.int32)
+        for i, (index, ids) in enumerate(batch):
+            matrix[i, :len(ids)] = ids
+        self.tokens += int(lengths.sum())
+        self.padding += matrix.size - int(lengths.sum())
+        indices = np.array([index for index, ids in batch], dtype=np.int64)
+        return Batch(matrix, lengths, indices)
+
+    def _put(self, item):
+        """Queue an item, unless the iterator is closed first"""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.05)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        # Runs in the background thread
+        try:
+            for batch in self._batches():
+                if not self._put(self._pad(batch)):
+                    break
+            else:
+                self._put(_END)
+        except BaseException as e:
+            self._put(_Failure(e))
+        finally:
+            if hasattr(self._results, "close"):
+                self._results.close() # stops any worker processes
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._thread is None:
+            raise StopIteration
+        item = self._queue.get()
+        if item is _END or isinstance(item, _Failure):
+            self.close()
+            if item is _END:
+                raise StopIteration
+            raise item.exception
+        return item
+
+    def close(self):
+        """Stop the background work"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,274 @@
+# Copyright 2018 NextMove Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Benchmark the conversion speed on deterministic synthetic corpora
+
+Run as "python -m deepsmiles.bench". Each corpus is generated from a
+seeded random number generator, so a given seed and size always give
+the same molecules and the results can be compared across versions.
+The results are written as JSON.
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import deepsmiles
+from .converter import Converter
+from .lexer import ring_symbol
+
+MODES = {
+    "RS": dict(rings=True),
+    "PN": dict(branches=True),
+    "RS+PN": dict(rings=True, branches=True),
+}
+
+SUBSTITUENTS = ["C", "F", "Cl", "Br", "O", "OC", "N", "C(=O)O", "C(F)(F)F", "C#N", "S(=O)(=O)N"]
+LINKERS = ["", "C", "CC", "O", "N", "C(=O)N", "NC(=O)", "OCC", "S"]
+
+def druglike(rng, label=1):
+    """A few rings joined by linkers, with substituents
+
+    Rings that are nested in branches are given increasing ring numbers,
+    starting from 'label'.
+    """
+    def ring(label, depth):
+        size = rng.choice([5, 6, 6, 6])
+        aromatic = rng.random() < 0.6 and size == 6 or size == 5 and rng.random() < 0.3
+        atoms = []
+        for i in range(size):
+            if aromatic:
+                atom = rng.choice("cccccn") if size == 6 else rng.choice(["c", "c", "c", "[nH]", "o", "s"])
+            else:
+                atom = rng.choice("CCCCNO")
+            atoms.append(atom)
+        if aromatic and size == 5 and not any(a in ("[nH]", "o", "s") for a in atoms):
+            atoms[2] = "[nH]"
+        ans = [atoms[0] + ring_symbol(label)]
+        for i, atom in enumerate(atoms[1:-1]):
+            ans.append(atom)
+            if atom in "cC" and rng.random() < 0.25:
+                if depth < 2 and rng.random() < 0.3:
+                    ans.append("(%s%s)" % (rng.choice(LINKERS), ring(label + 1, depth + 1)))
+                else:
+                    ans.append("(%s)" % rng.choice(SUBSTITUENTS))
+        ans.append(atoms[-1] + ring_symbol(label))
+        return "".join(ans)
+
+    parts = [rng.choice(["", "C", "CC(=O)", "CO", "N"])]
+    for i in range(rng.randint(1, 4)):
+        if i:
+            parts.append(rng.choice(LINKERS))
+        parts.append(ring(label, 0))
+    parts.append(rng.choice(["", "C", "O", "N", "C(=O)O"]))
+    return "".join(parts)
+
+def long_chain(rng):
+    """A lipid-like chain of a few hundred to a few thousand atoms"""
+    ans = []
+    for i in range(rng.randint(200, 2000)):
+        x = rng.random()
+        ans.append("C" if x < 0.85 else "O" if x < 0.9 else "C(C)" if x < 0.95 else "C(=O)")
+    return "".join(ans) + "C"
+
+def deep_branches(rng):
+    """Branches nested tens to hundreds deep"""
+    depth = rng.randint(20, 300)
+    atoms = [rng.choice(["C", "C", "N", "C(C)"]) for i in range(depth)]
+    return "(".join(atoms) + "C" + ")C" * (depth - 1)
+
+def macrocycle(rng):
+    """A single ring of 12 to 200 atoms"""
+    size = rng.randint(12, 200)
+    atoms = ["C" if rng.random() < 0.8 else rng.choice("ON") for i in range(size)]
+    return atoms[0] + "1" + "".join(atoms[1:-1]) + atoms[-1] + "1"
+
+def fused_polycycle(rng):
+    """A linear run of 2 to 40 fused six-membered rings"""
+    N = rng.randint(2, 40)
+    ans = ["C1CCC2"]
+    for i in range(3, N + 1):
+        ans.append("CC" + ring_symbol(i))
+    ans.append("CCCC" + ring_symbol(N))
+    for i in range(N - 1, 1, -1):
+        ans.append("CC" + ring_symbol(i))
+    ans.append("C1")
+    return "".join(ans)
+
+def stereo_rings(rng):
+    """Fused rings with stereocentres at every ring junction"""
+    N = rng.randint(2, 12)
+    stereo = lambda: rng.choice(["[C@H]", "[C@@H]"])
+    ans = ["C1CC" + stereo() + "2"]
+    for i in range(3, N + 1):
+        ans.append("C" + stereo() + ring_symbol(i))
+    ans.append("C" + rng.choice(["/C=C/", "CC", "/C=C\\"]) + "C" + stereo() + ring_symbol(N))
+    for i in range(N - 1, 1, -1):
+        ans.append("C" + stereo() + ring_symbol(i))
+    ans.append(rng.choice(["[C@]", "[C@@]"]) + "1(O)C")
+    return "".join(ans)
+
+def ring_assembly(rng):
+    """A chain of 10 to 40 rings joined by single bonds or linkers
+
+    Only one ring is open at a time, but a decoder that does not reuse
+    ring-closure digits writes %NN for the tenth ring onwards.
+    """
+    rings = ["c1ccccc1", "c1ccncc1", "C1CCCCC1", "c1ccsc1", "C1CCNCC1", "c1cn[nH]c1"]
+    N = rng.randint(10, 40)
+    return rng.choice(LINKERS).join(rng.choice(rings) for i in range(N))
+
+def big_ring_numbers(rng):
+    """Drug-like molecules whose ring numbers are written as %(NNN)"""
+    return druglike(rng, label=rng.randint(100, 900))
+
+CORPORA = {
+    "druglike": druglike,
+    "long_chain": long_chain,
+    "deep_branches": deep_branches,
+    "macrocycle": macrocycle,
+    "fused_polycycle": fused_polycycle,
+    "stereo_rings": stereo_rings,
+    "big_ring_numbers": big_ring_numbers,
+    "ring_assembly": ring_assembly,
+}
+
+def make_corpus(name, size, seed=0):
+    """Return a list of 'size' SMILES strings from the named corpus"""
+    rng = random.Random("%s-%d" % (name, seed))
+    func = CORPORA[name]
+    return [func(rng) for i in range(size)]
+
+def percentile(data, p):
+    """Return the p-th percentile of a sorted list"""
+    if not data:
+        return 0.0
+    return data[min(len(data) - 1, int(round(p / 100.0 * (len(data) - 1))))]
+
+def time_conversion(func, data, repeat=1):
+    """Time func over each item of data, returning the result of the fastest run
+
+    Returns a tuple of (results, total time, sorted per-item latencies).
+    """
+    best = None
+    for i in range(repeat):
+        latencies = []
+        results = []
+        timer = time.perf_counter
+        for x in data:
+            start = timer()
+            results.append(func(x))
+            latencies.append(timer() - start)
+        total = sum(latencies)
+        if best is None or total < best[1]:
+            best = (results, total, latencies)
+    results, total, latencies = best
+    latencies.sort()
+    return results, total, latencies
+
+def peak_memory(func, data):
+    """Return the peak memory (in bytes) allocated while converting data"""
+    tracemalloc.start()
+    try:
+        for x in data:
+            func(x)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def summarise(corpus, mode, direction, data, total, latencies, memory):
+    N = len(data)
+    return {
+        "corpus": corpus,
+        "mode": mode,
+        "direction": direction,
+        "molecules": N,
+        "characters": sum(len(x) for x in data),
+        "seconds": total,
+        "molecules_per_second": N / total if total else 0.0,
+        "characters_per_second": sum(len(x) for x in data) / total if total else 0.0,
+        "latency_us": dict(("p%d" % p, percentile(latencies, p) * 1e6) for p in (50, 90, 99)),
+        "max_latency_us": latencies[-1] * 1e6 if latencies else 0.0,
+        "peak_memory_bytes": memory,
+    }
+
+def run(corpora=None, modes=None, size=1000, seed=0, repeat=3, memory=True):
+    """Run the benchmark and return the results as a dict"""
+    corpora = corpora or sorted(CORPORA)
+    modes = modes or list(MODES)
+    results = []
+    for corpus in corpora:
+        smiles = make_corpus(corpus, size, seed)
+        for mode in modes:
+            converter = Converter(**MODES[mode])
+            encoded, total, latencies = time_conversion(converter.encode, smiles, repeat)
+            mem = peak_memory(converter.encode, smiles) if memory else None
+            results.append(summarise(corpus, mode, "encode", smiles, total, latencies, mem))
+
+            decoded, total, latencies = time_conversion(converter.decode, encoded, repeat)
+            mem = peak_memory(converter.decode, encoded) if memory else None
+            result = summarise(corpus, mode, "decode", encoded, total, latencies, mem)
+            # The space saved by reusing ring-closure digits in the SMILES
+            reuse = Converter(reuse_digits=True, **MODES[mode])
+            result["output_characters"] = sum(len(x) for x in decoded)
+            result["output_characters_reuse_digits"] = sum(len(reuse.decode(x)) for x in encoded)
+            results.append(result)
+    return {
+        "deepsmiles_version": deepsmiles.__version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "seed": seed,
+        "size": size,
+        "repeat": repeat,
+        "results": results,
+    }
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m deepsmiles.bench",
+            description="Benchmark DeepSMILES conversion on synthetic corpora")
+    parser.add_argument("-n", "--size", type=int, default=1000,
+            help="number of molecules per corpus (default: 1000)")
+    parser.add_argument("-s", "--seed", type=int, default=0,
+            help="random seed for the corpora (default: 0)")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+            help="number of timing runs, of which the fastest is kept (default: 3)")
+    parser.add_argument("-c", "--corpus", action="append", choices=sorted(CORPORA),
+            help="corpus to use (may be repeated; default: all)")
+    parser.add_argument("-m", "--mode", action="append", choices=list(MODES),
+            help="DeepSMILES variant to use (may be repeated; default: all)")
+    parser.add_argument("--no-memory", action="store_true",
+            help="skip the peak memory measurement")
+    parser.add_argument("-o", "--output", help="write the JSON here instead of to stdout")
+    args = parser.parse_args(args)
+
+    results = run(args.corpus, args.mode, args.size, args.seed, args.repeat, not args.no_memory)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
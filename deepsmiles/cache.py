@@ -0,0 +1,79 @@
+# Copyright 2018 NextMove Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""A bounded least-recently-used cache for conversion results"""
+import sys
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions",
+                                     "maxsize", "currsize", "maxbytes", "currbytes"])
+
+def sizeof(obj):
+    """Return the approximate memory use of an object, including the items of a tuple"""
+    if isinstance(obj, tuple):
+        return sys.getsizeof(obj) + sum(sizeof(x) for x in obj)
+    return sys.getsizeof(obj)
+
+class LRUCache:
+    def __init__(self, maxsize=None, maxbytes=None):
+        """Initialise an LRUCache object.
+
+        The least recently used entries are evicted to keep the number of
+        entries at most 'maxsize' and their approximate memory use (as
+        given by sizeof() on the keys and values) at most 'maxbytes'.
+        A limit of None means no limit.
+        """
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.data = OrderedDict() # key -> (value, size in bytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+    def get(self, key):
+        """Return the value for a key, or None if it is not in the cache"""
+        try:
+            value = self.data[key][0]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+    def put(self, key, value):
+        """Add a value to the cache, evicting old entries if necessary"""
+        size = sizeof(key) + sizeof(value)
+        if key in self.data:
+            self.nbytes -= self.data.pop(key)[1]
+        self.data[key] = (value, size)
+        self.nbytes += size
+        while self.data and ((self.maxsize is not None and len(self.data) > self.maxsize) or
+                             (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+            self.nbytes -= self.data.popitem(last=False)[1][1]
+            self.evictions += 1
+    def clear(self):
+        """Remove all entries and reset the statistics"""
+        self.data.clear()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+    def info(self):
+        """Return a CacheInfo with the statistics and current size"""
+        return CacheInfo(self.hits, self.misses, self.evictions,
+                         self.maxsize, len(self.data), self.maxbytes, self.nbytes)
@@ -18,11 +18,89 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import functools
+import itertools
+import multiprocessing
+import os
+from collections import deque
+
 from . import encode
 from . import decode
+from . import exceptions
+from . import lexer
+from .cache import LRUCache
+from .stats import Stats
+
+ERROR_POLICIES = ("raise", "skip", "none")
+
+def _chunks(iterable, size):
+    """Split an iterable into lists of at most 'size' items"""
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _convert_chunk(func, chunk, errors):
+    """Apply 'func' to each string in 'chunk' according to the error policy"""
+    if errors == "raise":
+        return [func(x) for x in chunk]
+    ans = []
+    for x in chunk:
+        try:
+            ans.append(func(x))
+        except Exception:
+            if errors == "none":
+                ans.append(None)
+    return ans
+
+def _is_valid(deepsmiles, rings, branches, limits=None):
+    """Return whether DeepSMILES can be decoded (for use by worker processes)"""
+    return decode.validate(deepsmiles, rings, branches, limits)[0] == exceptions.OK
+
+def _convert_chunk_instrumented(converter, direction, chunk, errors):
+    """Convert a chunk with an instrumented Converter, returning its Stats too"""
+    results = _convert_chunk(getattr(converter, direction), chunk, errors)
+    return results, converter.stats
+
+def _convert_in_pool(func, chunks, errors, processes, stats=None):
+    """Yield the results for each chunk, in order, using a process pool
+
+    Only a couple of chunks per process are in flight at any one time so
+    that memory use does not depend on the length of the input.
+
+    If 'stats' is given, 'func' should be a tuple of an instrumented
+    Converter and the name of the method to call, and the statistics
+    from the workers are merged into 'stats'.
+    """
+    if stats is None:
+        task, args = _convert_chunk, (func,)
+    else:
+        task, args = _convert_chunk_instrumented, func
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = deque()
+        def results():
+            ans = pending.popleft().get()
+            if stats is not None:
+                ans, chunkstats = ans
+                stats.merge(chunkstats)
+            return ans
+        for chunk in chunks:
+            pending.append(pool.apply_async(task, args + (chunk, errors)))
+            if len(pending) >= 2 * processes:
+                for x in results():
+                    yield x
+        while pending:
+            for x in results():
+                yield x
+    finally:
+        pool.terminate()
 
 class Converter:
-    def __init__(self, rings=False, branches=False):
+    def __init__(self, rings=False, branches=False, cache_size=0, cache_bytes=None,
+                 instrument=False, reuse_digits=False, limits=None):
         """Initialise a Converter object.
 
         By default, nothing is converted, so you probably should specify
@@ -30,19 +108,259 @@ class Converter:
         1. rings=True, branches=True gives DeepSMILES/RS+PN
         2. rings=True gives DeepSMILES/RS
         3. branches=True gives DeepSMILES/PN
+
+        To avoid converting the same string twice, set 'cache_size' to
+        the maximum number of results to keep (None for no limit) and/or
+        'cache_bytes' to their approximate maximum memory use. If only
+        'cache_bytes' is given, the number of results is not limited.
+        Encoded and decoded results are cached separately.
+
+        If 'instrument' is True, call counts, timings, errors and the
+        shapes of the inputs are recorded in the 'stats' attribute (see
+        deepsmiles.stats.Stats). Otherwise 'stats' is None.
+
+        If 'reuse_digits' is True, decoding reuses a ring-closure digit
+        once its ring has closed, as canonical SMILES writers do, instead
+        of giving each ring its own number. This keeps ring numbers small
+        for molecules with many rings.
+
+        To guard against huge or degenerate input, such as the output of a
+        generative model, 'limits' may be a decode.Limits of the maximum
+        length, number of atoms, depth, ring size and number of ring
+        closures to decode. Input over a limit raises a DecodeError with
+        one of the limit reason codes (for example exceptions.TOO_LONG)
+        as soon as the limit is reached, and is reported as invalid by
+        is_valid() and validate(). The limits do not apply to encoding.
         """
         self.rings = rings
         self.branches = branches
+        self.reuse_digits = reuse_digits
+        self.limits = limits
+        if cache_size == 0 and cache_bytes is None:
+            self._encode_cache = self._decode_cache = None
+        else:
+            if cache_size == 0: # only the memory use is limited
+                cache_size = None
+            self._encode_cache = LRUCache(cache_size, cache_bytes)
+            self._decode_cache = LRUCache(cache_size, cache_bytes)
+        self.stats = Stats() if instrument else None
     def encode(self, smiles):
-        """Encode a SMILES string as DeepSMILES"""
-        return encode.encode(smiles, rings=self.rings, branches=self.branches)
+        """Encode a SMILES string as DeepSMILES
+
+        A str gives a str, and bytes-like input (bytes, bytearray or
+        memoryview) gives bytes.
+        """
+        if not isinstance(smiles, str):
+            return lexer.as_bytes(self.encode(lexer.as_text(smiles)))
+        if self.stats is not None:
+            return self.stats.encode.measure(self._encode, smiles, self.rings, encode.encode_with_metadata)
+        return self._encode(smiles, encode.encode)
     def decode(self, deepsmiles):
-        """Decode a DeepSMILES string back to SMILES"""
-        return decode.decode(deepsmiles, rings=self.rings, branches=self.branches)
+        """Decode a DeepSMILES string back to SMILES
+
+        As for encode(), bytes-like input gives bytes.
+        """
+        if not isinstance(deepsmiles, str):
+            return lexer.as_bytes(self.decode(lexer.as_text(deepsmiles)))
+        if self.stats is not None:
+            return self.stats.decode.measure(self._decode, deepsmiles, self.rings, decode.decode_with_metadata)
+        return self._decode(deepsmiles, decode.decode)
+    def _encode(self, smiles, func):
+        # 'func' is encode.encode, or encode.encode_with_metadata if
+        # instrumented (in which case the metadata is cached too)
+        if self._encode_cache is None:
+            return func(smiles, self.rings, self.branches)
+        key = (self.rings, self.branches, smiles)
+        ans = self._encode_cache.get(key)
+        if ans is None:
+            ans = func(smiles, self.rings, self.branches)
+            self._encode_cache.put(key, ans)
+        return ans
+    def _decode(self, deepsmiles, func):
+        # As for _encode(), with decode.decode or decode.decode_with_metadata
+        if self._decode_cache is None:
+            return func(deepsmiles, self.rings, self.branches, self.reuse_digits, self.limits)
+        key = (self.rings, self.branches, deepsmiles)
+        ans = self._decode_cache.get(key)
+        if ans is None:
+            ans = func(deepsmiles, self.rings, self.branches, self.reuse_digits, self.limits)
+            self._decode_cache.put(key, ans)
+        return ans
+    def try_decode(self, deepsmiles):
+        """Decode a DeepSMILES string back to SMILES, without raising a DecodeError
+
+        Returns a DecodeResult tuple of the SMILES (None if it cannot be
+        decoded), the reason code (exceptions.OK if it can) and the
+        position of the error (None if it can). See decode.try_decode().
+        """
+        try:
+            return decode.DecodeResult(self.decode(deepsmiles), exceptions.OK, None)
+        except exceptions.DecodeError as e:
+            return decode.DecodeResult(None, e.code, e.idx)
+    def encode_with_metadata(self, smiles):
+        """Encode a SMILES string as DeepSMILES, along with its EncodeMetadata
+
+        Returns a tuple of the DeepSMILES and the EncodeMetadata (the
+        length, number of atoms and tokens, ring sizes, branch depth and
+        number of inverted stereocentres). See encode.encode_with_metadata().
+        The cache is not used.
+        """
+        return encode.encode_with_metadata(smiles, self.rings, self.branches)
+    def is_valid(self, deepsmiles):
+        """Return whether a DeepSMILES string can be decoded
+
+        This makes the same checks as decode() but is faster, as no SMILES
+        is written and no exception is raised.
+        """
+        return decode.validate(deepsmiles, self.rings, self.branches, self.limits)[0] == exceptions.OK
+    def validate(self, deepsmiles):
+        """Check whether a DeepSMILES string can be decoded
+
+        Returns a tuple of the reason code and the position of the error.
+        This is (exceptions.OK, None) if the string is valid, and otherwise
+        the same as the 'code' and 'idx' of the DecodeError that decode()
+        would raise.
+        """
+        return decode.validate(deepsmiles, self.rings, self.branches, self.limits)
+    def options(self):
+        """Return the keyword options that affect the results, as a dict
+
+        Converter(**options) makes an equivalent Converter, for example in
+        another process.
+        """
+        return {"rings": self.rings, "branches": self.branches,
+                "reuse_digits": self.reuse_digits, "limits": self.limits}
+    def cache_info(self):
+        """Return the cache statistics as a dict of CacheInfo tuples
+
+        The dict has keys "encode" and "decode", and is empty if there
+        is no cache.
+        """
+        if self._encode_cache is None:
+            return {}
+        return {"encode": self._encode_cache.info(),
+                "decode": self._decode_cache.info()}
+    def cache_clear(self):
+        """Empty the cache and reset its statistics"""
+        if self._encode_cache is not None:
+            self._encode_cache.clear()
+            self._decode_cache.clear()
+    def encode_many(self, smiles, processes=None, chunksize=1000, errors="raise"):
+        """Encode an iterable of SMILES strings as DeepSMILES
+
+        The results are yielded lazily, in input order. The input is
+        split into chunks of 'chunksize' strings which are shared out
+        across a pool of 'processes' worker processes (by default, one
+        per CPU). If 'processes' is 1, the work is done in the current
+        process instead (making use of any cache).
+
+        'errors' is the policy for a string that cannot be converted:
+        1. "raise" raises the exception (the default)
+        2. "skip" leaves it out of the results
+        3. "none" gives None in its place
+        """
+        return self._convert_many("encode", encode.encode, smiles, processes, chunksize, errors)
+    def encode_with_metadata_many(self, smiles, processes=1, chunksize=1000, errors="raise"):
+        """Encode an iterable of SMILES strings, along with their EncodeMetadata
+
+        Yields a (deepsmiles, metadata) tuple for each string, as for
+        encode_with_metadata(). The keyword options are as for
+        encode_many(), except that by default the work is done in the
+        current process.
+        """
+        return self._convert_many("encode_with_metadata", encode.encode_with_metadata,
+                                  smiles, processes, chunksize, errors)
+    def decode_many(self, deepsmiles, processes=None, chunksize=1000, errors="raise"):
+        """Decode an iterable of DeepSMILES strings back to SMILES
+
+        The keyword options are the same as for encode_many().
+        """
+        return self._convert_many("decode", decode.decode, deepsmiles, processes, chunksize, errors)
+    def encode_into(self, smiles, out, processes=1, chunksize=1000, errors="raise", sep=b"\n"):
+        """Encode an iterable of SMILES strings, appending them to a bytearray
+
+        Each result is written to 'out' followed by 'sep', a chunk at a
+        time, so that no bytes object is made for each string. The SMILES
+        may be str or bytes-like. With the "none" error policy, a string
+        that cannot be converted gives an empty line. The other options
+        are as for encode_many(), except that by default the work is done
+        in the current process.
+
+        Returns the number of strings written.
+        """
+        return self._convert_into(self.encode_many, smiles, out, processes, chunksize, errors, sep)
+    def decode_into(self, deepsmiles, out, processes=1, chunksize=1000, errors="raise", sep=b"\n"):
+        """Decode an iterable of DeepSMILES strings, appending them to a bytearray
+
+        The options are as for encode_into().
+        """
+        return self._convert_into(self.decode_many, deepsmiles, out, processes, chunksize, errors, sep)
+    def _convert_into(self, method, data, out, processes, chunksize, errors, sep):
+        sep = lexer.as_text(sep)
+        N = 0
+        results = method((lexer.as_text(x) for x in data), processes, chunksize, errors)
+        for chunk in _chunks(results, chunksize):
+            chunk.append("")
+            out += lexer.as_bytes(sep.join(["" if x is None else x for x in chunk]))
+            N += len(chunk) - 1
+        return N
+    def try_decode_many(self, deepsmiles, processes=1, chunksize=1000):
+        """Decode an iterable of DeepSMILES strings, without raising a DecodeError
+
+        Yields a DecodeResult for each string, as for try_decode(). The
+        'processes' and 'chunksize' options are as for encode_many(),
+        except that by default the work is done in the current process.
+        """
+        return self._convert_many("try_decode", decode.try_decode, deepsmiles, processes, chunksize, "raise")
+    def validate_many(self, deepsmiles, processes=1, chunksize=1000, details=False):
+        """Check whether each of an iterable of DeepSMILES strings can be decoded
+
+        Yields True or False for each string, or if 'details' is True,
+        the (code, position) tuple from validate(). The 'processes' and
+        'chunksize' options are as for encode_many(), except that by
+        default the work is done in the current process.
+        """
+        if details:
+            return self._convert_many("validate", decode.validate, deepsmiles, processes, chunksize, "raise")
+        return self._convert_many("is_valid", _is_valid, deepsmiles, processes, chunksize, "raise")
+    def _convert_many(self, direction, func, data, processes, chunksize, errors):
+        # The method named by 'direction' is used in this process, while
+        # 'func' (the plain module function) is sent to the worker processes
+
+        if errors not in ERROR_POLICIES:
+            raise ValueError("errors should be one of %s" % ", ".join(ERROR_POLICIES))
+        if processes is None:
+            processes = os.cpu_count() or 1
+        chunks = _chunks(data, chunksize)
+        if processes == 1:
+            method = getattr(self, direction)
+            return itertools.chain.from_iterable(
+                    _convert_chunk(method, chunk, errors) for chunk in chunks)
+        if self.stats is not None and direction in ("encode", "decode"):
+            worker = Converter(self.rings, self.branches, instrument=True,
+                               reuse_digits=self.reuse_digits, limits=self.limits)
+            return _convert_in_pool((worker, direction), chunks, errors, processes, self.stats)
+        if direction in ("decode", "try_decode"):
+            func = functools.partial(func, rings=self.rings, branches=self.branches,
+                                     reuse_digits=self.reuse_digits, limits=self.limits)
+        elif direction in ("validate", "is_valid"):
+            func = functools.partial(func, rings=self.rings, branches=self.branches,
+                                     limits=self.limits)
+        else:
+            func = functools.partial(func, rings=self.rings, branches=self.branches)
+        return _convert_in_pool(func, chunks, errors, processes)
     def __str__(self):
-        """Return a string representation"""
-        return "Converter(rings=%s, branches=%s)" % (
+        """Return a string representation
+
+        The decoding options reuse_digits and limits are included if they
+        are set.
+        """
+        ans = "Converter(rings=%s, branches=%s" % (
                 ["False", "True"][self.rings],
                 ["False", "True"][self.branches])
-
-
+        if self.reuse_digits:
+            ans += ", reuse_digits=True"
+        if self.limits is not None:
+            ans += ", limits=Limits(%s)" % ", ".join("%s=%d" % (name, value)
+                    for name, value in zip(self.limits._fields, self.limits) if value is not None)
+        return ans + ")"
@@ -0,0 +1,309 @@
+# Copyright 2018 NextMove Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""A compact, memory-mapped file format for a corpus of DeepSMILES strings
+
+The file holds all of the strings as one contiguous blob of ASCII bytes,
+followed by an array of offsets into it, so that a reader can map the
+file into memory and get at any string in constant time without copying.
+Optionally, the token IDs of each string (see deepsmiles.vocab) are
+stored in the same way. As the file is only ever mapped read-only, the
+pages are shared between all of the processes that read it, such as the
+workers of a data loader.
+
+The layout is a header, the blob, then (aligned to 8 bytes) the offsets
+as little-endian uint64, and if present, the token offsets as uint64,
+the token IDs as int32, and the vocabulary as JSON.
+"""
+import array
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+from .converter import Converter, ERROR_POLICIES
+from .vocab import Vocabulary
+
+MAGIC = b"DSCORPUS"
+VERSION = 1
+RINGS, BRANCHES, TOKENS = 1, 2, 4 # flags
+# magic, version, flags, count, then the start of the blob, the offsets,
+# the token offsets, the token IDs, the vocabulary, and the end of the vocabulary
+HEADER = struct.Struct("<8s9Q")
+
+def _write_array(fileobj, values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    fileobj.write(values.tobytes())
+
+def _pad(fileobj):
+    remainder = fileobj.tell() % 8
+    if remainder:
+        fileobj.write(b"\0" * (8 - remainder))
+    return fileobj.tell()
+
+class CorpusWriter:
+    def __init__(self, filename, converter, vocab=None, errors="raise"):
+        """Initialise a CorpusWriter, which writes to 'filename'
+
+        SMILES strings are encoded with 'converter'. If 'vocab' is given,
+        the token IDs of each DeepSMILES string are stored too.
+
+        'errors' is the policy for a SMILES string that cannot be encoded,
+        as for Converter.encode_many(): "raise", "skip" it, or "none" to
+        store an empty string in its place (keeping the row numbers the
+        same as those of the input).
+        """
+        if errors not in ERROR_POLICIES:
+            raise ValueError("errors should be one of %s" % ", ".join(ERROR_POLICIES))
+        self.filename = filename
+        self.converter = converter
+        self.vocab = vocab
+        self.errors = errors
+        self.count = 0
+        self.file = open(filename, "wb")
+        self.file.write(b"\0" * HEADER.size)
+        self.offsets = tempfile.TemporaryFile()
+        self.pending = array.array("Q", [0])
+        self.blob_length = 0
+        if vocab is not None:
+            self.token_offsets = tempfile.TemporaryFile()
+            self.ids = tempfile.TemporaryFile()
+            self.pending_token_offsets = array.array("Q", [0])
+            self.pending_ids = array.array("i")
+            self.id_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._discard()
+
+    def _flush(self):
+        _write_array(self.offsets, self.pending)
+        self.pending = array.array("Q")
+        if self.vocab is not None:
+            _write_array(self.token_offsets, self.pending_token_offsets)
+            _write_array(self.ids, self.pending_ids)
+            self.pending_token_offsets = array.array("Q")
+            self.pending_ids = array.array("i")
+
+    def add(self, deepsmiles):
+        """Append a DeepSMILES string that is already encoded"""
+        data = deepsmiles.encode("ascii")
+        self.file.write(data)
+        self.blob_length += len(data)
+        self.pending.append(self.blob_length)
+        if self.vocab is not None:
+            ids = self.vocab.ids(deepsmiles)
+            self.pending_ids.extend(ids)
+            self.id_count += len(ids)
+            self.pending_token_offsets.append(self.id_count)
+        self.count += 1
+        if len(self.pending) >= 65536:
+            self._flush()
+
+    def write(self, smiles):
+        """Encode a SMILES string and append it
+
+        Returns the row number, or None if the string was skipped.
+        """
+        try:
+            encoded = self.converter.encode(smiles)
+        except Exception:
+            if self.errors == "raise":
+                raise
+            if self.errors == "skip":
+                return None
+            encoded = ""
+        self.add(encoded)
+        return self.count - 1
+
+    def write_many(self, smiles, processes=1, chunksize=1000):
+        """Encode an iterable of SMILES strings and append them
+
+        The strings are streamed through Converter.encode_many(), so the
+        'processes' and 'chunksize' options are as described there.
+        Returns the number of rows written.
+        """
+        start = self.count
+        for encoded in self.converter.encode_many(smiles, processes, chunksize, self.errors):
+            self.add("" if encoded is None else encoded)
+        return self.count - start
+
+    def close(self):
+        """Write the offsets and header, and close the file"""
+        if self.file is None:
+            return
+        self._flush()
+        out = self.file
+        positions = [HEADER.size]
+        for part in [self.offsets] + ([self.token_offsets, self.ids] if self.vocab is not None else []):
+            positions.append(_pad(out))
+            part.seek(0)
+            shutil.copyfileobj(part, out)
+            part.close()
+        flags = RINGS * self.converter.rings + BRANCHES * self.converter.branches
+        if self.vocab is not None:
+            flags |= TOKENS
+            positions.append(out.tell())
+            out.write(json.dumps(self.vocab.tokens).encode("ascii"))
+        else:
+            positions += [0, 0, out.tell()]
+        positions.append(out.tell())
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, VERSION, flags, self.count, *positions))
+        out.close()
+        self.file = None
+
+    def _discard(self):
+        self.file.close()
+        self.file = None
+        self.offsets.close()
+        if self.vocab is not None:
+            self.token_offsets.close()
+            self.ids.close()
+        os.remove(self.filename)
+
+class CorpusReader:
+    def __init__(self, filename):
+        """Initialise a CorpusReader by memory-mapping 'filename'
+
+        corpus[i] is the DeepSMILES string of row i as a memoryview of
+        ASCII bytes (use bytes() or text() for a copy), and corpus[i:j]
+        is a CorpusReader for a range of the rows that shares the same
+        mapping. If token IDs were stored, ids(i) is a memoryview of
+        int32 token IDs and 'vocab' is the Vocabulary.
+        """
+        if sys.byteorder == "big":
+            raise ValueError("Reading a corpus file requires a little-endian machine")
+        self.filename = filename
+        with open(filename, "rb") as inp:
+            header = inp.read(HEADER.size)
+            if len(header) != HEADER.size or header[:len(MAGIC)] != MAGIC:
+                raise ValueError("%s is not a DeepSMILES corpus file" % filename)
+            self.mmap = mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, flags, count, blob, offsets, token_offsets, ids,
+         vocab, end) = HEADER.unpack(header)
+        if version != VERSION:
+            raise ValueError("Unsupported corpus file version %d" % version)
+        self.rings = bool(flags & RINGS)
+        self.branches = bool(flags & BRANCHES)
+        view = memoryview(self.mmap)
+        self.blob = view[blob:blob + (offsets - blob)]
+        self.offsets = view[offsets:offsets + 8 * (count + 1)].cast("Q")
+        if flags & TOKENS:
+            self.token_offsets = view[token_offsets:token_offsets + 8 * (count + 1)].cast("Q")
+            self.token_ids = view[ids:vocab].cast("i")
+            self.vocab = Vocabulary(json.loads(self.mmap[vocab:end].decode("ascii")))
+        else:
+            self.token_offsets = self.token_ids = self.vocab = None
+        self.start, self.stop = 0, count
+        self.owner = True
+
+    def converter(self):
+        """Return a Converter for the variant of DeepSMILES in the file"""
+        return Converter(rings=self.rings, branches=self.branches)
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def _row(self, i):
+        N = self.stop - self.start
+        if i < 0:
+            i += N
+        if not 0 <= i < N:
+            raise IndexError("corpus index out of range")
+        return self.start + i
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError("A corpus can only be sliced with a step of 1")
+            ans = object.__new__(CorpusReader)
+            ans.__dict__.update(self.__dict__)
+            ans.start, ans.stop = self.start + start, self.start + max(start, stop)
+            ans.owner = False
+            return ans
+        row = self._row(i)
+        return self.blob[self.offsets[row]:self.offsets[row + 1]]
+
+    def __iter__(self):
+        blob, offsets = self.blob, self.offsets
+        for row in range(self.start, self.stop):
+            yield blob[offsets[row]:offsets[row + 1]]
+
+    def text(self, i):
+        """Return the DeepSMILES string of row i as a str"""
+        return str(self[i], "ascii")
+
+    def ids(self, i):
+        """Return the token IDs of row i as a memoryview of int32"""
+        if self.token_ids is None:
+            raise ValueError("%s does not include token IDs" % self.filename)
+        row = self._row(i)
+        return self.token_ids[self.token_offsets[row]:self.token_offsets[row + 1]]
+
+    def span(self):
+        """Return the bytes of all of the rows, concatenated, as a memoryview"""
+        return self.blob[self.offsets[self.start]:self.offsets[self.stop]]
+
+    def close(self):
+        """Release the mapping
+
+        If memoryviews from the corpus are still in use elsewhere, the
+        mapping is instead released once they have all gone. Closing a
+        slice of a corpus does nothing.
+        """
+        if not self.owner:
+            return
+        for name in ("blob", "offsets", "token_offsets", "token_ids"):
+            view = self.__dict__.pop(name, None)
+            if view is not None:
+                view.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # When sent to another process, the file is mapped again there
+        return {"filename": self.filename, "start": self.start, "stop": self.stop}
+
+    def __setstate__(self, state):
+        self.__init__(state["filename"])
+        self.start, self.stop = state["start"], state["stop"]
+
+    def __str__(self):
+        """Return a string representation"""
+        return "CorpusReader(%s, %d rows)" % (self.filename, len(self))
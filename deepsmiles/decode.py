@@ -18,240 +18,578 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
-import itertools
-from collections import defaultdict
+import heapq
+import sys
+from collections import defaultdict, namedtuple
 
 from . import exceptions
+from . import lexer
 
 bondchars = "-=#$:/\\"
 
-def is_ring_symbol(char):
-    return char.isdigit() or char=='%'
+# Markers used in place of node indices on the stack in Tree.to_smiles().
+# CLOSE_BRANCH closes a branch with a single ')', and each smaller number
+# with one more (for DeepSMILES branches).
+OPEN_BRANCH, CLOSE_BRANCH = -1, -2
+
+class RingDigits:
+    """Hands out ring-closure digits for SMILES, reusing those that are free
+
+    symbol() should be called for each ring-closure symbol in the order
+    that they are written. The first call for a ring opens it, with the
+    lowest digit that is not in use, and the second closes it, freeing
+    the digit. A digit freed at an atom is not reused at the same atom,
+    as SMILES such as C11 are easily misread.
+    """
+    __slots__ = ["open", "free", "next_digit", "atom", "released"]
+
+    def __init__(self):
+        self.open = {} # ring -> digit
+        self.free = [] # a heap of the digits that have been freed
+        self.next_digit = 1
+        self.atom = None
+        self.released = []
+
+    def symbol(self, ring, atom):
+        """Return the ring-closure symbol for 'ring' at 'atom'"""
+        if atom != self.atom:
+            for digit in self.released:
+                heapq.heappush(self.free, digit)
+            self.atom = atom
+            self.released = []
+        digit = self.open.pop(ring, None)
+        if digit is None:
+            if self.free:
+                digit = heapq.heappop(self.free)
+            else:
+                digit = self.next_digit
+                self.next_digit += 1
+            self.open[ring] = digit
+        else:
+            self.released.append(digit)
+        return lexer.ring_symbol(digit)
+
+class Shape:
+    """The ring sizes and maximum branch depth, as recorded by the decoders"""
+    __slots__ = ["ring_sizes", "branch_depth"]
+
+    def __init__(self):
+        self.ring_sizes = []
+        self.branch_depth = 0
 
 class Tree:
+    """A rooted tree of atoms, stored as arrays indexed by node
+
+    parent -- the parent of each node (-1 for a root)
+    first_child, last_child -- the first and last child of each node (-1 for none)
+    next_sibling -- the next child of the same parent (-1 for none)
+    annotations -- None, or a list of the text to write after each node.
+                   Ring closures added by add_ring_closure() are instead
+                   (bond symbol, ring) tuples, where the rings are numbered
+                   in the order that they were closed, and are given their
+                   digits when the SMILES is written.
+    """
+    __slots__ = ["nodes", "parent", "first_child", "last_child", "next_sibling",
+                 "annotations", "rc_digit"]
+
     def __init__(self):
         self.nodes = []
-        self.edges = defaultdict(list)
-        self.rev_edges = {}
+        self.parent = []
+        self.first_child = []
+        self.last_child = []
+        self.next_sibling = []
+        self.annotations = []
         self.rc_digit = 0
 
     def add_node(self, text):
         self.nodes.append(text)
+        self.parent.append(-1)
+        self.first_child.append(-1)
+        self.last_child.append(-1)
+        self.next_sibling.append(-1)
+        self.annotations.append(None)
         return len(self.nodes)-1
 
     def add_edge(self, _from, to):
-        self.edges[_from].append(to)
-        self.rev_edges[to] = _from
+        self.parent[to] = _from
+        if self.first_child[_from] == -1:
+            self.first_child[_from] = to
+        else:
+            self.next_sibling[self.last_child[_from]] = to
+        self.last_child[_from] = to
 
-    def add_ring_closure(self, _from, rc, bondchar):
-        curr = _from
-        for i in range(rc-1):
-            try:
-                curr = self.rev_edges[curr]
-            except:
+    def annotate(self, N, text):
+        """Add text to be written after node N"""
+        if self.annotations[N] is None:
+            self.annotations[N] = [text]
+        else:
+            self.annotations[N].append(text)
+
+    def add_ring_closure(self, _from, rc, bondchar, path):
+        """Close a ring of size rc at node _from
+
+        path is the list of nodes from the root to the current node, as
+        kept by the decoder, so that the ring opening can be found
+        directly. Returns False if there is no such ring opening.
+        """
+        if _from < 0 or rc < 1:
+            return False
+        if path and path[-1] == _from:
+            if rc > len(path):
                 return False
+            curr = path[-rc]
+        else: # _from has already been popped off the path
+            curr = _from
+            for i in range(rc-1):
+                curr = self.parent[curr]
+                if curr == -1:
+                    return False
         self.rc_digit += 1
-        if self.rc_digit < 10:
-            smi_bcsymbol = str(self.rc_digit)
-        elif self.rc_digit < 100:
-            smi_bcsymbol = "%" + str(self.rc_digit)
-        else:
-            smi_bcsymbol = "%(" + str(self.rc_digit) + ")"
-        self.nodes[_from] += bondchar + smi_bcsymbol
-        self.nodes[curr] += smi_bcsymbol
+        self.annotate(_from, (bondchar, self.rc_digit))
+        self.annotate(curr, ("", self.rc_digit))
         return True
 
-    def to_smiles(self):
+    def chain_length(self, N):
+        """Return the number of nodes in the chain that continues from node N
+
+        This is the number of atoms in the branch that starts at N, not
+        counting those in any branches from it.
+        """
+        ans = 1
+        while self.last_child[N] != -1:
+            N = self.last_child[N]
+            ans += 1
+        return ans
 
-        def visit(N):
-            children = self.edges[N]
-            if not children:
-                return self.nodes[N]
-            if len(children) == 1:
-                return self.nodes[N] + visit(children[0])
-            ans = []
-            for child in children[:-1]:
-                ans.append('(%s)' % visit(child))
-            ans.append(visit(children[-1]))
-            return self.nodes[N] + "".join(ans)
+    def to_smiles(self, branches=False, reuse_digits=False, shape=None):
+        """Write out the tree from the first node as SMILES
 
-        return visit(0)
+        Every child except the last is written as a parenthesised branch,
+        or if 'branches' is True, as a DeepSMILES branch (closed by one
+        ')' for each atom in the branch). The traversal uses an explicit
+        stack so that there is no limit on the size of the tree.
 
-def decode_branches(deepsmiles, rings):
+        Each ring closure gets its own digit, in the order that they were
+        closed, unless 'reuse_digits' is True, in which case it gets the
+        lowest digit that is free (see RingDigits).
+
+        If 'shape' (a Shape) is given, the maximum depth of nested
+        branches in the SMILES is recorded in it.
+        """
+        if not self.nodes:
+            return ""
+        nodes = self.nodes
+        annotations = self.annotations
+        first_child = self.first_child
+        next_sibling = self.next_sibling
+        digits = RingDigits() if reuse_digits else None
+
+        ans = []
+        stack = [0]
+        depth = 0
+        while stack:
+            N = stack.pop()
+            if N < 0:
+                if N == OPEN_BRANCH:
+                    ans.append('(')
+                    if shape is not None:
+                        depth += 1
+                        if depth > shape.branch_depth:
+                            shape.branch_depth = depth
+                else:
+                    ans.append(')' * (CLOSE_BRANCH - N + 1))
+                    depth -= 1
+                continue
+            ans.append(nodes[N])
+            if annotations[N] is not None:
+                for x in annotations[N]:
+                    if isinstance(x, str):
+                        ans.append(x)
+                    elif digits is None:
+                        ans.append(x[0] + lexer.ring_symbol(x[1]))
+                    else:
+                        ans.append(x[0] + digits.symbol(x[1], N))
+            child = first_child[N]
+            if child == -1:
+                continue
+            children = []
+            while child != -1:
+                children.append(child)
+                child = next_sibling[child]
+            stack.append(children[-1])
+            for child in reversed(children[:-1]):
+                if branches:
+                    stack.append(CLOSE_BRANCH + 1 - self.chain_length(child))
+                    stack.append(child)
+                else:
+                    stack.append(CLOSE_BRANCH)
+                    stack.append(child)
+                    stack.append(OPEN_BRANCH)
+        return "".join(ans)
+
+def lexer_error(deepsmiles, i):
+    """Return the DecodeError for an unmatched '[' or a bad '%' at position i"""
+    if deepsmiles[i] == '[':
+        return exceptions.DecodeError(deepsmiles, i, "There is a '[' without the corresponding ']'",
+                                      exceptions.UNMATCHED_BRACKET)
+    if deepsmiles[i+1:i+2] == '(':
+        if deepsmiles.find(')', i+2) == -1:
+            return exceptions.DecodeError(deepsmiles, i, "'%(' is missing the corresponding close parenthesis",
+                                          exceptions.BAD_RING_SYMBOL)
+        return exceptions.DecodeError(deepsmiles, i, "'%(' should be followed by a number and a close parenthesis",
+                                      exceptions.BAD_RING_SYMBOL)
+    return exceptions.DecodeError(deepsmiles, i, "'%' should be followed by two digits",
+                                  exceptions.BAD_RING_SYMBOL)
+
+def decode_branches(deepsmiles, rings, tokens=None, reuse_digits=False, shape=None):
     """
     Decode DeepSMILES/Branches and DeepSMILES/Branches+Rings to SMILES
+
+    tokens -- the tokens of deepsmiles, if it has already been split
+    reuse_digits -- whether to reuse ring-closure digits once they are free
+    shape -- a Shape in which to record the ring sizes and branch depth
+    """
+    return build_tree(deepsmiles, rings, tokens, shape).to_smiles(reuse_digits=reuse_digits, shape=shape)
+
+def build_tree(deepsmiles, rings, tokens=None, shape=None):
+    """
+    Read DeepSMILES/Branches or DeepSMILES/Branches+Rings into a Tree
+
+    If 'shape' is given, the ring sizes are recorded in it.
     """
     stack = []
     tree = Tree()
-    i = 0
     idx = -1
-    while i < len(deepsmiles):
-        x = deepsmiles[i]
-        if x == ')':
+    bondchar = ""
+    pos = 0
+    if tokens is None:
+        tokens = lexer.token_re.findall(deepsmiles)
+    for x in tokens:
+        i = pos
+        pos += len(x)
+        kind = lexer.kinds.get(x[0])
+        if kind is None or kind == lexer.OPEN: # add atom (a stray '(' is treated as an atom too)
+            if x == '[':
+                raise lexer_error(deepsmiles, i)
+            idx = tree.add_node(bondchar + x)
+            if stack:
+                tree.add_edge(stack[-1], idx)
+            stack.append(idx)
+        elif kind == lexer.BOND:
+            bondchar = x
+            continue
+        elif kind == lexer.CLOSE:
             if len(stack) == 0:
-                raise exceptions.DecodeError(deepsmiles, i, "Too many close parentheses - there is no corresponding atom to pop off the stack")
+                raise exceptions.DecodeError(deepsmiles, i, "Too many close parentheses - there is no corresponding atom to pop off the stack",
+                                             exceptions.TOO_MANY_CLOSE_PARENS)
             stack.pop()
-        elif x in bondchars:
-            pass
-        elif x == '%':
-            if i == 0:
-                raise exceptions.DecodeError(deepsmiles, i, "'%' not allowed as first character")
-            bondchar = deepsmiles[i-1] if i > 0 and deepsmiles[i-1] in bondchars else ""
-            if deepsmiles[i+1] == '(':
-                closebracket = deepsmiles.find(')', i+2)
-                if closebracket == -1:
-                    raise exceptions.DecodeError(deepsmiles, i, "'%(' is missing the corresponding close parenthesis")
-                digit = int(deepsmiles[i+2:closebracket])
-                i = closebracket
-            else:
-                try:
-                    digit = int(deepsmiles[i+1:i+3])
-                except ValueError:
-                    raise exceptions.DecodeError(deepsmiles, i, "'%' should be followed by two digits")
-                i += 2
-            ok = tree.add_ring_closure(idx, digit, bondchar)
-            if not ok:
-                raise exceptions.DecodeError(deepsmiles, i, "There is no corresponding atom on which to place the ring opening symbol for the ring sized %s" % digit)
-        elif x.isdigit():
+        elif kind == lexer.RING:
             if i == 0:
-                raise exceptions.DecodeError(deepsmiles, i, "digit not allowed as first character")
-            bondchar = deepsmiles[i-1] if i > 0 and deepsmiles[i-1] in bondchars else ""
-            ok = tree.add_ring_closure(idx, int(x), bondchar)
-            if not ok:
-                raise exceptions.DecodeError(deepsmiles, i, "There is no corresponding atom on which to place the ring opening symbol for the ring sized %s" % deepsmiles[i])
-        else: # add atom
-            bondchar = deepsmiles[i-1] if i > 0 and deepsmiles[i-1] in bondchars else ""
-            if i < len(deepsmiles) - 1 and ((x=='C' and deepsmiles[i+1]=='l') or (x=='B' and deepsmiles[i+1]=='r')):
-                idx = tree.add_node(bondchar + x + deepsmiles[i+1])
-                i += 1
-            elif x=='[':
-                closebracket = deepsmiles.find(']', i)
-                if closebracket == -1:
-                    raise exceptions.DecodeError(deepsmiles, i, "There is a '[' without the corresponding ']'")
-                idx = tree.add_node(bondchar + deepsmiles[i:closebracket+1])
-                i = closebracket
+                if x[0] == '%':
+                    raise exceptions.DecodeError(deepsmiles, i, "'%' not allowed as first character",
+                                                 exceptions.RING_AT_START)
+                raise exceptions.DecodeError(deepsmiles, i, "digit not allowed as first character",
+                                             exceptions.RING_AT_START)
+            if x == '%':
+                raise lexer_error(deepsmiles, i)
+            if not rings and idx >= 0:
+                # If we are not handling ring closures specially just hoover them up and bung them
+                # on the end of the atom
+                tree.annotate(idx, bondchar + x)
             else:
-                idx = tree.add_node(bondchar + x)
-            # If we are not handling ring closures specially just hoover them up and bung them
-            # on the end of the atom
-            if not rings:
-                tmpi = i+1
-                while tmpi < len(deepsmiles) and (is_ring_symbol(deepsmiles[tmpi]) or (deepsmiles[tmpi] in bondchars and is_ring_symbol(deepsmiles[tmpi+1]))):
-                    tmpi += 1
-                if tmpi > i+1:
-                    tree.nodes[-1] += deepsmiles[i+1:tmpi]
-                    i = tmpi-1
-            if stack:
-                tree.add_edge(stack[-1], idx)
-            stack.append(idx)
-        i += 1
-
-    return tree.to_smiles()
+                digit = lexer.ring_number(x)
+                ok = tree.add_ring_closure(idx, digit, bondchar, stack)
+                if not ok:
+                    raise exceptions.DecodeError(deepsmiles, pos-1, "There is no corresponding atom on which to place the ring opening symbol for the ring sized %d" % digit,
+                                                 exceptions.NO_RING_OPENING)
+                if shape is not None:
+                    shape.ring_sizes.append(digit)
+        bondchar = ""
 
-# From the itertools docs
-def nth(iterable, n):
-    """Returns the nth item"""
-    return next(itertools.islice(iterable, n, None))
+    return tree
 
-def flatten_in_reverse(sequence):
-    for item in reversed(sequence):
-        if isinstance(item, list):
-            for subitem in flatten_in_reverse(item):
-                yield subitem
-        else:
-            yield item
-
-def decode_only_rings(deepsmiles):
+def decode_only_rings(deepsmiles, tokens=None, reuse_digits=False, shape=None):
     """
     Decode DeepSMILES/Rings to SMILES
+
+    tokens -- the tokens of deepsmiles, if it has already been split
+    reuse_digits -- whether to reuse ring-closure digits once they are free
+    shape -- a Shape in which to record the ring sizes and branch depth
     """
-    # smi_prev is a list, for each bracket level, of the atom lookups seen at that level
-    # When we come to a close bracket, smi_prev.pop() is called.
-    # This means that the length of this list, at any point, gives the distance along the
-    # shortest branch from the first atom
-    smi_prev = [[]]
+    # path is the list of atom lookups along the shortest route from the first atom to
+    # the current one, so the ring opening for a ring of size N is at path[-N].
+    # branch_starts records the length of the path at each open bracket. When we
+    # come to a close bracket, the path is cut back to that length.
+    path = []
+    branch_starts = []
 
     ans = []
-    bondclosures = defaultdict(str) # ans idx -> string
+    # The ring closures (bond symbol, ring) and ring openings (ring) to write
+    # after each 'ans' idx, where the rings are numbered in order of closing
+    closures = defaultdict(list)
+    openings = defaultdict(list)
 
-    digit = 1
+    ring = 0
+    bondchar = ""
 
-    i = 0
-    while i < len(deepsmiles):
-        x = deepsmiles[i]
-        if x == ')':
-            lastbranch = smi_prev.pop()
+    pos = 0
+    if tokens is None:
+        tokens = lexer.token_re.findall(deepsmiles)
+    for x in tokens:
+        i = pos
+        pos += len(x)
+        kind = lexer.kinds.get(x[0])
+        if kind is None: # an atom
+            if x == '[':
+                raise lexer_error(deepsmiles, i)
+            path.append(len(ans))
+            ans.append(bondchar + x)
+        elif kind == lexer.BOND:
+            bondchar = x
+            continue
+        elif kind == lexer.CLOSE:
+            if not branch_starts:
+                raise exceptions.DecodeError(deepsmiles, i, "Too many close parentheses - there is no corresponding open parenthesis",
+                                             exceptions.TOO_MANY_CLOSE_PARENS)
+            del path[branch_starts.pop():]
             ans.append(')')
-        elif x == '(':
-            smi_prev.append([])
+        elif kind == lexer.OPEN:
+            branch_starts.append(len(path))
             ans.append('(')
-        elif x in bondchars:
-            pass
-        elif is_ring_symbol(x):
+            if shape is not None and len(branch_starts) > shape.branch_depth:
+                shape.branch_depth = len(branch_starts)
+        elif kind == lexer.RING:
             if i == 0 or not ans:
-                raise exceptions.DecodeError(deepsmiles, i, "Ring closure symbol must be preceded by an atom")
-            bondchar = deepsmiles[i-1] if deepsmiles[i-1] in bondchars else ""
-            depth = sum(len(z) for z in smi_prev)
-            if x == "%":
-                if deepsmiles[i+1] == '(':
-                    closebracket = deepsmiles.find(')', i+2)
-                    if closebracket == -1:
-                        raise exceptions.DecodeError(deepsmiles, i, "'%(' is missing the corresponding close parenthesis")
-                    ringsize = int(deepsmiles[i+2:closebracket])
-                    i = closebracket
-                else:
-                    try:
-                        ringsize = int(deepsmiles[i+1:i+3])
-                    except ValueError:
-                        raise exceptions.DecodeError(deepsmiles, i, "'%' should be followed by two digits")
-                    i += 2
-            else:
-                ringsize = int(x)
-            if digit < 10:
-                smi_bcsymbol = str(digit)
-            elif digit < 100:
-                smi_bcsymbol = "%" + str(digit)
-            else:
-                smi_bcsymbol = "%(" + str(digit) + ")"
-            ans[-1] += bondchar + smi_bcsymbol
-            try:
-                ring_open_atom_idx = nth(flatten_in_reverse(smi_prev), ringsize - 1)
-            except StopIteration:
-                raise exceptions.DecodeError(deepsmiles, i, "There is no corresponding atom on which to place the ring opening symbol for the ring sized %d" % ringsize)
-            bondclosures[ring_open_atom_idx] += smi_bcsymbol
-            digit += 1
-        else:
-            smi_prev[-1].append(len(ans))
-            bondchar = deepsmiles[i-1] if i > 0 and deepsmiles[i-1] in bondchars else ""
-            if x == '[':
-                closebracket = deepsmiles.find(']', i)
-                if closebracket == -1:
-                    raise exceptions.DecodeError(deepsmiles, i, "There is a '[' without the corresponding ']'")
-                ans.append(bondchar + deepsmiles[i:closebracket+1])
-                i = closebracket
-            elif i < len(deepsmiles) - 1 and deepsmiles[i:i+2] in ["Cl", "Br"]:
-                ans.append(bondchar + deepsmiles[i:i+2])
-                i += 1
-            else:
-                ans.append(bondchar + x)
-        i += 1
+                raise exceptions.DecodeError(deepsmiles, i, "Ring closure symbol must be preceded by an atom",
+                                             exceptions.RING_AT_START)
+            if x == '%':
+                raise lexer_error(deepsmiles, i)
+            ringsize = lexer.ring_number(x)
+            if ringsize < 1 or ringsize > len(path):
+                raise exceptions.DecodeError(deepsmiles, pos-1, "There is no corresponding atom on which to place the ring opening symbol for the ring sized %d" % ringsize,
+                                             exceptions.NO_RING_OPENING)
+            if shape is not None:
+                shape.ring_sizes.append(ringsize)
+            ring += 1
+            closures[len(ans)-1].append((bondchar, ring))
+            openings[path[-ringsize]].append(ring)
+        bondchar = ""
 
+    if not closures:
+        return "".join(ans)
+    digits = RingDigits() if reuse_digits else None
     finalans = []
     for idx, x in enumerate(ans):
         finalans.append(x)
-        bcsymbols = bondclosures.get(idx, None)
-        if bcsymbols:
-            finalans.append("".join(bcsymbols))
+        if idx in closures:
+            for bondchar, ring in closures[idx]:
+                finalans.append(bondchar + (lexer.ring_symbol(ring) if digits is None
+                                             else digits.symbol(ring, idx)))
+        if idx in openings:
+            for ring in openings[idx]:
+                finalans.append(lexer.ring_symbol(ring) if digits is None
+                                else digits.symbol(ring, idx))
     return "".join(finalans)
 
-def decode(deepsmiles, rings=False, branches=False):
+# Limits on the size and complexity of DeepSMILES to decode (None for no limit)
+#   length -- the number of characters
+#   atoms -- the number of atoms
+#   depth -- the number of atoms on the path from the first atom to any
+#            other, which bounds the work needed to find a ring opening
+#   ring_size -- the size of a ring (DeepSMILES/Rings only)
+#   rings -- the number of ring-closure symbols
+Limits = namedtuple("Limits", ["length", "atoms", "depth", "ring_size", "rings"])
+Limits.__new__.__defaults__ = (None,) * len(Limits._fields)
+
+LIMIT_MESSAGES = {
+    exceptions.TOO_LONG: ("length", "The DeepSMILES is longer than the limit of %d characters"),
+    exceptions.TOO_MANY_ATOMS: ("atoms", "There are more atoms than the limit of %d"),
+    exceptions.TOO_DEEP: ("depth", "The path from the first atom is longer than the limit of %d atoms"),
+    exceptions.RING_TOO_LARGE: ("ring_size", "The ring size is larger than the limit of %d"),
+    exceptions.TOO_MANY_RINGS: ("rings", "There are more ring closures than the limit of %d"),
+}
+
+def limit_error(deepsmiles, code, idx, limits):
+    """Return the DecodeError for DeepSMILES over one of the limits"""
+    field, message = LIMIT_MESSAGES[code]
+    return exceptions.DecodeError(deepsmiles, idx, message % getattr(limits, field), code)
+
+def validate(deepsmiles, rings=False, branches=False, limits=None):
+    """Check whether DeepSMILES can be decoded, without decoding it
+
+    Returns a tuple of the reason code (exceptions.OK if valid) and the
+    position of the error (None if valid). These are the same as the
+    'code' and 'idx' of the DecodeError that decode() would raise. The
+    DeepSMILES may be bytes-like.
+
+    If 'limits' (a Limits) is given, exceeding any of them is an error
+    too, found as soon as the scan reaches it. The string is then only
+    tokenized as far as needed, so that the work done is in proportion
+    to the limits rather than to the length of the input.
+    """
+    OK = exceptions.OK
+    if not rings and not branches:
+        return OK, None
+    deepsmiles = lexer.as_text(deepsmiles)
+    limited = limits is not None
+    if not limited:
+        tokens = lexer.token_re.findall(deepsmiles)
+    else:
+        if limits.length is not None and len(deepsmiles) > limits.length:
+            return exceptions.TOO_LONG, limits.length
+        tokens = (m.group() for m in lexer.token_re.finditer(deepsmiles))
+        max_atoms, max_depth, max_ring_size, max_rings = [sys.maxsize if x is None else x
+                for x in (limits.atoms, limits.depth, limits.ring_size, limits.rings)]
+    atoms = 0
+    ring_closures = 0
+    depth = 0         # the number of atoms on the path to the current atom
+    last_depth = 0    # the same, for the most recently added atom
+    branch_starts = [] # DeepSMILES/Rings only: the depth at each open bracket
+    started = False   # DeepSMILES/Rings only: whether an atom or bracket has been seen
+    pos = 0
+    for x in tokens:
+        i = pos
+        pos += len(x)
+        kind = lexer.kinds.get(x[0])
+        if kind is None or (branches and kind == lexer.OPEN):
+            if x == '[':
+                return exceptions.UNMATCHED_BRACKET, i
+            depth += 1
+            last_depth = depth
+            started = True
+            if limited:
+                atoms += 1
+                if atoms > max_atoms:
+                    return exceptions.TOO_MANY_ATOMS, i
+                if depth > max_depth:
+                    return exceptions.TOO_DEEP, i
+        elif kind == lexer.CLOSE:
+            if branches:
+                if depth == 0:
+                    return exceptions.TOO_MANY_CLOSE_PARENS, i
+                depth -= 1
+            else:
+                if not branch_starts:
+                    return exceptions.TOO_MANY_CLOSE_PARENS, i
+                depth = branch_starts.pop()
+        elif kind == lexer.OPEN: # DeepSMILES/Rings only
+            branch_starts.append(depth)
+            started = True
+        elif kind == lexer.RING:
+            if i == 0 or not (branches or started):
+                return exceptions.RING_AT_START, i
+            if x == '%':
+                return exceptions.BAD_RING_SYMBOL, i
+            if limited:
+                ring_closures += 1
+                if ring_closures > max_rings:
+                    return exceptions.TOO_MANY_RINGS, i
+            if branches:
+                if not rings and last_depth > 0:
+                    continue
+                # The decoder places the ring opening by walking up from the
+                # most recently added atom, which is 'last_depth' atoms deep
+                ringsize = lexer.ring_number(x)
+                if limited and ringsize > max_ring_size:
+                    return exceptions.RING_TOO_LARGE, i
+                if ringsize < 1 or ringsize > last_depth:
+                    return exceptions.NO_RING_OPENING, pos-1
+            else:
+                ringsize = lexer.ring_number(x)
+                if limited and ringsize > max_ring_size:
+                    return exceptions.RING_TOO_LARGE, i
+                if ringsize < 1 or ringsize > depth:
+                    return exceptions.NO_RING_OPENING, pos-1
+    return OK, None
+
+DecodeResult = namedtuple("DecodeResult", ["smiles", "code", "idx"])
+
+def try_decode(deepsmiles, rings=False, branches=False, reuse_digits=False, limits=None):
+    """
+    Decode DeepSMILES to SMILES without raising an exception
+
+    Returns a DecodeResult of the SMILES (or None if the DeepSMILES cannot
+    be decoded), the reason code (exceptions.OK, or the 'code' of the
+    DecodeError that decode() would raise) and the position of the error
+    (None if there is none).
+    """
+    try:
+        return DecodeResult(decode(deepsmiles, rings, branches, reuse_digits, limits), exceptions.OK, None)
+    except exceptions.DecodeError as e:
+        return DecodeResult(None, e.code, e.idx)
+
+def decode(deepsmiles, rings=False, branches=False, reuse_digits=False, limits=None):
     """
     Decode DeepSMILES to SMILES
+
+    As for encode(), bytes-like input gives bytes output. If 'reuse_digits'
+    is True, a ring-closure digit is reused once its ring has closed, as
+    in canonical SMILES, rather than every ring having its own number.
+    If 'limits' (a Limits) is given, DeepSMILES over any of them raises
+    a DecodeError before any decoding is done (see validate()). So does
+    any other error, which is then found without reading any further
+    than it.
     """
+    if not isinstance(deepsmiles, str):
+        return lexer.as_bytes(decode(lexer.as_text(deepsmiles), rings, branches, reuse_digits, limits))
+
     if not rings and not branches:
         return deepsmiles
 
+    return _decode(deepsmiles, rings, branches, reuse_digits, limits)
+
+# A description of a decoded molecule, collected while decoding it
+#   ring_sizes -- a tuple of the size of each ring closure (DeepSMILES/Rings
+#                 only), in the order of the DeepSMILES
+#   branch_depth -- the maximum depth of nested branches in the SMILES
+DecodeMetadata = namedtuple("DecodeMetadata", ["ring_sizes", "branch_depth"])
+
+def decode_with_metadata(deepsmiles, rings=False, branches=False, reuse_digits=False, limits=None):
+    """
+    Decode DeepSMILES to SMILES, returning it with its DecodeMetadata
+
+    The options are as for decode(). Without ring or branch decoding, the
+    DeepSMILES is returned unchanged, so only its branch depth is found.
+    """
+    if not isinstance(deepsmiles, str):
+        smiles, metadata = decode_with_metadata(lexer.as_text(deepsmiles), rings, branches, reuse_digits, limits)
+        return lexer.as_bytes(smiles), metadata
+
+    shape = Shape()
+    if not rings and not branches:
+        depth = 0
+        for x in lexer.token_re.findall(deepsmiles):
+            if x == '(':
+                depth += 1
+                if depth > shape.branch_depth:
+                    shape.branch_depth = depth
+            elif x == ')':
+                depth -= 1
+        return deepsmiles, DecodeMetadata((), shape.branch_depth)
+
+    smiles = _decode(deepsmiles, rings, branches, reuse_digits, limits, shape)
+    return smiles, DecodeMetadata(tuple(shape.ring_sizes), shape.branch_depth)
+
+def _decode(deepsmiles, rings, branches, reuse_digits, limits, shape=None):
+    if limits is not None:
+        code, idx = validate(deepsmiles, rings, branches, limits)
+        if code in LIMIT_MESSAGES:
+            raise limit_error(deepsmiles, code, idx, limits)
+        if code != exceptions.OK:
+            # Raise the same DecodeError as decoding the whole string would,
+            # but only decode as far as the token with the error
+            if code == exceptions.UNMATCHED_BRACKET or code == exceptions.BAD_RING_SYMBOL:
+                raise lexer_error(deepsmiles, idx)
+            if code == exceptions.NO_RING_OPENING: # idx is the end of the ring symbol
+                end = idx + 1
+            else:
+                end = lexer.token_re.match(deepsmiles, idx).end()
+            try:
+                _decode(deepsmiles[:end], rings, branches, reuse_digits, None)
+            except exceptions.DecodeError as e:
+                raise exceptions.DecodeError(deepsmiles, e.idx, e.message, e.code) from None
+
     if not branches:
-        return decode_only_rings(deepsmiles)
+        return decode_only_rings(deepsmiles, reuse_digits=reuse_digits, shape=shape)
 
-    return decode_branches(deepsmiles, rings=rings)
+    return decode_branches(deepsmiles, rings=rings, reuse_digits=reuse_digits, shape=shape)
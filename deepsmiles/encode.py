@@ -18,7 +18,10 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
-from collections import defaultdict
+from collections import namedtuple
+
+from . import exceptions
+from . import lexer
 
 bondchars = "-=#$:\\/"
 CLOSE, OPEN = range(2)
@@ -82,72 +85,155 @@ def shouldInvertStereo(bcinfo):
     data.sort(key=lambda x:x[1])
 
     # Check the permutation parity (even/odd) after sorting
-    outOfOrder = 0
-    for i in range(len(data)-1):
-        for j in range(i+1, len(data)):
-            if data[i][0] > data[j][0]:
-                outOfOrder += 1
-    return outOfOrder % 2 == 1
+    return isOddPermutation(sorted(range(len(data)), key=lambda i: data[i][0]))
+
+def isOddPermutation(order):
+    """
+    Return whether a permutation of range(N), given as a list, is odd
+
+    Rather than counting out-of-order pairs, this counts the cycles of
+    the permutation: a cycle of length k is k-1 swaps.
+    >>> isOddPermutation([0, 1, 2]), isOddPermutation([1, 0, 2]), isOddPermutation([1, 2, 0])
+    (False, True, False)
+    """
+    seen = [False] * len(order)
+    swaps = 0
+    for i in range(len(order)):
+        if seen[i]:
+            continue
+        seen[i] = True
+        j = order[i]
+        while j != i:
+            seen[j] = True
+            j = order[j]
+            swaps += 1
+    return swaps % 2 == 1
 
 class BondClosureInfo:
     def __init__(self):
-        self.ringopenings = {} # rc_symbol -> (depth, bondchar)
+        self.ringopenings = {} # rc_symbol -> (depth, bondchar, ans_idx, symbol_idx)
 
-        # Where a bond opening is on a stereoatom, we need to record the 'ans' index associated
-        # with that symbol so that when we come to the closing we can match it up
-        self.roindex = {} # ring_opening_symbol -> ans_idx (where the symbol is on a stereoatom)
+        # This is a map from the 'ans' idx of a stereoatom to its bond closure information
+        # This information will be used to decide whether to invert the stereo
+        self.symbolinfo = {}
 
-        # This is a map from 'ans' idx to bond closure information
-        # This information will be used to generate the final string
-        self.symbolinfo = defaultdict(list)
+# A description of an encoded molecule, collected while encoding it
+#   length -- the length of the DeepSMILES
+#   atoms -- the number of atoms
+#   tokens -- the number of DeepSMILES tokens (as given by lexer.split())
+#   ring_sizes -- a tuple of the size of each ring closure, in order of closing
+#   branch_depth -- the maximum depth of nested branches in the SMILES
+#   inverted_stereo -- the number of stereocentres whose @/@@ was inverted
+EncodeMetadata = namedtuple("EncodeMetadata", ["length", "atoms", "tokens", "ring_sizes",
+                                               "branch_depth", "inverted_stereo"])
 
 def encode(smi, rings=False, branches=False):
-    """Encode SMILES as DeepSMILES"""
+    """Encode SMILES as DeepSMILES
+
+    A str gives a str, and bytes-like input (bytes, bytearray or
+    memoryview) gives bytes.
+    """
+    if not isinstance(smi, str):
+        return lexer.as_bytes(encode(lexer.as_text(smi), rings, branches))
 
     if not rings and not branches:
         return smi
 
-    i = 0 # the index in the smiles string
+    return _encode(smi, rings, branches, False)
+
+def encode_with_metadata(smi, rings=False, branches=False):
+    """Encode SMILES as DeepSMILES, returning it with its EncodeMetadata
+
+    The metadata is collected while encoding rather than by scanning the
+    result again, so it costs little more than encode().
+
+    Without ring or branch encoding, the SMILES is returned unchanged, as
+    by encode(), even if it could not be encoded. The metadata is then
+    only the length, number of atoms and tokens and the branch depth,
+    with no ring sizes.
+    """
+    if not isinstance(smi, str):
+        deepsmiles, metadata = encode_with_metadata(lexer.as_text(smi), rings, branches)
+        return lexer.as_bytes(deepsmiles), metadata
+    if rings or branches:
+        return _encode(smi, rings, branches, True)
+    try:
+        metadata = _encode(smi, False, False, True)[1]
+    except exceptions.EncodeError:
+        tokens = lexer.token_re.findall(smi)
+        atoms = depth = max_depth = 0
+        for x in tokens:
+            kind = lexer.kinds.get(x[0])
+            if kind is None:
+                atoms += x != '['
+            elif kind == lexer.OPEN:
+                depth += 1
+                if depth > max_depth:
+                    max_depth = depth
+            elif kind == lexer.CLOSE and depth > 0:
+                depth -= 1
+        metadata = EncodeMetadata(len(smi), atoms, len(tokens), (), max_depth, 0)
+    return smi, metadata._replace(length=len(smi))
+
+def _encode(smi, rings, branches, metadata):
     ans = []
-    idx = -1 # the atom index, the first atom having idx 0
-    # smi_prev is a list, for each bracket level, of the atom indices seen at that level
-    # When we come to a close bracket, smi_prev.pop() is called.
-    # This means that the length of this list, at any point, gives the distance along the
-    # shortest branch from the first atom
-    smi_prev = [[]]
+    atom_ans = -1 # the 'ans' idx of the most recent atom
+    # level_counts is a list, for each bracket level, of the number of atoms seen at that level
+    # When we come to a close bracket, level_counts.pop() is called.
+    # depth is the sum of this list, that is, the distance along the shortest
+    # branch from the first atom, and is updated as we go
+    level_counts = [0]
+    depth = 0
     bci = BondClosureInfo()
+    bondchar = "" # the bond symbol preceding the current token, if any
+    # For the metadata (atoms and tokens are counted afterwards from 'ans')
+    ring_sizes = []
+    max_level = 0
 
-    while i < len(smi):
-        x = smi[i]
-        if x == ')':
-            lastbranch = smi_prev.pop()
+    pos = 0
+    for x in lexer.token_re.findall(smi):
+        i = pos # the index of the token in the smiles string
+        pos += len(x)
+        kind = lexer.kinds.get(x[0])
+        if kind is None: # an atom
+            if x == '[':
+                raise exceptions.EncodeError(smi, i, "There is a '[' without the corresponding ']'")
+            level_counts[-1] += 1
+            depth += 1
+            atom_ans = len(ans)
+            ans.append(bondchar + x)
+        elif kind == lexer.BOND:
+            bondchar = x
+            continue
+        elif kind == lexer.CLOSE:
+            if len(level_counts) == 1:
+                raise exceptions.EncodeError(smi, i, "Too many close parentheses - there is no corresponding open parenthesis")
+            lastbranch = level_counts.pop()
+            depth -= lastbranch
             if branches:
-                ans.append(')'*len(lastbranch))
+                ans.append(')'*lastbranch)
             else:
                 ans.append(')')
-        elif x == '(':
-            smi_prev.append([])
+        elif kind == lexer.OPEN:
+            level_counts.append(0)
+            if len(level_counts) > max_level:
+                max_level = len(level_counts)
             if not branches:
                 ans.append('(')
-        elif x in bondchars:
-            pass
-        elif x.isdigit() or x=='%':
+        elif kind == lexer.RING:
+            if x == '%':
+                raise exceptions.EncodeError(smi, i, "'%' should be followed by two digits or by a number in parentheses")
             if not rings:
-                bondchar = smi[i-1] if i > 0 and smi[i-1] in bondchars else ""
                 ans.append(bondchar + x)
-            else:
-                depth = sum(len(z) for z in smi_prev)
-                bondchar = smi[i-1] if i > 0 and smi[i-1] in bondchars else ""
-                if x == "%":
-                    if smi[i+1] != '(':
-                        bcsymbol = smi[i:i+3]
-                        i += 2
+                if metadata:
+                    # Track the ring openings just to find the ring sizes
+                    bcsymbol = lexer.ring_number(x)
+                    if bcsymbol in bci.ringopenings:
+                        ring_sizes.append(depth - bci.ringopenings.pop(bcsymbol)[0] + 1)
                     else:
-                        closeparens = smi.find(")", i+1)
-                        bcsymbol = smi[i:closeparens]
-                        i = closeparens
-                else:
-                    bcsymbol = x
+                        bci.ringopenings[bcsymbol] = (depth, bondchar, atom_ans, i)
+            else:
+                bcsymbol = lexer.ring_number(x)
                 if bcsymbol in bci.ringopenings:
                     open_depth, open_bondchar, open_ans, open_i = bci.ringopenings.pop(bcsymbol)
                     digit = depth - open_depth + 1
@@ -158,44 +244,47 @@ def encode(smi, rings=False, branches=False):
                             outbondchar = "/"
                         elif outbondchar == "/":
                             outbondchar = "\\"
-                    if "@" in ans[open_ans]:
-                        bci.symbolinfo[open_ans].append( (OPEN, open_i, i) )
+                    if open_ans >= 0 and "@" in ans[open_ans]:
+                        bci.symbolinfo.setdefault(open_ans, []).append( (OPEN, open_i, i) )
                     formatstr = "%s%d" if digit < 10 else "%s%%%d" if digit < 100 else "%s%%(%d)"
-                    bci.symbolinfo[len(ans)-1].append( (CLOSE, i, formatstr % (outbondchar, digit)) )
+                    closesymbol = formatstr % (outbondchar, digit)
+                    if atom_ans >= 0 and "@" in ans[atom_ans]:
+                        bci.symbolinfo.setdefault(atom_ans, []).append( (CLOSE, i, closesymbol) )
+                    # The ring size goes straight after the atom (and any earlier ring sizes)
+                    ans.append(closesymbol)
+                    ring_sizes.append(digit)
                 else:
-                    bci.ringopenings[bcsymbol] = (depth, bondchar, len(ans)-1, i)
-        else:
-            bondchar = smi[i-1] if i > 0 and smi[i-1] in bondchars else ""
-            idx += 1
-            smi_prev[-1].append(idx)
-            if x == '[':
-                closeparens = smi.find(']', i)
-                ans.append(bondchar + smi[i:closeparens+1])
-                i = closeparens
-            elif i < len(smi) - 1 and smi[i:i+2] in ["Cl", "Br"]:
-                ans.append(bondchar + smi[i:i+2])
-                i += 1
-            else:
-                ans.append(bondchar + x)
-        i += 1
+                    bci.ringopenings[bcsymbol] = (depth, bondchar, atom_ans, i)
+        bondchar = ""
 
-    # Stitch together the answer from the 'ans' string, plus ring sizes.
-    # While doing this, if necessary, invert the stereo of tet centers
-    # based on ring info.
-    finalans = []
-    for i, x in enumerate(ans):
-        bcinfo = bci.symbolinfo.get(i, [])
-        if bcinfo:
-            if shouldInvertStereo(bcinfo):
-                finalans.append(invertStereo(x))
-            else:
-                finalans.append(x)
-            for y in bcinfo:
-                if y[0] == CLOSE:
-                    finalans.append(y[2])
+    # If necessary, invert the stereo of tet centers based on ring info
+    inverted = 0
+    for atom_ans, bcinfo in bci.symbolinfo.items():
+        if shouldInvertStereo(bcinfo):
+            ans[atom_ans] = invertStereo(ans[atom_ans])
+            inverted += 1
+    if not metadata:
+        return "".join(ans)
+    deepsmiles = "".join(ans)
+    # Each item of 'ans' is an atom, ring symbol or parenthesis (or a run
+    # of close parentheses), possibly preceded by a bond symbol
+    atoms = tokens = 0
+    for x in ans:
+        if not x:
+            continue
+        kind = lexer.kinds.get(x[0])
+        if kind == lexer.BOND:
+            tokens += 1
+            kind = lexer.kinds.get(x[1])
+        if kind is None:
+            atoms += 1
+            tokens += 1
+        elif kind == lexer.CLOSE:
+            tokens += len(x)
         else:
-            finalans.append(x)
-    return "".join(finalans)
+            tokens += 1
+    return deepsmiles, EncodeMetadata(len(deepsmiles), atoms, tokens, tuple(ring_sizes),
+                                      max(max_level - 1, 0), inverted)
 
 if __name__ == "__main__":
     import doctest
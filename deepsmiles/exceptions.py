@@ -20,6 +20,17 @@
 
 import textwrap
 
+# The reasons that DeepSMILES cannot be decoded, given as DecodeError.code
+# and returned by decode.validate(). The last five are for input that is
+# over one of the limits in a decode.Limits.
+(OK, UNMATCHED_BRACKET, BAD_RING_SYMBOL, RING_AT_START,
+ TOO_MANY_CLOSE_PARENS, NO_RING_OPENING,
+ TOO_LONG, TOO_MANY_ATOMS, TOO_DEEP, RING_TOO_LARGE, TOO_MANY_RINGS) = range(11)
+# The names of the reason codes, indexed by code
+CODE_NAMES = ["OK", "UNMATCHED_BRACKET", "BAD_RING_SYMBOL", "RING_AT_START",
+              "TOO_MANY_CLOSE_PARENS", "NO_RING_OPENING",
+              "TOO_LONG", "TOO_MANY_ATOMS", "TOO_DEEP", "RING_TOO_LARGE", "TOO_MANY_RINGS"]
+
 class Error(Exception):
     """Base class for DeepSMILES exceptions."""
     pass
@@ -30,12 +41,14 @@ class DecodeError(Error):
     Attributes:
         expression -- input expression in which the error occurred
         message -- explanation of the error
+        code -- the reason for the error, one of the constants above
     """
 
-    def __init__(self, expression, idx, message):
+    def __init__(self, expression, idx, message, code=None):
         self.expression = expression
         self.idx = idx
         self.message = message
+        self.code = code
 
     def __str__(self):
         return """DeepSMILES cannot be decoded to SMILES
@@ -43,3 +56,23 @@ class DecodeError(Error):
   %s
   %s^
         """ % ("\n".join(textwrap.wrap(self.message, width=70)), self.expression, " "*self.idx)
+
+class EncodeError(Error):
+    """Exception raised for SMILES that cannot be encoded.
+
+    Attributes:
+        expression -- input expression in which the error occurred
+        message -- explanation of the error
+    """
+
+    def __init__(self, expression, idx, message):
+        self.expression = expression
+        self.idx = idx
+        self.message = message
+
+    def __str__(self):
+        return """SMILES cannot be encoded as DeepSMILES
+%s:
+  %s
+  %s^
+        """ % ("\n".join(textwrap.wrap(self.message, width=70)), self.expression, " "*self.idx)
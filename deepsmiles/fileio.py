@@ -0,0 +1,95 @@
+# Copyright 2018 NextMove Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Reading, writing and converting .smi files
+
+These are shared by the command-line tools and by the job runner in
+deepsmiles.jobs.
+"""
+import gzip
+import sys
+import time
+from collections import deque
+
+def open_file(filename, mode):
+    """Open a file for text I/O, transparently handling gzip and '-'"""
+    if filename == "-":
+        return sys.stdin if mode == "r" else sys.stdout
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode + "t")
+    return open(filename, mode, buffering=1<<20)
+
+def split_line(line):
+    """Split a line into the SMILES and the remainder (including the separator)"""
+    line = line.rstrip("\r\n")
+    for i, x in enumerate(line):
+        if x.isspace():
+            return line[:i], line[i:]
+    return line, ""
+
+def convert_file(inp, out, converter, decode=False, errout=None,
+                 processes=1, chunksize=1000, progress=0, log=sys.stderr):
+    """Convert each line of 'inp', writing the results to 'out'
+
+    Lines that cannot be converted are written unchanged to 'errout'
+    (if given). The conversion rate is reported to 'log' every 'progress'
+    lines and at the end (use 0 to report only at the end, or None to
+    never report). Returns a tuple of (number of lines, number of invalid
+    lines).
+    """
+    titles = deque()
+    def read_smiles():
+        for line in inp:
+            smi, title = split_line(line)
+            if not smi:
+                continue
+            titles.append((line, title))
+            yield smi
+
+    convert_many = converter.decode_many if decode else converter.encode_many
+    results = convert_many(read_smiles(), processes=processes, chunksize=chunksize, errors="none")
+
+    start = time.time()
+    N = invalid = 0
+    buf = []
+    for result in results:
+        line, title = titles.popleft()
+        N += 1
+        if result is None:
+            invalid += 1
+            if errout is not None:
+                errout.write(line if line.endswith("\n") else line + "\n")
+        else:
+            buf.append(result + title + "\n")
+        if len(buf) >= chunksize:
+            out.write("".join(buf))
+            buf = []
+        if progress and N % progress == 0:
+            report(N, invalid, time.time() - start, log)
+    out.write("".join(buf))
+    if progress is not None:
+        report(N, invalid, time.time() - start, log)
+    return N, invalid
+
+def report(N, invalid, duration, log):
+    rate = N / duration if duration > 0 else 0.0
+    log.write("Converted %d lines (%d invalid) in %.1f s (%.0f lines/s)\n" % (
+        N, invalid, duration, rate))
+    log.flush()
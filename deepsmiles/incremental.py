@@ -0,0 +1,191 @@
+# Copyright 2018 NextMove Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Decode DeepSMILES one token at a time
+
+This is intended for constrained generation, where after each token it
+is necessary to know whether the DeepSMILES so far can still be decoded,
+and which tokens may come next. The checks are the same as those made
+by decode.validate(), but each token is handled in constant time.
+"""
+import copy
+
+from . import decode
+from . import exceptions
+from . import lexer
+
+def classify(token):
+    """Return a tuple of the kind of a token and, for a ring symbol, its number
+
+    The kind is None for an atom, and lexer.ERROR if the text is not a
+    single complete token (such as '[' or '%').
+    """
+    if lexer.split(token) != [token]:
+        return lexer.ERROR, None
+    kind = lexer.kinds.get(token[0])
+    if token == '[' or token == '%':
+        return lexer.ERROR, None
+    if kind == lexer.RING:
+        return kind, lexer.ring_number(token)
+    return kind, None
+
+class IncrementalDecoder:
+    """The state of the decoder after each token of a DeepSMILES string
+
+    Create one with the Converter whose variant of DeepSMILES is to be
+    decoded, then feed() it the tokens one at a time. fork() gives an
+    independent copy in constant time, for example for each hypothesis
+    in a beam search.
+    """
+    __slots__ = ["rings", "branches", "reuse_digits", "pos", "depth", "last_depth", "branch_starts",
+                 "started", "code", "idx", "history", "_masks"]
+
+    def __init__(self, converter):
+        self.rings = converter.rings
+        self.branches = converter.branches
+        self.reuse_digits = converter.reuse_digits
+        self.pos = 0            # the length of the text so far
+        self.depth = 0          # the number of atoms on the path to the current atom
+        self.last_depth = 0     # the same, for the most recently added atom
+        self.branch_starts = None # DeepSMILES/Rings only: the depth at each open
+                                  # bracket, as a linked list of (depth, rest)
+        self.started = False    # DeepSMILES/Rings only: whether an atom or bracket has been seen
+        self.code = exceptions.OK
+        self.idx = None
+        self.history = None     # the tokens so far, as a linked list of (token, rest)
+        self._masks = {}        # id(vocab) -> (vocab, classified tokens), shared by forks
+
+    @property
+    def valid(self):
+        """Whether the tokens so far can be decoded"""
+        return self.code == exceptions.OK
+
+    def validate(self):
+        """Return the reason code and position, as for decode.validate()"""
+        return self.code, self.idx
+
+    def _check(self, kind, number, length):
+        """Return the reason code for adding a token, and its position"""
+        i = self.pos
+        if not self.rings and not self.branches:
+            return exceptions.OK, None
+        if kind == lexer.ERROR:
+            return exceptions.UNMATCHED_BRACKET if number == '[' else exceptions.BAD_RING_SYMBOL, i
+        if kind == lexer.CLOSE:
+            if (self.depth == 0) if self.branches else (self.branch_starts is None):
+                return exceptions.TOO_MANY_CLOSE_PARENS, i
+        elif kind == lexer.RING:
+            if i == 0 or not (self.branches or self.started):
+                return exceptions.RING_AT_START, i
+            if self.branches:
+                if not self.rings and self.last_depth > 0:
+                    return exceptions.OK, None
+                limit = self.last_depth
+            else:
+                limit = self.depth
+            if number < 1 or number > limit:
+                return exceptions.NO_RING_OPENING, i + length - 1
+        return exceptions.OK, None
+
+    def feed(self, token):
+        """Add the next token, returning whether the text so far can be decoded
+
+        The token should be a single token, as given by lexer.split().
+        Once a token makes the text invalid, it remains invalid.
+        """
+        kind, number = classify(token)
+        if kind == lexer.ERROR:
+            if token not in ('[', '%'):
+                raise ValueError("%r is not a single DeepSMILES token" % token)
+            number = token
+        if self.code == exceptions.OK:
+            self.code, self.idx = self._check(kind, number, len(token))
+            if self.code == exceptions.OK:
+                if kind is None or (self.branches and kind == lexer.OPEN):
+                    self.depth += 1
+                    self.last_depth = self.depth
+                    self.started = True
+                elif kind == lexer.CLOSE:
+                    if self.branches:
+                        self.depth -= 1
+                    else:
+                        self.depth, self.branch_starts = self.branch_starts
+                elif kind == lexer.OPEN:
+                    self.branch_starts = (self.depth, self.branch_starts)
+                    self.started = True
+        self.history = (token, self.history)
+        self.pos += len(token)
+        return self.code == exceptions.OK
+
+    def allowed(self, token):
+        """Return whether the text would still be decodable after adding a token"""
+        if self.code != exceptions.OK:
+            return False
+        kind, number = classify(token)
+        return self._check(kind, number, len(token))[0] == exceptions.OK
+
+    def mask(self, vocab):
+        """Return a list of whether each token of a vocabulary is allowed next
+
+        'vocab' is a Vocabulary or a list of token strings. The special
+        tokens of a Vocabulary (and anything else that is not a single
+        token) are never allowed.
+        """
+        tokens = getattr(vocab, "tokens", vocab)
+        cached = self._masks.get(id(tokens))
+        if cached is None or cached[0] is not tokens:
+            cached = (tokens, [classify(token) + (len(token),) for token in tokens])
+            self._masks[id(tokens)] = cached
+        if self.code != exceptions.OK:
+            return [False] * len(tokens)
+        OK = exceptions.OK
+        check = self._check
+        return [check(kind, number, length)[0] == OK for kind, number, length in cached[1]]
+
+    def fork(self):
+        """Return an independent copy of the decoder"""
+        return copy.copy(self)
+
+    def tokens(self):
+        """Return the list of tokens so far"""
+        ans = []
+        node = self.history
+        while node is not None:
+            ans.append(node[0])
+            node = node[1]
+        ans.reverse()
+        return ans
+
+    def text(self):
+        """Return the DeepSMILES so far"""
+        return "".join(self.tokens())
+
+    def finalize(self):
+        """Return the SMILES for the tokens so far
+
+        Raises a DecodeError if they cannot be decoded.
+        """
+        tokens = self.tokens()
+        deepsmiles = "".join(tokens)
+        if not self.rings and not self.branches:
+            return deepsmiles
+        if not self.branches:
+            return decode.decode_only_rings(deepsmiles, tokens, self.reuse_digits)
+        return decode.decode_branches(deepsmiles, self.rings, tokens, self.reuse_digits)
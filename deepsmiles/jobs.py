@@ -0,0 +1,210 @@
+# Copyright 2018 NextMove Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Resumable conversion of large files, split into shards
+
+The input file is split into byte ranges that start and end at line
+boundaries, and each range (a shard) is converted by a worker process
+into an output file of its own in a working directory. A manifest in
+the working directory records the shards and which of them are done, so
+that if the job is interrupted, running it again skips the completed
+shards. Finally, the shard outputs are joined in input order.
+"""
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+from .converter import Converter
+from .fileio import convert_file, report
+
+MANIFEST = "manifest.json"
+
+def shard_ranges(filename, shards):
+    """Split a file into at most 'shards' (start, end) byte ranges at line boundaries"""
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, "rb") as inp:
+        for i in range(1, shards):
+            target = size * i // shards
+            if target <= bounds[-1]:
+                continue
+            inp.seek(target - 1)
+            inp.readline() # move to the start of the next line
+            pos = inp.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+def read_range(filename, start, end):
+    """Yield the lines of a byte range of a file, as str"""
+    with open(filename, "rb") as inp:
+        inp.seek(start)
+        pos = start
+        while pos < end:
+            line = inp.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line.decode("latin-1")
+
+def convert_shard(args):
+    """Convert one shard, returning its index and the numbers of lines and invalid lines"""
+    (index, filename, start, end, outname, errname, options, decode) = args
+    converter = Converter(**options)
+    # Write to temporary files, so that a shard's output only exists once it is complete
+    with open(outname + ".tmp", "w", encoding="latin-1", newline="") as out:
+        errout = open(errname + ".tmp", "w", encoding="latin-1", newline="") if errname else None
+        try:
+            N, invalid = convert_file(read_range(filename, start, end), out, converter,
+                                      decode=decode, errout=errout, progress=None)
+        finally:
+            if errout is not None:
+                errout.close()
+    if errname:
+        os.replace(errname + ".tmp", errname)
+    os.replace(outname + ".tmp", outname)
+    return index, N, invalid
+
+class Job:
+    def __init__(self, input, output, converter, decode=False, errors=None,
+                 workdir=None, shards=None, processes=None):
+        """Initialise a Job that converts the file 'input' to 'output'
+
+        Each line is converted with 'converter' as for the command-line
+        tool (decoding if 'decode' is True), and lines that cannot be
+        converted are written to 'errors' (if given). The input must be
+        an uncompressed file; the output is gzipped if its name ends in
+        .gz.
+
+        The shards and the manifest are kept in 'workdir' (by default,
+        the name of the output with ".shards" added). By default, there
+        are 'shards' shards for each of the 'processes' worker processes
+        (one per CPU).
+        """
+        if input.endswith(".gz") or input == "-":
+            raise ValueError("A sharded job needs an uncompressed input file")
+        self.input = input
+        self.output = output
+        self.converter = converter
+        self.decode = decode
+        self.errors = errors
+        self.workdir = output + ".shards" if workdir is None else workdir
+        self.processes = (os.cpu_count() or 1) if processes is None else processes
+        self.shards = 4 * self.processes if shards is None else shards
+        self.manifest = None
+
+    def _settings(self):
+        stat = os.stat(self.input)
+        return {"input": os.path.abspath(self.input), "size": stat.st_size, "mtime": stat.st_mtime,
+                "rings": self.converter.rings, "branches": self.converter.branches,
+                "reuse_digits": self.converter.reuse_digits,
+                "limits": None if self.converter.limits is None else list(self.converter.limits),
+                "decode": self.decode, "errors": self.errors is not None}
+
+    def _save(self):
+        name = os.path.join(self.workdir, MANIFEST)
+        with open(name + ".tmp", "w") as out:
+            json.dump(self.manifest, out, indent=1, sort_keys=True)
+        os.replace(name + ".tmp", name)
+
+    def load(self):
+        """Read the manifest, or create it if this is a new job
+
+        Raises a ValueError if the working directory belongs to a job
+        with a different input file or settings.
+        """
+        settings = self._settings()
+        name = os.path.join(self.workdir, MANIFEST)
+        if os.path.exists(name):
+            with open(name) as inp:
+                manifest = json.load(inp)
+            if manifest["settings"] != settings:
+                raise ValueError("%s belongs to a different job; remove it to start again" % self.workdir)
+            self.manifest = manifest
+        else:
+            if not os.path.isdir(self.workdir):
+                os.makedirs(self.workdir)
+            self.manifest = {"settings": settings, "done": {},
+                             "ranges": shard_ranges(self.input, self.shards)}
+            self._save()
+        return self.manifest
+
+    def shard_name(self, index, kind="out"):
+        return os.path.join(self.workdir, "shard%05d.%s" % (index, kind))
+
+    def pending(self):
+        """Return the indices of the shards that are not yet done"""
+        done = self.manifest["done"]
+        return [i for i in range(len(self.manifest["ranges"])) if str(i) not in done]
+
+    def run(self, keep=False, log=sys.stderr):
+        """Convert the shards that are not yet done, then join them
+
+        Progress is reported to 'log' (None for no report). The working
+        directory is removed at the end unless 'keep' is True. Returns
+        a tuple of (number of lines, number of invalid lines).
+        """
+        self.load()
+        start = time.time()
+        tasks = []
+        for i in self.pending():
+            begin, end = self.manifest["ranges"][i]
+            tasks.append((i, self.input, begin, end, self.shard_name(i),
+                          self.shard_name(i, "err") if self.errors else None,
+                          self.converter.options(), self.decode))
+        total = len(self.manifest["ranges"])
+        if tasks:
+            pool = multiprocessing.Pool(min(self.processes, len(tasks)))
+            try:
+                for i, N, invalid in pool.imap_unordered(convert_shard, tasks):
+                    self.manifest["done"][str(i)] = {"lines": N, "invalid": invalid}
+                    self._save()
+                    if log is not None:
+                        log.write("Shard %d done (%d of %d)\n" % (i, len(self.manifest["done"]), total))
+                        log.flush()
+            finally:
+                pool.terminate()
+        self.join()
+        N = sum(x["lines"] for x in self.manifest["done"].values())
+        invalid = sum(x["invalid"] for x in self.manifest["done"].values())
+        if log is not None:
+            report(N, invalid, time.time() - start, log)
+        if not keep:
+            shutil.rmtree(self.workdir)
+        return N, invalid
+
+    def join(self):
+        """Concatenate the shard outputs, in input order"""
+        parts = [(self.output, "out")]
+        if self.errors:
+            parts.append((self.errors, "err"))
+        for filename, kind in parts:
+            opener = gzip.open if filename.endswith(".gz") else io.open
+            with opener(filename + ".tmp", "wb") as out:
+                for i in range(len(self.manifest["ranges"])):
+                    with open(self.shard_name(i, kind), "rb") as inp:
+                        shutil.copyfileobj(inp, out)
+            os.replace(filename + ".tmp", filename)
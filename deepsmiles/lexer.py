@@ -0,0 +1,137 @@
+# Copyright 2018 NextMove Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""A single-pass lexer shared by the SMILES and DeepSMILES codecs
+
+Every character of the input belongs to exactly one token. The kinds of
+token are:
+  ATOM  -- a bracket atom such as [C@@H], Cl, Br, or any other single
+           character that is not covered below
+  BOND  -- one of -=#$:/\\
+  RING  -- a ring symbol: a digit, %NN or %(NNN)
+  OPEN  -- an open parenthesis
+  CLOSE -- a close parenthesis
+  ERROR -- a '[' without a corresponding ']', or a '%' that is not
+           followed by two digits or by a number in parentheses
+"""
+import re
+import sys
+from collections import namedtuple
+
+ATOM, BOND, RING, OPEN, CLOSE, ERROR = "ATOM", "BOND", "RING", "OPEN", "CLOSE", "ERROR"
+
+token_re = re.compile(
+        r"\[[^\]]*\]|Cl|Br|[^-=#$:/\\()%0-9\[]" # atoms
+        r"|[-=#$:/\\]"                          # bonds
+        r"|[0-9]|%[0-9][0-9]|%\([0-9]+\)"       # ring symbols
+        r"|[()%\[]")                            # parentheses, and errors
+
+# The kind of a token is given by its first character, except that the
+# single-character tokens '[' and '%' are errors. Atoms are not in this
+# table; the codecs look up kinds directly in it and check for the errors
+# themselves.
+kinds = dict.fromkeys("-=#$:/\\", BOND)
+kinds.update(dict.fromkeys("0123456789%", RING))
+kinds["("] = OPEN
+kinds[")"] = CLOSE
+
+Token = namedtuple("Token", ["kind", "text", "pos"])
+
+def as_text(data):
+    """Return a str for SMILES or DeepSMILES given as str or bytes-like
+
+    bytes, bytearray and memoryview are decoded as Latin-1, so that each
+    byte becomes a character with the same value and positions in the
+    text are positions in the bytes.
+    """
+    if isinstance(data, str):
+        return data
+    return str(data, "latin-1")
+
+def as_bytes(text):
+    """Return the bytes for a str produced from as_text()"""
+    return text.encode("latin-1")
+
+def split(text):
+    """Split a SMILES or DeepSMILES string into a list of token strings
+
+    The string may also be given as bytes-like, but the tokens are str.
+
+    >>> split("cccccc6))Br/C=C%(12)")
+    ['c', 'c', 'c', 'c', 'c', 'c', '6', ')', ')', 'Br', '/', 'C', '=', 'C', '%(12)']
+    """
+    return token_re.findall(as_text(text))
+
+def tokenize(text):
+    """Yield the tokens of a SMILES or DeepSMILES string (str or bytes-like)
+
+    >>> for token in tokenize("C[C@@H](Cl)=O5%"):
+    ...     print(token)
+    Token(kind='ATOM', text='C', pos=0)
+    Token(kind='ATOM', text='[C@@H]', pos=1)
+    Token(kind='OPEN', text='(', pos=7)
+    Token(kind='ATOM', text='Cl', pos=8)
+    Token(kind='CLOSE', text=')', pos=10)
+    Token(kind='BOND', text='=', pos=11)
+    Token(kind='ATOM', text='O', pos=12)
+    Token(kind='RING', text='5', pos=13)
+    Token(kind='ERROR', text='%', pos=14)
+    """
+    pos = 0
+    for x in token_re.findall(as_text(text)):
+        if x == '[' or x == '%':
+            yield Token(ERROR, x, pos)
+        else:
+            yield Token(kinds.get(x[0], ATOM), x, pos)
+        pos += len(x)
+
+def ring_number(text):
+    """Return the number of a ring symbol
+
+    >>> ring_number("5"), ring_number("%12"), ring_number("%(123)")
+    (5, 12, 123)
+
+    A number too large to be a ring size (more than 18 digits) is given
+    as sys.maxsize, rather than converting arbitrarily long text.
+    """
+    if text[0] != '%':
+        return int(text)
+    if text[1] == '(':
+        digits = text[2:-1].lstrip("0")
+        if len(digits) > 18:
+            return sys.maxsize
+        return int(digits or "0")
+    return int(text[1:])
+
+def ring_symbol(number):
+    """Return the shortest ring symbol for a number
+
+    >>> ring_symbol(5), ring_symbol(12), ring_symbol(123)
+    ('5', '%12', '%(123)')
+    """
+    if number < 10:
+        return str(number)
+    if number < 100:
+        return "%%%d" % number
+    return "%%(%d)" % number
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,393 @@
+# Copyright 2018 NextMove Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""A local conversion server, with requests gathered into micro-batches
+
+Run as "python -m deepsmiles.serve". The server listens on a Unix socket
+or a localhost TCP port. The protocol is newline-delimited JSON: each
+request is a JSON object on a line of its own, such as
+
+  {"id": 1, "op": "encode", "data": "c1ccccc1"}
+
+where "op" is "encode", "decode" or "metrics". Each response is a JSON
+object on a line of its own with the same "id", and either a "result"
+or an "error":
+
+  {"id": 1, "result": "cccccc6"}
+
+Responses may come back in a different order from the requests. The
+strings to be converted are gathered from all of the connections into
+batches of at most 'max_batch' strings, each of which waits at most
+'max_wait' seconds for the batch to fill, and the batches are converted
+by a pool of worker processes.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import socket
+import sys
+import time
+
+from .converter import Converter
+from .decode import Limits
+from .stats import Histogram
+
+OPS = ("encode", "decode")
+
+# The number of bytes of requests that Client.request_many() sends before
+# reading their responses. The responses (at most about twice the size)
+# then fit within the 64 KiB that the server buffers before it stops
+# reading, whatever the size of the socket buffers.
+WINDOW_BYTES = 1 << 14
+
+def convert_batch(options, op, batch):
+    """Convert a list of strings, returning a list of (result, error message)
+
+    'options' are the keyword options for the Converter.
+    """
+    method = getattr(Converter(**options), op)
+    ans = []
+    for x in batch:
+        try:
+            ans.append((method(x), None))
+        except Exception as e:
+            ans.append((None, getattr(e, "message", None) or str(e)))
+    return ans
+
+class Batcher:
+    """Gathers the strings for one operation into batches"""
+    def __init__(self, server, op):
+        self.server = server
+        self.op = op
+        self.pending = [] # (string, future)
+        self.timer = None
+
+    def submit(self, text):
+        """Add a string to the current batch, returning a future for its result"""
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((text, future))
+        if len(self.pending) >= self.server.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.server.max_wait, self.flush)
+        return future
+
+    def flush(self):
+        """Send the current batch to be converted"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.ensure_future(self.run(batch))
+
+    async def run(self, batch):
+        server = self.server
+        server.in_flight += len(batch)
+        server.batches += 1
+        server.batch_size.add(len(batch))
+        args = (server.converter.options(), self.op, [x[0] for x in batch])
+        try:
+            if server.executor is None:
+                results = convert_batch(*args)
+            else:
+                results = await asyncio.get_event_loop().run_in_executor(server.executor, convert_batch, *args)
+        except Exception as e:
+            results = [(None, "Conversion failed: %s" % e)] * len(batch)
+        finally:
+            server.in_flight -= len(batch)
+        for (text, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+class Server:
+    def __init__(self, converter, max_batch=256, max_wait=0.002, processes=None):
+        """Initialise a Server object.
+
+        Strings are converted with the variant of 'converter', in batches
+        of at most 'max_batch' strings that wait at most 'max_wait' seconds
+        to fill. The batches are shared out across a pool of 'processes'
+        worker processes (by default, one per CPU); if 'processes' is 0
+        they are converted in the server process instead.
+        """
+        self.converter = converter
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.processes = (os.cpu_count() or 1) if processes is None else processes
+        self.executor = None
+        self.batchers = dict((op, Batcher(self, op)) for op in OPS)
+        self.server = None
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.in_flight = 0
+        self.batch_size = Histogram()
+        self.latency = Histogram() # nanoseconds from receiving a request to sending the response
+
+    async def start(self, path=None, host="127.0.0.1", port=0):
+        """Start listening on a Unix socket (if 'path' is given) or a TCP port
+
+        Returns the address, which for TCP includes the port (useful if
+        'port' is 0, to choose any free port).
+        """
+        if self.processes > 0 and self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.processes)
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()
+
+    async def close(self):
+        """Stop listening and shut down the worker processes"""
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for batcher in self.batchers.values():
+            batcher.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def metrics(self):
+        """Return a dict of the number of requests, queue depth and latency"""
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "batches": self.batches,
+            "queue_depth": sum(len(x.pending) for x in self.batchers.values()),
+            "in_flight": self.in_flight,
+            "batch_size": self.batch_size.to_dict(),
+            "latency_us": dict(("p%d" % p, None if not self.latency.count else
+                                self.latency.percentile(p) / 1000.0) for p in (50, 90, 99)),
+        }
+
+    async def respond(self, writer, start, request_id, future):
+        result, error = await future
+        if error is None:
+            response = {"id": request_id, "result": result}
+        else:
+            self.errors += 1
+            response = {"id": request_id, "error": error}
+        self.latency.add(int((time.perf_counter() - start) * 1e9))
+        writer.write((json.dumps(response) + "\n").encode("ascii"))
+
+    async def handle(self, reader, writer):
+        """Handle the requests from one connection"""
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                start = time.perf_counter()
+                self.requests += 1
+                request_id = None
+                try:
+                    request = json.loads(line)
+                    request_id = request.get("id")
+                    op = request["op"]
+                    if op == "metrics":
+                        writer.write((json.dumps({"id": request_id, "result": self.metrics()}) + "\n").encode("ascii"))
+                        continue
+                    if op not in self.batchers:
+                        raise ValueError("Unknown op %r" % op)
+                    data = request["data"]
+                    if not isinstance(data, str):
+                        raise ValueError("'data' should be a string")
+                except (ValueError, KeyError, AttributeError, TypeError) as e:
+                    self.errors += 1
+                    writer.write((json.dumps({"id": request_id, "error": "Bad request: %s" % e}) + "\n").encode("ascii"))
+                    continue
+                future = self.batchers[op].submit(data)
+                task = asyncio.ensure_future(self.respond(writer, start, request_id, future))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                await writer.drain()
+            if tasks:
+                await asyncio.wait(tasks)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+class Client:
+    """A blocking client for a conversion server"""
+    def __init__(self, path=None, host="127.0.0.1", port=None, timeout=None):
+        """Connect to a server on a Unix socket (if 'path' is given) or a TCP port"""
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection((host, port), timeout)
+            # Send the end of each window of requests at once, as the
+            # client then waits for the responses
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile("rwb")
+        self.next_id = 0
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request_many(self, op, data):
+        """Send a request for each string, and return the responses in input order
+
+        The requests are sent a window of WINDOW_BYTES at a time, so that
+        the server can gather them into batches, and the responses to
+        each window are read before the next is sent. (If all of the
+        requests were sent first, then once the socket buffers were full,
+        the client would wait for the server to read its requests while
+        the server waited for the client to read its responses.)
+        """
+        ans = []
+        ids = []
+        size = 0
+        for x in data:
+            self.next_id += 1
+            ids.append(self.next_id)
+            line = (json.dumps({"id": self.next_id, "op": op, "data": x}) + "\n").encode("ascii")
+            self.file.write(line)
+            size += len(line)
+            if size >= WINDOW_BYTES:
+                ans.extend(self._responses(ids))
+                ids = []
+                size = 0
+        if ids:
+            ans.extend(self._responses(ids))
+        return ans
+
+    def _responses(self, ids):
+        """Read the responses to the requests with the given ids, in that order"""
+        self.file.flush()
+        responses = {}
+        for i in range(len(ids)):
+            response = json.loads(self.file.readline())
+            responses[response["id"]] = response
+        return [responses[x] for x in ids]
+
+    def _convert_many(self, op, data, errors):
+        ans = []
+        for response in self.request_many(op, data):
+            if "error" in response:
+                if errors == "raise":
+                    raise ValueError(response["error"])
+                if errors == "none":
+                    ans.append(None)
+            else:
+                ans.append(response["result"])
+        return ans
+
+    def encode(self, smiles):
+        """Encode a SMILES string, raising a ValueError if the server reports an error"""
+        return self._convert_many("encode", [smiles], "raise")[0]
+
+    def decode(self, deepsmiles):
+        """Decode a DeepSMILES string, raising a ValueError if the server reports an error"""
+        return self._convert_many("decode", [deepsmiles], "raise")[0]
+
+    def encode_many(self, smiles, errors="raise"):
+        """Encode a list of SMILES strings
+
+        'errors' is the error policy, as for Converter.encode_many().
+        """
+        return self._convert_many("encode", smiles, errors)
+
+    def decode_many(self, deepsmiles, errors="raise"):
+        """Decode a list of DeepSMILES strings
+
+        'errors' is the error policy, as for Converter.encode_many().
+        """
+        return self._convert_many("decode", deepsmiles, errors)
+
+    def metrics(self):
+        """Return the metrics of the server"""
+        self.next_id += 1
+        self.file.write((json.dumps({"id": self.next_id, "op": "metrics"}) + "\n").encode("ascii"))
+        self.file.flush()
+        return json.loads(self.file.readline())["result"]
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m deepsmiles.serve",
+            description="Serve DeepSMILES conversion over a socket, using newline-delimited JSON")
+    parser.add_argument("-r", "--rings", action="store_true",
+            help="use the DeepSMILES ring syntax")
+    parser.add_argument("-b", "--branches", action="store_true",
+            help="use the DeepSMILES branch syntax")
+    parser.add_argument("--reuse-digits", action="store_true",
+            help="reuse ring-closure digits in decoded SMILES once they are free")
+    parser.add_argument("--max-length", type=int, metavar="N",
+            help="reject DeepSMILES longer than N characters")
+    parser.add_argument("--max-atoms", type=int, metavar="N",
+            help="reject DeepSMILES with more than N atoms")
+    parser.add_argument("--max-depth", type=int, metavar="N",
+            help="reject DeepSMILES with a path of more than N atoms from the first atom")
+    parser.add_argument("--max-ring-size", type=int, metavar="N",
+            help="reject DeepSMILES with a ring size larger than N")
+    parser.add_argument("--max-rings", type=int, metavar="N",
+            help="reject DeepSMILES with more than N ring closures")
+    parser.add_argument("--unix", metavar="PATH",
+            help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--host", default="127.0.0.1",
+            help="TCP address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8642,
+            help="TCP port to listen on (default: 8642)")
+    parser.add_argument("--max-batch", type=int, default=256,
+            help="maximum number of strings per batch (default: 256)")
+    parser.add_argument("--max-wait", type=float, default=2.0, metavar="MS",
+            help="maximum time in milliseconds to wait for a batch to fill (default: 2)")
+    parser.add_argument("-j", "--processes", type=int,
+            help="number of worker processes, or 0 for none (default: one per CPU)")
+    args = parser.parse_args(args)
+    if not args.rings and not args.branches:
+        parser.error("at least one of --rings and --branches is required")
+
+    limits = Limits(args.max_length, args.max_atoms, args.max_depth,
+                    args.max_ring_size, args.max_rings)
+    if not any(x is not None for x in limits):
+        limits = None
+    server = Server(Converter(rings=args.rings, branches=args.branches,
+                              reuse_digits=args.reuse_digits, limits=limits),
+                    args.max_batch, args.max_wait / 1000.0, args.processes)
+    loop = asyncio.new_event_loop()
+    try:
+        address = loop.run_until_complete(server.start(args.unix, args.host, args.port))
+        sys.stderr.write("Listening on %s\n" % (address,))
+        sys.stderr.flush()
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.close())
+        loop.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
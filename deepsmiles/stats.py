@@ -0,0 +1,194 @@
+# Copyright 2018 NextMove Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Instrumentation of a Converter: call counts, timings and input shapes
+
+The statistics are only collected if a Converter is created with
+instrument=True. They can be exported with to_dict() or to_json(), and
+the statistics from different processes can be combined with merge().
+"""
+import json
+import time
+
+class Histogram:
+    """A histogram of non-negative integers with logarithmic buckets
+
+    Values below 8 have a bucket each, while larger values share
+    buckets that are a quarter of an octave wide, so that percentiles
+    are accurate to within 25% whatever the scale.
+    """
+    def __init__(self):
+        self.buckets = {} # lower bound -> count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+    def add(self, value):
+        """Add a value to the histogram"""
+        if value >= 8:
+            shift = value.bit_length() - 3
+            bucket = (value >> shift) << shift
+        else:
+            bucket = value
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+    def merge(self, other):
+        """Add the contents of another Histogram to this one"""
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+    def percentile(self, p):
+        """Return the lower bound of the bucket holding the p-th percentile
+
+        Returns None if the histogram is empty.
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(round(p / 100.0 * self.count)))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return bucket
+        return self.max
+    def to_dict(self):
+        return {"count": self.count, "sum": self.total, "min": self.min, "max": self.max,
+                "buckets": sorted(self.buckets.items())}
+    @classmethod
+    def from_dict(cls, data):
+        ans = cls()
+        ans.buckets = dict((bucket, count) for bucket, count in data["buckets"])
+        ans.count = data["count"]
+        ans.total = data["sum"]
+        ans.min = data["min"]
+        ans.max = data["max"]
+        return ans
+
+class CallStats:
+    """The statistics for one direction of conversion (encode or decode)
+
+    'calls' and 'errors' count the calls and the exceptions raised,
+    'seconds' is the cumulative time taken, and 'latency' is a Histogram
+    of the time per call in nanoseconds. The shape of the inputs is
+    recorded as Histograms of the input 'length', the 'ring_size' of each
+    ring closure (DeepSMILES/RS only) and the maximum 'branch_depth' of
+    the SMILES. The shapes are those found by the encoder and decoder as
+    they convert each string, so nothing is scanned twice.
+    """
+    fields = ["latency", "length", "ring_size", "branch_depth"]
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        for field in self.fields:
+            setattr(self, field, Histogram())
+    def error_rate(self):
+        """Return the fraction of calls that raised an exception"""
+        return self.errors / self.calls if self.calls else 0.0
+    def measure(self, func, text, rings, *args):
+        """Return the result of func(text, *args), recording the time taken and the shape of the input
+
+        func should return a tuple of the result and its EncodeMetadata or
+        DecodeMetadata, which gives the branch depth and (if 'rings' is
+        True) the ring sizes.
+        """
+        start = time.perf_counter()
+        try:
+            ans, metadata = func(text, *args)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.calls += 1
+            self.seconds += elapsed
+            self.latency.add(int(elapsed * 1e9))
+            self.length.add(len(text))
+        if rings:
+            for size in metadata.ring_sizes:
+                self.ring_size.add(size)
+        self.branch_depth.add(metadata.branch_depth)
+        return ans
+    def merge(self, other):
+        """Add the statistics from another CallStats to these ones"""
+        self.calls += other.calls
+        self.errors += other.errors
+        self.seconds += other.seconds
+        for field in self.fields:
+            getattr(self, field).merge(getattr(other, field))
+    def to_dict(self):
+        ans = {"calls": self.calls, "errors": self.errors,
+               "error_rate": self.error_rate(), "seconds": self.seconds}
+        ans["latency_us"] = dict(("p%d" % p, None if self.latency.count == 0 else
+                                  self.latency.percentile(p) / 1000.0) for p in (50, 90, 99))
+        for field in self.fields:
+            ans[field] = getattr(self, field).to_dict()
+        return ans
+    @classmethod
+    def from_dict(cls, data):
+        ans = cls()
+        ans.calls = data["calls"]
+        ans.errors = data["errors"]
+        ans.seconds = data["seconds"]
+        for field in cls.fields:
+            setattr(ans, field, Histogram.from_dict(data[field]))
+        return ans
+
+class Stats:
+    """The statistics collected by an instrumented Converter
+
+    The 'encode' and 'decode' attributes hold a CallStats each.
+    """
+    def __init__(self):
+        self.encode = CallStats()
+        self.decode = CallStats()
+    def merge(self, other):
+        """Add the statistics from another Stats object (or its dict) to these ones"""
+        if isinstance(other, dict):
+            other = Stats.from_dict(other)
+        self.encode.merge(other.encode)
+        self.decode.merge(other.decode)
+    def reset(self):
+        """Discard all of the statistics collected so far"""
+        self.__init__()
+    def to_dict(self):
+        """Return the statistics as a dict of plain Python types"""
+        return {"encode": self.encode.to_dict(), "decode": self.decode.to_dict()}
+    def to_json(self, **kwargs):
+        """Return the statistics as a JSON string"""
+        return json.dumps(self.to_dict(), **kwargs)
+    @classmethod
+    def from_dict(cls, data):
+        """Create a Stats object from the output of to_dict() (or its JSON)"""
+        ans = cls()
+        ans.encode = CallStats.from_dict(data["encode"])
+        ans.decode = CallStats.from_dict(data["decode"])
+        return ans
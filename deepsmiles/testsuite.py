@@ -18,8 +18,34 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import asyncio
+import bisect
+import gzip
+import io
+import itertools
+import json
+import random
+import re
+import os
+import pickle
+import shutil
+import socket
+import tempfile
+import threading
+import timeit
 import unittest
 import deepsmiles as ds
+from deepsmiles.__main__ import main
+from deepsmiles.batching import BatchIterator
+from deepsmiles import arrays, augment, bench, exceptions, jobs, serve
+from deepsmiles.cache import LRUCache
+from deepsmiles.corpus import CorpusReader, CorpusWriter
+from deepsmiles.fileio import convert_file, split_line
+from deepsmiles.incremental import IncrementalDecoder
+from deepsmiles.lexer import split
+from deepsmiles.stats import Histogram, Stats
+from deepsmiles.transcode import transcode, transcode_many
+from deepsmiles.vocab import TokenStats, Vocabulary, build_stats
 
 class ConverterTest(unittest.TestCase):
     def testStringRep(self):
@@ -31,6 +57,12 @@ class ConverterTest(unittest.TestCase):
                 "Converter(rings=False, branches=True)")
         self.assertEqual(str(ds.Converter(rings=True, branches=True)),
                 "Converter(rings=True, branches=True)")
+        self.assertEqual(str(ds.Converter(rings=True, reuse_digits=True)),
+                "Converter(rings=True, branches=False, reuse_digits=True)")
+        self.assertEqual(str(ds.Converter(branches=True, limits=ds.Limits(length=100, depth=20))),
+                "Converter(rings=False, branches=True, limits=Limits(length=100, depth=20))")
+        self.assertEqual(str(ds.Converter(limits=ds.Limits())),
+                "Converter(rings=False, branches=False, limits=Limits())")
 
 class Encoding(unittest.TestCase):
     def testRingEncoding(self):
@@ -88,6 +120,40 @@ class Encoding(unittest.TestCase):
             else:
                 self.assertEqual(d[2], encodedB)
 
+    def testMetadata(self):
+        allconverter = ds.Converter(rings=True, branches=True)
+        data = [ # smi, DeepSMILES/RC+PN, (length, atoms, tokens, ring sizes, branch depth, inverted)
+                ("C1CC(OC)CC1", "CCCOC))CC5", (10, 7, 10, (5,), 1, 0)),
+                ("CC1CCCO[C@]21CCCCO2", "CCCCCO[C@@]6CCCCO6", (18, 12, 14, (6, 6), 0, 1)),
+                ("C(OC(=O)Cl)I", "COC=O)Cl)))I", (12, 6, 11, (), 2, 0)),
+                ("C=%(123)CC%(123)", "CCC=3", (5, 3, 5, (3,), 0, 0)),
+                ]
+        for smi, deepsmiles, metadata in data:
+            encoded, got = allconverter.encode_with_metadata(smi)
+            self.assertEqual(deepsmiles, encoded)
+            self.assertEqual(metadata, tuple(got))
+            self.assertEqual(len(split(encoded)), got.tokens)
+
+        # Without ring closure or branch encoding, the SMILES is unchanged
+        # but the ring sizes are still found
+        smi, metadata = ds.Converter().encode_with_metadata("C1CC(OC)CC1")
+        self.assertEqual("C1CC(OC)CC1", smi)
+        self.assertEqual((11, 7, 11, (5,), 1, 0), tuple(metadata))
+        # ...even if it could not be encoded, as with encode()
+        for smi, metadata in [("CC)C", (4, 3, 4, (), 0, 0)), ("C(C", (3, 2, 3, (), 1, 0)),
+                              ("C1CC%", (5, 3, 5, (), 0, 0))]:
+            self.assertEqual(ds.encode.encode(smi), smi)
+            self.assertEqual((smi, metadata), ds.encode.encode_with_metadata(smi))
+        self.assertEqual((b"CCCOC))CC5", allconverter.encode_with_metadata("C1CC(OC)CC1")[1]),
+                         allconverter.encode_with_metadata(b"C1CC(OC)CC1"))
+
+        results = list(allconverter.encode_with_metadata_many(["C(O)C", "CC)C", "C1CC1"], errors="none"))
+        self.assertEqual([("CO)C", (4, 3, 4, (), 1, 0)), None, ("CCC3", (4, 3, 4, (3,), 0, 0))],
+                         [r if r is None else (r[0], tuple(r[1])) for r in results])
+        results = list(allconverter.encode_with_metadata_many(["C(O)C", "C1CC1"], processes=2, chunksize=1))
+        self.assertEqual(["CO)C", "CCC3"], [r[0] for r in results])
+        self.assertEqual((3,), results[1][1].ring_sizes)
+
 class Decoding(unittest.TestCase):
 
     def testBranchDecoding(self):
@@ -132,19 +198,43 @@ class Decoding(unittest.TestCase):
                 decodedB = allconverter.decode(minput)
                 self.assertEqual(d[0], decodedB)
 
+    def testLongChains(self):
+        # Deeper than the recursion limit
+        converter = ds.Converter(rings=True, branches=True)
+        for smi in ["C(O)" * 3000 + "C", "C" * 5000 + "1CC1", "C(" * 2000 + "C" + ")C" * 2000]:
+            self.assertEqual(smi, converter.decode(converter.encode(smi)))
+
     def testDecodingExceptions(self):
         converter = ds.Converter(rings=True, branches=True)
         data = ["C8", "C))I", "%10C", "9C", "CCCCCC%(3CC", "C%(100)",
-                "C[C@@CCl", "C%CC", "-5cc[nH]9"]
+                "C[C@@CCl", "C%CC", "-5cc[nH]9", "CC%", "CC%(a)"]
         for dsmi in data:
             self.assertRaises(ds.DecodeError, converter.decode, dsmi)
         # Test just the ring decoder
         converter = ds.Converter(rings=True)
         data = ["C8", "%10C", "9C", "C%(100)",
-                "C[C@@CCl", "C%CC", "-5cc[nH]9"]
+                "C[C@@CCl", "C%CC", "-5cc[nH]9", "CC%", "CC%(a)"]
         for dsmi in data:
             self.assertRaises(ds.DecodeError, converter.decode, dsmi)
 
+    def testDecodingErrorPositions(self):
+        converter = ds.Converter(rings=True, branches=True)
+        data = [ # deepsmiles, idx, start of message
+                ("C))I", 2, "Too many close parentheses"),
+                ("9C", 0, "digit not allowed"),
+                ("%10C", 0, "'%' not allowed"),
+                ("CCCCCC%(3CC", 6, "'%(' is missing"),
+                ("CCC%(10)C", 7, "There is no corresponding atom"),
+                ("CC-%12", 5, "There is no corresponding atom"),
+                ("C[C@@CCl", 1, "There is a '['"),
+                ("C%CC", 1, "'%' should be followed"),
+                ]
+        for dsmi, idx, message in data:
+            with self.assertRaises(ds.DecodeError) as cm:
+                converter.decode(dsmi)
+            self.assertEqual(idx, cm.exception.idx)
+            self.assertTrue(cm.exception.message.startswith(message))
+
     def testDecodingBasic(self):
         converter = ds.Converter()
         dsmi = converter.decode("C")
@@ -158,5 +248,971 @@ class Decoding(unittest.TestCase):
             decoded = converter.decode(encoded)
             self.assertTrue("%(100)" in decoded)
 
+    def testReuseDigits(self):
+        data = [ # DeepSMILES/RS+PN, SMILES with ring-closure digits reused
+                ("CC2CC2CC2CC2CC2CC2CC2CC2CC2CC2", "C1C1" * 10),
+                ("CC=C/CCCCCC/89", "C1C2=C/CCCCCC/21"),
+                ("C[C@@H]CCCO[C@]6CCCCO6", "C[C@@H]1CCCO[C@]12CCCCO2"),
+                ("CCCC4CC3", "C1CCC12CC2"), # digit 1 is not reused at the same atom
+                ("cccccc6-" * 11 + "C=O)Cl", "c1ccccc1-" * 11 + "C(=O)Cl"),
+                ]
+        rsconverter = ds.Converter(rings=True)
+        for branches in [False, True]:
+            converter = ds.Converter(rings=True, branches=branches, reuse_digits=True)
+            plain = ds.Converter(rings=True, branches=branches)
+            for dsmi, smi in data:
+                if not branches:
+                    dsmi = dsmi.replace("C=O)Cl", "C(=O)Cl")
+                self.assertEqual(smi, converter.decode(dsmi))
+                # The same molecule, with the same stereo, as without reuse
+                self.assertEqual(rsconverter.encode(plain.decode(dsmi)), rsconverter.encode(smi))
+        self.assertTrue("%11" in plain.decode(data[-1][0]))
+        converter = ds.Converter(rings=True, branches=True, reuse_digits=True)
+        self.assertEqual([converter.decode(data[0][0])] * 2,
+                         list(converter.decode_many([data[0][0]] * 2, processes=2)))
+
+    def testMetadata(self):
+        data = [ # DeepSMILES, options, SMILES, (ring sizes, branch depth)
+                ("COC=O)Cl)))I", {"branches": True}, "C(OC(=O)Cl)I", ((), 2)),
+                ("CCCOC))CC5", {"rings": True, "branches": True}, "C1CC(OC)CC1", ((5,), 1)),
+                ("CCC(OC)CC5", {"rings": True}, "C1CC(OC)CC1", ((5,), 1)),
+                ("CC(C(C)O)C", {}, "CC(C(C)O)C", ((), 2)),
+                ]
+        for dsmi, options, smi, metadata in data:
+            self.assertEqual((smi, metadata), ds.decode.decode_with_metadata(dsmi, **options))
+        self.assertEqual((b"C1CC(OC)CC1", ((5,), 1)), ds.decode.decode_with_metadata(b"CCC(OC)CC5", rings=True))
+        self.assertRaises(ds.DecodeError, ds.decode.decode_with_metadata, "C))I", branches=True)
+
+class Validation(unittest.TestCase):
+    modes = [(True, False), (False, True), (True, True)]
+
+    def expected(self, converter, dsmi):
+        try:
+            converter.decode(dsmi)
+        except ds.DecodeError as e:
+            return e.code, e.idx
+        return exceptions.OK, None
+
+    def testReasons(self):
+        data = [
+            ("CC[NH", exceptions.UNMATCHED_BRACKET, 2),
+            ("CC%1", exceptions.BAD_RING_SYMBOL, 2),
+            ("CC%(5", exceptions.BAD_RING_SYMBOL, 2),
+            ("5CC", exceptions.RING_AT_START, 0),
+            ("C))C", exceptions.TOO_MANY_CLOSE_PARENS, 2),
+            ("CC4", exceptions.NO_RING_OPENING, 2),
+            ("CCCC0", exceptions.NO_RING_OPENING, 4),
+            ("CCCC4", exceptions.OK, None),
+        ]
+        converter = ds.Converter(rings=True, branches=True)
+        for dsmi, code, idx in data:
+            self.assertEqual((code, idx), converter.validate(dsmi))
+            self.assertEqual(code == exceptions.OK, converter.is_valid(dsmi))
+            self.assertEqual((code, idx), self.expected(converter, dsmi))
+
+    def testSameAsDecoding(self):
+        rng = random.Random(42)
+        symbols = ["C", "C", "c", "(", ")", ")", "1", "3", "5", "%", "%10", "%(3)", "%(12",
+                   "[", "[NH]", "=", "/"]
+        data = ["".join(rng.choice(symbols) for i in range(rng.randint(0, 10))) for j in range(2000)]
+        for rings, branches in self.modes:
+            converter = ds.Converter(rings=rings, branches=branches)
+            for dsmi in data:
+                self.assertEqual(self.expected(converter, dsmi), converter.validate(dsmi), dsmi)
+
+    def testValidateMany(self):
+        converter = ds.Converter(rings=True, branches=True)
+        data = ["CCCC4", "C))I", "CO)C", "9C"] * 3
+        for processes in [1, 2]:
+            self.assertEqual([True, False, True, False] * 3,
+                             list(converter.validate_many(data, processes=processes, chunksize=5)))
+        self.assertEqual([(exceptions.OK, None), (exceptions.RING_AT_START, 0)],
+                         list(converter.validate_many(["CCCC4", "9C"], details=True)))
+        self.assertEqual([(exceptions.TOO_MANY_CLOSE_PARENS, 2)],
+                         list(converter.validate_many(["C))I"], processes=2, details=True)))
+
+    def testTryDecode(self):
+        converter = ds.Converter(rings=True, branches=True)
+        self.assertEqual(("C(C)O", exceptions.OK, None), converter.try_decode("CC)O"))
+        result = converter.try_decode("C))I")
+        self.assertEqual((None, exceptions.TOO_MANY_CLOSE_PARENS, 2), result)
+        self.assertEqual("TOO_MANY_CLOSE_PARENS", exceptions.CODE_NAMES[result.code])
+        self.assertEqual(result, ds.decode.try_decode("C))I", rings=True, branches=True))
+        data = ["CCCC4", "C))I", "CO)C", "9C", "CC[NH"] * 3
+        expected = [converter.try_decode(dsmi) for dsmi in data]
+        self.assertEqual(["C1CCC1", None, "C(O)C", None, None] * 3, [x.smiles for x in expected])
+        for processes in [1, 2]:
+            self.assertEqual(expected, list(converter.try_decode_many(data, processes=processes, chunksize=4)))
+
+    def testLimits(self):
+        data = [ # limits, deepsmiles, code, idx
+                (ds.Limits(length=5), "CCCCCC6", exceptions.TOO_LONG, 5),
+                (ds.Limits(atoms=3), "CCC)CC", exceptions.TOO_MANY_ATOMS, 4),
+                (ds.Limits(depth=2), "CCC)CC", exceptions.TOO_DEEP, 2),
+                (ds.Limits(depth=2), "CC)C)C", exceptions.OK, None),
+                (ds.Limits(ring_size=5), "CCCCCC6", exceptions.RING_TOO_LARGE, 6),
+                (ds.Limits(ring_size=5), "CCCC%(99999999)", exceptions.RING_TOO_LARGE, 4),
+                (ds.Limits(rings=1), "CCC3C3", exceptions.TOO_MANY_RINGS, 5),
+                (ds.Limits(atoms=2), "C))CCC", exceptions.TOO_MANY_CLOSE_PARENS, 2), # the first error wins
+                ]
+        for limits, dsmi, code, idx in data:
+            converter = ds.Converter(rings=True, branches=True, limits=limits)
+            self.assertEqual((code, idx), converter.validate(dsmi))
+            self.assertEqual((code, idx), self.expected(converter, dsmi))
+            self.assertEqual(code, converter.try_decode(dsmi).code)
+        # Limits on the number of atoms and ring size also apply to DeepSMILES/Rings
+        converter = ds.Converter(rings=True, limits=ds.Limits(atoms=3, ring_size=3))
+        self.assertEqual((exceptions.RING_TOO_LARGE, 3), converter.validate("CCC4"))
+        self.assertEqual((exceptions.TOO_MANY_ATOMS, 7), converter.validate("C(C)(C)C"))
+        self.assertEqual(["C1CC1", None], list(converter.decode_many(["CCC3", "CCCC4"], processes=2, errors="none")))
+        # Huge input is rejected without being read to the end
+        converter = ds.Converter(rings=True, branches=True, limits=ds.Limits(atoms=100))
+        self.assertEqual((exceptions.TOO_MANY_ATOMS, 100), converter.validate("C" * 10000000))
+        # Other errors are the same as without limits
+        plain = ds.Converter(rings=True, branches=True)
+        for dsmi in ["C)))C", "CC[C", "CC%(1", "CC9", "9C", "CCC5"]:
+            with self.assertRaises(ds.DecodeError) as limited:
+                converter.decode(dsmi)
+            with self.assertRaises(ds.DecodeError) as unlimited:
+                plain.decode(dsmi)
+            self.assertEqual(str(unlimited.exception), str(limited.exception))
+            self.assertEqual((unlimited.exception.code, unlimited.exception.idx),
+                             (limited.exception.code, limited.exception.idx))
+
+    def testHugeRingNumber(self):
+        converter = ds.Converter(rings=True, branches=True)
+        self.assertEqual((exceptions.NO_RING_OPENING, 5004), converter.validate("CC%(" + "9" * 5000 + ")"))
+        self.assertEqual("C1C1", converter.decode("CC%(" + "0" * 5000 + "2)"))
+
+class IncrementalDecoding(unittest.TestCase):
+    modes = [(True, False), (False, True), (True, True)]
+
+    def testSameAsValidation(self):
+        rng = random.Random(7)
+        symbols = ["C", "c", "(", ")", ")", "1", "3", "5", "%10", "%(3)", "[NH]", "=", "0"]
+        for rings, branches in self.modes:
+            converter = ds.Converter(rings=rings, branches=branches)
+            for j in range(300):
+                tokens = [rng.choice(symbols) for i in range(rng.randint(0, 10))]
+                decoder = IncrementalDecoder(converter)
+                for i, token in enumerate(tokens):
+                    mask = decoder.mask(symbols)
+                    self.assertEqual(mask[symbols.index(token)], decoder.fork().feed(token))
+                    decoder.feed(token)
+                    text = "".join(tokens[:i+1])
+                    self.assertEqual(converter.validate(text), decoder.validate(), text)
+                if decoder.valid:
+                    self.assertEqual(converter.decode(decoder.text()), decoder.finalize())
+                else:
+                    self.assertRaises(ds.DecodeError, decoder.finalize)
+
+    def testMask(self):
+        vocab = Vocabulary(["C", "(", ")", "3", "%", "[", "Cl"])
+        decoder = IncrementalDecoder(ds.Converter(rings=True, branches=True))
+        #                 <pad>  <unk>  C     (     )      3      %      [      Cl
+        self.assertEqual([False, False, True, True, False, False, False, False, True], decoder.mask(vocab))
+        for token in "CCC":
+            decoder.feed(token)
+        self.assertEqual([False, False, True, True, True, True, False, False, True], decoder.mask(vocab))
+        self.assertTrue(decoder.feed(")"))
+        self.assertTrue(decoder.allowed("3"))
+        self.assertFalse(decoder.allowed("4"))
+        self.assertFalse(decoder.feed("%"))
+        self.assertEqual((exceptions.BAD_RING_SYMBOL, 4), decoder.validate())
+        self.assertEqual([False] * len(vocab), decoder.mask(vocab))
+
+    def testFork(self):
+        decoder = IncrementalDecoder(ds.Converter(rings=True, branches=True))
+        for token in ["C", "C", "C", "C"]:
+            decoder.feed(token)
+        ring = decoder.fork()
+        branch = decoder.fork()
+        ring.feed("4")
+        branch.feed(")")
+        branch.feed("O")
+        self.assertEqual("C1CCC1", ring.finalize())
+        self.assertEqual("CCC(C)O", branch.finalize())
+        self.assertEqual("CCCC", decoder.finalize())
+
+    def testTokens(self):
+        # Tokens are not re-split, so "C" followed by "l" is not chlorine
+        decoder = IncrementalDecoder(ds.Converter(branches=True))
+        for token in ["C", "l", "Cl"]:
+            decoder.feed(token)
+        self.assertEqual("ClCl", decoder.finalize())
+        self.assertEqual(["C", "l", "Cl"], decoder.tokens())
+        self.assertRaises(ValueError, decoder.feed, "CC")
+
+class Transcoding(unittest.TestCase):
+    variants = [ds.Converter(), ds.Converter(rings=True), ds.Converter(branches=True),
+                ds.Converter(rings=True, branches=True)]
+
+    def result(self, func, dsmi):
+        try:
+            return func(dsmi)
+        except (ds.DecodeError, ds.EncodeError) as e:
+            return type(e), e.idx, e.message
+
+    def testSameAsRoundTrip(self):
+        smiles = ["C1CC(OC)CC1", "NC[C@]12CCCC1C3CC2CC3", "C/C=C/1.C\\1", "[C@@H]12CCC[C@H]1CC2O",
+                  "F/C=C/1CC1", "c1ccccc1-c1ccccc1", "CC(C)(C)C(=O)O", "C11"]
+        smiles += bench.make_corpus("stereo_rings", 20) + bench.make_corpus("druglike", 20)
+        data = list(smiles)
+        for smi in smiles:
+            data.extend(converter.encode(smi) for converter in self.variants[1:])
+        data += ["CC(C)C", "C%(03)CCC%(3)", "CCC)4", "C))C", "CC[", "5C", "CC%1"]
+        for dsmi in data:
+            for source in self.variants:
+                for target in self.variants:
+                    expected = self.result(lambda x: target.encode(source.decode(x)), dsmi)
+                    result = self.result(lambda x: transcode(x, source, target), dsmi)
+                    self.assertEqual(expected, result, "%s %s %s" % (dsmi, source, target))
+
+    def testExamples(self):
+        rings, branches, both = self.variants[1:]
+        self.assertEqual("CCCOC))CC5", transcode("CCC(OC)CC5", rings, both))
+        self.assertEqual("CCC(OC)CC5", transcode("CCCOC))CC5", both, rings))
+        self.assertEqual("C1CCOC))CC1", transcode("CCCOC))CC5", both, branches))
+        self.assertEqual("CCC(OC)CC5", transcode("C1CCOC))CC1", branches, rings))
+        self.assertEqual("C" * 10 + "%10", transcode("C" * 10 + "%(10)", rings, both)) # ring symbols are normalised
+
+    def testTranscodeMany(self):
+        rings, branches, both = self.variants[1:]
+        data = ["CCC(OC)CC5", "CC9", "CC(O)C"] * 3
+        for processes in [1, 2]:
+            self.assertEqual(["CCCOC))CC5", None, "CCO)C"] * 3,
+                             list(transcode_many(data, rings, both, processes=processes,
+                                                 chunksize=2, errors="none")))
+
+class Augmentation(unittest.TestCase):
+    variants = [ds.Converter(rings=True), ds.Converter(branches=True),
+                ds.Converter(rings=True, branches=True)]
+    smiles = ["C1CC(OC)CC1.[Na+]", "F/C=C/C1CC1", "C/C=C\\1CC1", "[C@@H]12CCC[C@H]1CC2O",
+              "N[C@](C)(F)C(=O)O", "[C@H]1(Cl)CC[C@@H](Br)CC1", "C%10CC%10"]
+
+    def invariants(self, smiles):
+        # The bonds (written from the lower to the higher atom label) and
+        # the chirality of each atom (relative to its neighbours sorted by
+        # label), where the label is the isotope of the atom
+        graph = augment.Graph(smiles)
+        labels = [int(re.match(r"\[([0-9]+)", atom).group(1)) for atom in graph.atoms]
+        bonds = set()
+        for a, b, bondchar in graph.bonds:
+            if labels[a] > labels[b]:
+                a, b, bondchar = b, a, augment.flip(bondchar)
+            bonds.add((labels[a], labels[b], bondchar))
+        chirality = {}
+        for atom, order in graph.stereo.items():
+            nbrs = [labels[x] if x != augment.IMPLICIT_H else -1 for x in order]
+            chirality[labels[atom]] = (graph.atoms[atom].count("@") == 2) != augment.is_odd_permutation(sorted(nbrs), nbrs)
+        return bonds, chirality
+
+    def testSameMolecule(self):
+        # Every atom is labelled with a distinct isotope
+        smiles = ["[1C@@H]12[2CH2][3CH2]/[4CH]=[5CH]/[6C@H]1[7CH2][8C@]2([9CH3])[10OH]",
+                  "[1CH3][2C@H]([3Cl])[4C@@H]5[5CH2][6CH2][7CH2][8C@@]5([9F])[10Br].[11Na+]"]
+        for smi in smiles:
+            graph = augment.Graph(smi)
+            expected = self.invariants(smi)
+            for seed in range(20):
+                randomised = graph.write(ds.Converter(), random.Random(seed))
+                self.assertEqual(expected, self.invariants(randomised), randomised)
+
+    def testConsistentWithEncoder(self):
+        for smi in self.smiles + bench.make_corpus("stereo_rings", 10):
+            graph = augment.Graph(smi)
+            for seed in range(10):
+                randomised = graph.write(ds.Converter(), random.Random(seed))
+                for converter in self.variants:
+                    self.assertEqual(converter.encode(randomised), graph.write(converter, random.Random(seed)))
+
+    def testAugment(self):
+        converter = ds.Converter(rings=True, branches=True)
+        variants = augment.augment("c1ccccc1C(=O)NCC", converter, 5, seed=1)
+        self.assertEqual(5, len(set(variants)))
+        self.assertEqual(variants, augment.augment("c1ccccc1C(=O)NCC", converter, 5, seed=1))
+        decoded = set(converter.decode(x) for x in variants)
+        self.assertEqual(5, len(decoded))
+        self.assertEqual(["CC"], augment.augment("CC", converter, 3))
+        self.assertEqual(2, len(augment.augment("CO", converter, 3)))
+        self.assertRaises(ds.EncodeError, augment.Graph, "C1CC")
+        self.assertRaises(ds.EncodeError, augment.Graph, "CC)C")
+
+class Serving(unittest.TestCase):
+
+    def start(self, **kwargs):
+        server = serve.Server(ds.Converter(rings=True, branches=True), **kwargs)
+        loop = asyncio.new_event_loop()
+        address = loop.run_until_complete(server.start(port=0))
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        def stop():
+            asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        self.addCleanup(stop)
+        return server, address[1]
+
+    def testBatching(self):
+        server, port = self.start(max_batch=4, max_wait=10, processes=0)
+        data = ["c1ccccc1", "CC(=O)Cl", "C1CC1", "CO"] * 5
+        with serve.Client(port=port, timeout=10) as client:
+            encoded = client.encode_many(data)
+            self.assertEqual(["cccccc6", "CC=O)Cl", "CCC3", "CO"] * 5, encoded)
+            metrics = client.metrics()
+        # max_wait is long enough that only full batches are sent
+        self.assertEqual(5, metrics["batches"])
+        self.assertEqual([[4, 5]], metrics["batch_size"]["buckets"])
+        self.assertEqual(0, metrics["queue_depth"])
+
+    def testErrors(self):
+        server, port = self.start(max_batch=8, max_wait=0.001, processes=1)
+        with serve.Client(port=port, timeout=10) as client:
+            self.assertEqual("CC(C)O", client.decode("CCC)O"))
+            self.assertEqual(["C1CC1", None], client.decode_many(["CCC3", "C))C"], errors="none"))
+            self.assertRaises(ValueError, client.decode, "C))C")
+            response = client.request_many("transmogrify", ["C"])[0]
+            self.assertTrue(response["error"].startswith("Bad request"))
+            metrics = client.metrics()
+        self.assertEqual(3, metrics["errors"])
+        self.assertTrue(metrics["latency_us"]["p50"] > 0)
+
+    def testLargeBatch(self):
+        # Many more requests than fit in the socket buffers, which are
+        # made small so that the client would hang if it sent them all
+        # before reading any responses
+        server, port = self.start(processes=0)
+        data = ["C1CCCCC1" * 10, "C))C"] * 2000
+        with serve.Client(port=port, timeout=30) as client:
+            client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            self.assertTrue(len(data) * 80 > 10 * client.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+            encoded = client.encode_many(data, errors="none")
+        self.assertEqual(["CCCCCC6" * 10, None] * 2000, encoded)
+
+class Caching(unittest.TestCase):
+
+    def testLRUCache(self):
+        cache = LRUCache(maxsize=2)
+        cache.put("a", "A")
+        cache.put("b", "B")
+        self.assertEqual("A", cache.get("a"))
+        cache.put("c", "C") # evicts "b", the least recently used
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual("C", cache.get("c"))
+        info = cache.info()
+        self.assertEqual((2, 1, 1, 2, 2), info[:5])
+
+    def testByteBudget(self):
+        cache = LRUCache(maxbytes=1000)
+        for i in range(100):
+            cache.put("C" * i, "C" * i)
+            self.assertTrue(cache.nbytes <= 1000)
+        self.assertTrue(cache.info().evictions > 0)
+
+        # The strings in a tuple key are counted too
+        cache = LRUCache(maxbytes=2000)
+        cache.put((True, False, "C" * 2000), "C")
+        self.assertEqual(0, len(cache.data))
+
+    def testConverterCache(self):
+        converter = ds.Converter(rings=True, branches=True, cache_size=10)
+        for i in range(3):
+            self.assertEqual("CCCOC))CC5", converter.encode("C1CC(OC)CC1"))
+            self.assertEqual("C1CC(OC)CC1", converter.decode("CCCOC))CC5"))
+            self.assertRaises(ds.DecodeError, converter.decode, "C))I")
+        info = converter.cache_info()
+        self.assertEqual((2, 1, 0), info["encode"][:3])
+        self.assertEqual((2, 4, 0), info["decode"][:3])
+        self.assertEqual(1, info["decode"].currsize)
+
+        # The result depends on the options
+        converter.branches = False
+        self.assertEqual("CCC(OC)CC5", converter.encode("C1CC(OC)CC1"))
+
+        converter.cache_clear()
+        self.assertEqual((0, 0, 0, 10, 0), converter.cache_info()["encode"][:5])
+        self.assertEqual({}, ds.Converter(rings=True).cache_info())
+
+    def testConverterByteBudget(self):
+        # With only a byte budget, the number of entries is not limited
+        converter = ds.Converter(rings=True, cache_bytes=10**6)
+        for i in range(3):
+            self.assertEqual("CCCCC5", converter.encode("C1CCCC1"))
+        info = converter.cache_info()["encode"]
+        self.assertEqual((2, 1, 0, None), info[:4])
+        self.assertEqual(1, info.currsize)
+
+        converter = ds.Converter(rings=True, cache_bytes=300)
+        for i in range(10):
+            converter.encode("C%dC" % i)
+        info = converter.cache_info()["encode"]
+        self.assertTrue(0 < info.currsize < 10 and info.evictions > 0)
+
+class Instrumentation(unittest.TestCase):
+
+    def testDisabled(self):
+        self.assertIsNone(ds.Converter(rings=True).stats)
+
+    def testHistogram(self):
+        hist = Histogram()
+        for x in range(1, 101):
+            hist.add(x)
+        self.assertEqual((100, 5050, 1, 100), (hist.count, hist.total, hist.min, hist.max))
+        self.assertEqual(5, hist.percentile(5))
+        self.assertEqual(48, hist.percentile(50)) # the bucket from 48 to 55
+        self.assertEqual(96, hist.percentile(99))
+        self.assertIsNone(Histogram().percentile(50))
+
+    def testCounts(self):
+        converter = ds.Converter(rings=True, branches=True, instrument=True)
+        self.assertEqual("CCCOC))CC5", converter.encode("C1CC(OC)CC1"))
+        converter.encode("CC(C(C)O)C")
+        converter.decode("CCCC4")
+        self.assertRaises(ds.DecodeError, converter.decode, "C))I")
+        stats = converter.stats
+        self.assertEqual((2, 0), (stats.encode.calls, stats.encode.errors))
+        self.assertEqual((2, 1, 0.5), (stats.decode.calls, stats.decode.errors, stats.decode.error_rate()))
+        self.assertEqual({5: 1}, stats.encode.ring_size.buckets)
+        self.assertEqual({1: 1, 2: 1}, stats.encode.branch_depth.buckets)
+        self.assertEqual({4: 1}, stats.decode.ring_size.buckets)
+        self.assertEqual({0: 1}, stats.decode.branch_depth.buckets)
+        self.assertEqual({4: 1, 5: 1}, stats.decode.length.buckets)
+        self.assertEqual(2, stats.decode.latency.count)
+
+        data = json.loads(stats.to_json())
+        self.assertEqual(0.5, data["decode"]["error_rate"])
+        self.assertEqual(["p50", "p90", "p99"], sorted(data["encode"]["latency_us"]))
+        stats.merge(data)
+        self.assertEqual((4, 2), (stats.decode.calls, stats.decode.errors))
+        self.assertEqual({5: 2}, stats.encode.ring_size.buckets)
+        self.assertEqual(stats.to_dict(), Stats.from_dict(stats.to_dict()).to_dict())
+        stats.reset()
+        self.assertEqual(0, converter.stats.encode.calls)
+
+    def testSameResults(self):
+        # Instrumentation must not change what is returned or raised
+        for options in [{}, {"rings": True}, {"branches": True}, {"rings": True, "branches": True}]:
+            plain = ds.Converter(**options)
+            instrumented = ds.Converter(instrument=True, **options)
+            for text in ["C)", "CC(C", "C1CC%", "C[C", "C1CC(OC)CC1", "CCC5", "C))I"]:
+                for method in ["encode", "decode"]:
+                    try:
+                        expected = getattr(plain, method)(text)
+                    except (ds.EncodeError, ds.DecodeError) as e:
+                        self.assertRaises(type(e), getattr(instrumented, method), text)
+                    else:
+                        self.assertEqual(expected, getattr(instrumented, method)(text))
+        self.assertEqual("C)", ds.Converter(instrument=True).encode("C)"))
+
+    def testWorkerProcesses(self):
+        converter = ds.Converter(rings=True, instrument=True)
+        data = ["C1CCCC1", "C1CC(OC)CC1", "C(C(C(C)))"] * 5 + ["C%1"]
+        results = list(converter.encode_many(data, processes=2, chunksize=4, errors="none"))
+        self.assertEqual("CCCCC5", results[0])
+        self.assertEqual((16, 1), (converter.stats.encode.calls, converter.stats.encode.errors))
+        self.assertEqual({0: 5, 1: 5, 3: 5}, converter.stats.encode.branch_depth.buckets)
+
+    def testCommandLine(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            smifile = os.path.join(tmpdir, "input.smi")
+            with open(smifile, "w") as out:
+                out.write("C1CCCC1 a\nC(O)C b\n")
+            statsfile = os.path.join(tmpdir, "stats.json")
+            main([smifile, "-o", os.path.join(tmpdir, "output.smi"), "-r", "-q", "--stats", statsfile])
+            with open(statsfile) as inp:
+                data = json.load(inp)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(2, data["encode"]["calls"])
+        self.assertEqual(0, data["decode"]["calls"])
+
+class ByteStrings(unittest.TestCase):
+
+    def testCodecs(self):
+        converter = ds.Converter(rings=True, branches=True)
+        for smi, encoded in [("c1cc[nH]c1Cl", "ccc[nH]c5Cl"), ("C%12CC(Br)C%12", "CCCBr)C4"),
+                             ("F/C=C/F", "F/C=C/F")]:
+            for data in (smi.encode("ascii"), bytearray(smi, "ascii"), memoryview(smi.encode("ascii"))):
+                self.assertEqual(encoded.encode("ascii"), converter.encode(data))
+                self.assertEqual(converter.decode(encoded).encode("ascii"),
+                                 converter.decode(memoryview(converter.encode(data))))
+        self.assertEqual(["Cl", "[nH]", "%12", "="], split(bytearray(b"Cl[nH]%12=")))
+        with self.assertRaises(ds.DecodeError) as cm:
+            converter.decode(b"CC)))C")
+        self.assertEqual((exceptions.TOO_MANY_CLOSE_PARENS, 4), (cm.exception.code, cm.exception.idx))
+        self.assertEqual((exceptions.OK, None), converter.validate(bytearray(b"CC)C")))
+
+    def testInto(self):
+        converter = ds.Converter(rings=True)
+        out = bytearray(b"header\n")
+        self.assertEqual(3, converter.encode_into(["C1CC1", b"CC)C", "OCO"], out, errors="none"))
+        self.assertEqual(b"header\nCCC3\n\nOCO\n", out)
+        out = bytearray()
+        self.assertEqual(2, converter.decode_into([b"CCC3", b"OCO"], out, sep=b" "))
+        self.assertEqual(b"C1CC1 OCO ", out)
+
+class Tokenizing(unittest.TestCase):
+
+    def testTokenize(self):
+        data = [ # string, token kinds
+                ("CBr)Cl", "ATOM ATOM CLOSE ATOM"),
+                ("C[C@@H](O)C", "ATOM ATOM OPEN ATOM CLOSE ATOM"),
+                ("C=C/CCCCCC/8", "ATOM BOND ATOM BOND ATOM ATOM ATOM ATOM ATOM ATOM BOND RING"),
+                ("CCCCCCCCCC%10%(123)", "ATOM " * 10 + "RING RING"),
+                ("C[C", "ATOM ERROR ATOM"),
+                ("C%1", "ATOM ERROR RING"),
+                ]
+        for text, kinds in data:
+            tokens = list(ds.tokenize(text))
+            self.assertEqual(kinds.split(), [token.kind for token in tokens])
+            self.assertEqual(text, "".join(token.text for token in tokens))
+            self.assertEqual([token.text for token in tokens], split(text))
+            for token in tokens:
+                self.assertEqual(token.text, text[token.pos:token.pos+len(token.text)])
+
+    def testRingSymbolNumbers(self):
+        # %NN and %(NN) are the same ring closure
+        converter = ds.Converter(rings=True)
+        self.assertEqual("CCCC4", converter.encode("C%10CCC%(10)"))
+        self.assertEqual("CCCC4", converter.encode("C%(1)CCC1"))
+
+    def testEncodingExceptions(self):
+        converter = ds.Converter(rings=True, branches=True)
+        for smi in ["C[C", "C%1CC%1", "C%(1CC"]:
+            self.assertRaises(ds.EncodeError, converter.encode, smi)
+
+class Vocabularies(unittest.TestCase):
+
+    def testDefault(self):
+        vocab = Vocabulary.default()
+        self.assertEqual(0, vocab.index["<pad>"])
+        self.assertEqual(1, vocab.index["<unk>"])
+        for token in ["C", "Cl", "[C@@H]", "%10", ")", "/"]:
+            self.assertTrue(token in vocab)
+        ids = vocab.ids("CBr)[nH]=O%12%(123)")
+        self.assertEqual(vocab.unk_id, ids[-1])
+        self.assertEqual("CBr)[nH]=O%12", vocab.text(ids[:-1] + [vocab.pad_id]))
+        self.assertRaises(ValueError, vocab.text, ids)
+
+    def testCustom(self):
+        vocab = Vocabulary(["C", "O", ")"])
+        self.assertEqual(5, len(vocab))
+        self.assertEqual([2, 3, 4, 1], vocab.ids("CO)N"))
+        self.assertRaises(ValueError, Vocabulary, ["C", "O", "C"])
+
+    def testSaveLoad(self):
+        vocab = Vocabulary(["C", "O", ")", "%(123)"])
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "vocab.json")
+            vocab.save(filename)
+            self.assertEqual(vocab.tokens, Vocabulary.load(filename).tokens)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testBuildStats(self):
+        converter = ds.Converter(rings=True, branches=True)
+        smiles = ["CCl", "C(=O)Br", "CC)C", "C1CCCCCCCCCCC1", "[NH4+]"] * 20
+        stats = build_stats(smiles, converter, chunksize=7)
+        self.assertEqual((80, 20), (stats.sequences, stats.invalid))
+        # Tokens follow the library's own rules: Cl, bond symbols before ring sizes, %NN
+        self.assertEqual({"C": 280, "Cl": 20, "=": 20, "O": 20, ")": 20, "Br": 20,
+                          "%12": 20, "[NH4+]": 20}, dict(stats.counts))
+        self.assertEqual({1: 20, 2: 20, 5: 20, 13: 20}, dict(stats.lengths))
+        self.assertEqual((2, 13), (stats.length_percentile(50), stats.length_percentile(100)))
+        parallel = build_stats(iter(smiles), converter, processes=2, chunksize=7)
+        self.assertEqual(stats.to_dict(), parallel.to_dict())
+        encoded = build_stats(converter.encode_many(smiles, processes=1, errors="skip"))
+        self.assertEqual(stats.counts, encoded.counts)
+
+        vocab = stats.vocabulary(max_size=5)
+        self.assertEqual(["<pad>", "<unk>", "C", "%12", ")"], vocab.tokens)
+        self.assertEqual(100 / 420, stats.oov_rate(vocab))
+        merged = TokenStats.from_dict(json.loads(json.dumps(stats.to_dict(vocab)))).merge(stats)
+        self.assertEqual(2 * stats.counts["C"], merged.counts["C"])
+        self.assertEqual(40, merged.invalid)
+
+@unittest.skipIf(arrays.np is None, "NumPy is not available")
+class TokenArrays(unittest.TestCase):
+    smiles = ["c1ccccc1", "CC(=O)Cl", "C[C@@H](N)C(=O)O"]
+
+    def testAutoWidth(self):
+        converter = ds.Converter(rings=True, branches=True)
+        matrix, lengths = arrays.encode(converter, self.smiles)
+        self.assertEqual("int32", str(matrix.dtype))
+        self.assertEqual((3, 9), matrix.shape)
+        self.assertEqual([7, 6, 9], lengths.tolist())
+        vocab = Vocabulary.default()
+        for row, length, smi in zip(matrix.tolist(), lengths, self.smiles):
+            self.assertEqual(converter.encode(smi), vocab.text(row[:length]))
+            self.assertEqual([vocab.pad_id] * (9 - length), row[length:])
+        self.assertEqual(self.smiles, arrays.decode(converter, matrix))
+        self.assertEqual(self.smiles, arrays.decode(converter, matrix, lengths))
+
+    def testPreallocated(self):
+        import numpy as np
+        converter = ds.Converter(rings=True)
+        vocab = Vocabulary(["c", "C", "O", "=", ")", "6", "[C@@H]", "N"])
+        out = np.ones((4, 8), dtype=np.int32)
+        matrix, lengths = arrays.encode(converter, self.smiles, vocab=vocab, out=out, truncate=True)
+        self.assertTrue(matrix is out)
+        self.assertEqual([7, 7, 8, 0], lengths.tolist())
+        self.assertEqual([0] * 8, out[3].tolist())
+        self.assertRaises(ValueError, arrays.encode, converter, self.smiles, vocab=vocab, width=8)
+
+    def testErrors(self):
+        converter = ds.Converter(rings=True, branches=True)
+        matrix, lengths = arrays.encode(converter, ["C[C", "CC"], errors="none")
+        self.assertEqual([0, 2], lengths.tolist())
+        self.assertRaises(ds.EncodeError, arrays.encode, converter, ["C[C", "CC"])
+        vocab = Vocabulary.default()
+        matrix = [vocab.ids("C))C") + [vocab.pad_id], vocab.ids("CCCC4")]
+        self.assertEqual([None, "C1CCC1"], arrays.decode(converter, matrix, errors="none"))
+        self.assertRaises(ds.DecodeError, arrays.decode, converter, matrix)
+
+@unittest.skipIf(arrays.np is None, "NumPy is not available")
+class Batching(unittest.TestCase):
+
+    def setUp(self):
+        self.converter = ds.Converter(rings=True, branches=True)
+        self.smiles = bench.make_corpus("druglike", 300)
+        self.smiles.insert(5, "C[C")
+
+    def batches(self, **kwargs):
+        with BatchIterator(self.converter, self.smiles, **kwargs) as batches:
+            return list(batches), batches
+
+    def testBatches(self):
+        vocab = Vocabulary.default()
+        for boundaries in [None, [30, 40, 50]]:
+            results, batches = self.batches(tokens_per_batch=500, boundaries=boundaries, window=100, seed=1)
+            self.assertEqual(1, batches.skipped)
+            indices = []
+            for batch in results:
+                self.assertEqual("int32", str(batch.ids.dtype))
+                self.assertTrue(batch.ids.size <= 500 or len(batch.lengths) == 1)
+                for row, length, index in zip(batch.ids.tolist(), batch.lengths, batch.indices):
+                    self.assertEqual(self.converter.encode(self.smiles[index]), vocab.text(row[:length]))
+                    self.assertEqual([vocab.pad_id] * (len(row) - length), row[length:])
+                if boundaries:
+                    buckets = set(bisect.bisect_left(boundaries, x) for x in batch.lengths)
+                    self.assertEqual(1, len(buckets))
+                indices.extend(batch.indices.tolist())
+            self.assertEqual([i for i in range(len(self.smiles)) if i != 5], sorted(indices))
+            self.assertEqual(sum(len(x.indices) for x in results), len(self.smiles) - 1)
+            self.assertEqual(sum(x.ids.size for x in results), batches.tokens + batches.padding)
+
+        # Sorting within a window leaves little padding
+        results, batches = self.batches(tokens_per_batch=1000)
+        self.assertTrue(batches.padding < 0.1 * batches.tokens)
+
+    def testShuffle(self):
+        def order(**kwargs):
+            return [x.indices.tolist() for x in self.batches(**kwargs)[0]]
+        self.assertEqual(order(seed=1), order(seed=1))
+        self.assertNotEqual(order(seed=1), order(seed=2))
+        self.assertEqual(order(seed=1), order(seed=1, processes=2, chunksize=50))
+        unshuffled = order(shuffle=False, window=1000)
+        lengths = [len(split(self.converter.encode(self.smiles[i]))) for i in sum(unshuffled, [])]
+        self.assertEqual(sorted(lengths), lengths)
+
+    def testErrors(self):
+        self.assertRaises(ds.EncodeError, self.batches, errors="raise")
+        self.assertRaises(ValueError, BatchIterator, self.converter, self.smiles, errors="none")
+        self.assertEqual([], list(BatchIterator(self.converter, [])))
+        # Stopping early does not wait for the rest of the input
+        batches = BatchIterator(self.converter, itertools.cycle(self.smiles), tokens_per_batch=100,
+                                shuffle=False)
+        # The first batch has as many of the shortest sequences (6 tokens) as fit
+        self.assertEqual((16, 6), next(batches).ids.shape)
+        batches.close()
+        self.assertRaises(StopIteration, next, batches)
+
+def best_time(func, arg, repeat=5):
+    """Return the shortest of several timings of func(arg)"""
+    return min(timeit.repeat(lambda: func(arg), number=1, repeat=repeat))
+
+class Corpus(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.filename = os.path.join(self.tmpdir, "corpus.dsc")
+
+    def testRoundTrip(self):
+        converter = ds.Converter(rings=True, branches=True)
+        vocab = Vocabulary.default()
+        with CorpusWriter(self.filename, converter, vocab, errors="none") as writer:
+            self.assertEqual(0, writer.write("c1ccccc1"))
+            self.assertEqual(3, writer.write_many(["CC(=O)Cl", "CC)C", "C[C@H](F)Cl"]))
+        encoded = ["cccccc6", "CC=O)Cl", "", "C[C@H]F)Cl"]
+        with CorpusReader(self.filename) as corpus:
+            self.assertEqual(4, len(corpus))
+            self.assertTrue(corpus.rings and corpus.branches)
+            self.assertEqual(encoded, [bytes(x).decode("ascii") for x in corpus])
+            self.assertIsInstance(corpus[0], memoryview)
+            self.assertEqual("C[C@H]F)Cl", corpus.text(-1))
+            self.assertEqual(vocab.ids("CC=O)Cl"), list(corpus.ids(1)))
+            self.assertEqual(vocab.tokens, corpus.vocab.tokens)
+            part = corpus[1:3]
+            self.assertEqual(2, len(part))
+            self.assertEqual(b"CC=O)Cl", bytes(part.span()))
+            self.assertRaises(IndexError, part.text, 2)
+            copy = pickle.loads(pickle.dumps(part))
+            self.assertEqual("CC=O)Cl", copy.text(0))
+            copy.close()
+
+    def testWithoutTokens(self):
+        with CorpusWriter(self.filename, ds.Converter(rings=True), errors="skip") as writer:
+            writer.write_many(["C1CC1", "CC)C", "CCO"], processes=2, chunksize=1)
+        with CorpusReader(self.filename) as corpus:
+            self.assertEqual(["CCC3", "CCO"], [corpus.text(i) for i in range(len(corpus))])
+            self.assertFalse(corpus.branches)
+            self.assertRaises(ValueError, corpus.ids, 0)
+        with open(self.filename, "wb") as out:
+            out.write(b"CCC3\n")
+        self.assertRaises(ValueError, CorpusReader, self.filename)
+
+class Scaling(unittest.TestCase):
+
+    def assertLinear(self, func, make_input, N=2000):
+        small = best_time(func, make_input(N))
+        large = best_time(func, make_input(4*N))
+        # Linear growth gives a ratio of about 4, quadratic about 16
+        self.assertLess(large / small, 8)
+
+    def testLimitsRejectEarly(self):
+        # With limits, an error near the start is found without reading the
+        # rest of the input, whatever its length
+        converter = ds.Converter(rings=True, branches=True, limits=ds.Limits(atoms=100))
+        def early_error(N):
+            return "C)))" + "C" * N
+        small = best_time(converter.try_decode, early_error(10000))
+        large = best_time(converter.try_decode, early_error(1000000))
+        self.assertLess(large / small, 10)
+        self.assertEqual((exceptions.TOO_MANY_CLOSE_PARENS, 2), converter.try_decode(early_error(1000000))[1:])
+
+    def testRingDecodingMacrocycles(self):
+        # A chain where every atom after the first N/2 closes a ring of size N/2
+        def macrocycles(N):
+            ringsize = "%%(%d)" % (N // 2)
+            return "C" * (N // 2) + ("C" + ringsize) * (N // 2)
+        converter = ds.Converter(rings=True)
+        self.assertLinear(converter.decode, macrocycles)
+
+    def testRingDecodingFused(self):
+        # Fused six-membered rings, each also bridged back to the start,
+        # in nested branches
+        def fused(N):
+            ringsize = "%%(%d)" % (N // 10)
+            return "C" * (N // 10) + ("CCCC(CC6" + ringsize) * (N // 10) + ")" * (N // 10)
+        converter = ds.Converter(rings=True)
+        self.assertLinear(converter.decode, fused)
+
+    def testBranchDecodingMacrocycles(self):
+        def macrocycles(N):
+            ringsize = "%%(%d)" % (N // 2)
+            return "C" * (N // 2) + ("CC" + ringsize + ")") * (N // 2)
+        converter = ds.Converter(rings=True, branches=True)
+        self.assertLinear(converter.decode, macrocycles)
+
+    def testEncodingNestedRings(self):
+        # Ring closures inside deeply nested branches
+        def nested(N):
+            return "C(CC1CC1" * (N // 8) + ")" * (N // 8)
+        converter = ds.Converter(rings=True, branches=True)
+        self.assertLinear(converter.encode, nested)
+
+    def testEncodingStereoRingClosures(self):
+        # A stereocentre with a very large number of ring closures
+        def stereo(N):
+            symbols = ["%%(%d)" % i for i in range(1, N // 10)]
+            return "[C@@H]" + "".join(symbols) + "".join("C" + x for x in reversed(symbols))
+        converter = ds.Converter(rings=True)
+        self.assertLinear(converter.encode, stereo, N=4000)
+
+class Benchmark(unittest.TestCase):
+
+    def testCorporaAreReproducible(self):
+        for name in bench.CORPORA:
+            self.assertEqual(bench.make_corpus(name, 5, seed=3), bench.make_corpus(name, 5, seed=3))
+        self.assertNotEqual(bench.make_corpus("druglike", 5, seed=1), bench.make_corpus("druglike", 5, seed=2))
+
+    def testCorporaRoundTrip(self):
+        for name in bench.CORPORA:
+            for mode, options in bench.MODES.items():
+                converter = ds.Converter(**options)
+                for smi in bench.make_corpus(name, 20):
+                    encoded = converter.encode(smi)
+                    self.assertEqual(encoded, converter.encode(converter.decode(encoded)))
+
+    def testRun(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            jsonfile = os.path.join(tmpdir, "results.json")
+            self.assertEqual(0, bench.main(["-n", "3", "-r", "1", "-c", "macrocycle", "-m", "RS", "-o", jsonfile]))
+            with open(jsonfile) as inp:
+                results = json.load(inp)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(3, results["size"])
+        self.assertEqual([("macrocycle", "RS", "encode"), ("macrocycle", "RS", "decode")],
+                         [(x["corpus"], x["mode"], x["direction"]) for x in results["results"]])
+        for x in results["results"]:
+            self.assertEqual(3, x["molecules"])
+            self.assertEqual(["p50", "p90", "p99"], sorted(x["latency_us"]))
+            self.assertGreater(x["peak_memory_bytes"], 0)
+
+class BatchConversion(unittest.TestCase):
+    smiles = ["C1CCCC1", "C1CC(OC)CC1", "C(OC(=O)Cl)I", "B(c1ccccc1)(O)O",
+              "NC[C@]12CCCC1C3CC2CC3", "Cn1cccc-2nccc12"] * 7
+
+    def testEncodeMany(self):
+        converter = ds.Converter(rings=True, branches=True)
+        expected = [converter.encode(smi) for smi in self.smiles]
+        for processes in [1, 2]:
+            encoded = converter.encode_many(self.smiles, processes=processes, chunksize=4)
+            self.assertEqual(expected, list(encoded))
+
+    def testDecodeMany(self):
+        converter = ds.Converter(rings=True, branches=True)
+        encoded = [converter.encode(smi) for smi in self.smiles]
+        expected = [converter.decode(dsmi) for dsmi in encoded]
+        for processes in [1, 2]:
+            decoded = converter.decode_many(iter(encoded), processes=processes, chunksize=5)
+            self.assertEqual(expected, list(decoded))
+
+    def testErrorPolicy(self):
+        converter = ds.Converter(rings=True, branches=True)
+        data = ["CCCC4", "C))I", "CO)C", "9C"]
+        for processes in [1, 2]:
+            decoded = converter.decode_many(data, processes=processes, chunksize=1, errors="none")
+            self.assertEqual(["C1CCC1", None, "C(O)C", None], list(decoded))
+            decoded = converter.decode_many(data, processes=processes, chunksize=3, errors="skip")
+            self.assertEqual(["C1CCC1", "C(O)C"], list(decoded))
+            decoded = converter.decode_many(data, processes=processes, chunksize=2)
+            self.assertRaises(ds.DecodeError, list, decoded)
+        self.assertRaises(ValueError, converter.decode_many, data, errors="ignore")
+
+class ShardedJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.input = os.path.join(self.tmpdir, "input.smi")
+        self.smiles = bench.make_corpus("druglike", 200) + ["C)C"]
+        with open(self.input, "w") as out:
+            for i, smi in enumerate(self.smiles):
+                out.write("%s mol%d\n" % (smi, i))
+
+    def testShardRanges(self):
+        with open(self.input, "rb") as inp:
+            data = inp.read()
+        for shards in [1, 3, 7, 1000]:
+            ranges = jobs.shard_ranges(self.input, shards)
+            self.assertTrue(len(ranges) <= shards)
+            self.assertEqual(0, ranges[0][0])
+            self.assertEqual(len(data), ranges[-1][1])
+            for (a, b), (c, d) in zip(ranges, ranges[1:]):
+                self.assertEqual(b, c)
+                self.assertEqual(b"\n", data[b - 1:b])
+
+    def testModes(self):
+        for rings, branches in [(True, False), (False, True), (True, True)]:
+            converter = ds.Converter(rings=rings, branches=branches)
+            encoded = os.path.join(self.tmpdir, "encoded.smi")
+            errors = os.path.join(self.tmpdir, "errors.smi")
+            job = jobs.Job(self.input, encoded, converter, errors=errors, shards=5, processes=2)
+            self.assertEqual((201, 1), job.run(log=None))
+            self.assertFalse(os.path.exists(job.workdir))
+            with open(encoded) as inp:
+                lines = inp.read().splitlines()
+            expected = [converter.encode(smi) for smi in self.smiles[:-1]]
+            self.assertEqual(expected, [line.split()[0] for line in lines])
+            self.assertEqual("mol0", lines[0].split()[1])
+            with open(errors) as inp:
+                self.assertEqual("C)C mol200\n", inp.read())
+
+            decoded = os.path.join(self.tmpdir, "decoded.smi.gz")
+            job = jobs.Job(encoded, decoded, converter, decode=True, shards=3, processes=1)
+            self.assertEqual((200, 0), job.run(log=None))
+            with gzip.open(decoded, "rt") as inp:
+                self.assertEqual([converter.decode(x) for x in expected],
+                                 [line.split()[0] for line in inp])
+
+    def testResume(self):
+        converter = ds.Converter(rings=True, branches=True)
+        output = os.path.join(self.tmpdir, "output.smi")
+        job = jobs.Job(self.input, output, converter, shards=4, processes=2)
+        job.run(keep=True, log=None)
+        with open(output) as inp:
+            expected = inp.read()
+        # Pretend that the job was interrupted before shard 2 finished,
+        # and mark the output of shard 1 to check that it is not redone
+        del job.manifest["done"]["2"]
+        job._save()
+        os.remove(job.shard_name(2))
+        with open(job.shard_name(1)) as inp:
+            shard1 = inp.read()
+        with open(job.shard_name(1), "w") as out:
+            out.write("marker\n")
+
+        log = io.StringIO()
+        job = jobs.Job(self.input, output, converter, shards=4, processes=2)
+        job.load()
+        self.assertEqual([2], job.pending())
+        self.assertEqual((201, 1), job.run(log=log))
+        self.assertTrue("Shard 2 done (4 of 4)" in log.getvalue())
+        with open(output) as inp:
+            self.assertEqual(expected.replace(shard1, "marker\n"), inp.read())
+        # A different job cannot reuse the working directory
+        os.makedirs(job.workdir)
+        job._save()
+        other = jobs.Job(self.input, output, converter, decode=True)
+        self.assertRaises(ValueError, other.load)
+
+class CommandLine(unittest.TestCase):
+
+    def testSplitLine(self):
+        self.assertEqual(("c1ccccc1", "\tbenzene 1"), split_line("c1ccccc1\tbenzene 1\n"))
+        self.assertEqual(("CC", ""), split_line("CC\n"))
+
+    def testRoundTrip(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            smifile = os.path.join(tmpdir, "input.smi.gz")
+            with gzip.open(smifile, "wt") as out:
+                out.write("C1CC(OC)CC1 first\nC(O)C\tsecond x\n\nNC[C@]12CCCC1C3CC2CC3\n")
+            encfile = os.path.join(tmpdir, "encoded.smi")
+            self.assertEqual(0, main([smifile, "-o", encfile, "-r", "-b", "-q"]))
+            with open(encfile) as inp:
+                self.assertEqual("CCCOC))CC5 first\nCO)C\tsecond x\nNC[C@]CCCC5CCC8CC5\n", inp.read())
+
+            with open(encfile, "a") as out:
+                out.write("C))I third\n")
+            decfile = os.path.join(tmpdir, "decoded.smi.gz")
+            errfile = os.path.join(tmpdir, "errors.smi")
+            main([encfile, "-o", decfile, "-d", "-r", "-b", "-e", errfile, "-q"])
+            with gzip.open(decfile, "rt") as inp:
+                self.assertEqual("C1CC(OC)CC1 first\nC(O)C\tsecond x\nNC[C@]12CCCC1C3CC2CC3\n", inp.read())
+            with open(errfile) as inp:
+                self.assertEqual("C))I third\n", inp.read())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testConvertFile(self):
+        inp = io.StringIO("CCCC4 a\nC))I b\nCO)C c\n")
+        out = io.StringIO()
+        log = io.StringIO()
+        converter = ds.Converter(rings=True, branches=True)
+        N, invalid = convert_file(inp, out, converter, decode=True, processes=2,
+                                  chunksize=1, progress=2, log=log)
+        self.assertEqual((3, 1), (N, invalid))
+        self.assertEqual("C1CCC1 a\nC(O)C c\n", out.getvalue())
+        self.assertEqual(2, log.getvalue().count("lines/s"))
+
 if __name__ == "__main__":
     unittest.main()
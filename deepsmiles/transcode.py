@@ -0,0 +1,201 @@
+# Copyright 2018 NextMove Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Convert directly between the variants of DeepSMILES
+
+transcode() gives the same result as decoding with one Converter and
+encoding with another, but for the common cases it reads the input only
+once and writes the target variant directly:
+
+1. DeepSMILES/RS to DeepSMILES/RS+PN (the ring sizes are unchanged, so
+   only the branches are rewritten)
+2. DeepSMILES/RS+PN to DeepSMILES/RS (likewise)
+3. DeepSMILES/RS+PN to DeepSMILES/PN (the branch structure is read as
+   when decoding, and written out as DeepSMILES branches)
+
+Anything else (including DeepSMILES/RS+PN containing a '(', which the
+decoder treats as an atom) is decoded and encoded again.
+
+As the decoder writes the ring openings at each atom in the order in
+which the rings are closed, the encoder never inverts the stereo of an
+atom when the ring sizes are unchanged. The exception is a ring of size
+one, which is left to the general case.
+"""
+import functools
+import itertools
+import os
+
+from . import decode
+from . import encode
+from . import lexer
+from .converter import _chunks, _convert_chunk, _convert_in_pool, ERROR_POLICIES
+
+def rings_to_both(deepsmiles):
+    """Rewrite DeepSMILES/RS as DeepSMILES/RS+PN
+
+    Returns None if the input cannot be handled here (either because it
+    is invalid or because it has a ring of size one).
+    """
+    ans = []
+    level_counts = [0] # the number of atoms seen at each bracket level
+    depth = 0
+    started = False
+    bondchar = ""
+    pos = 0
+    for x in lexer.token_re.findall(deepsmiles):
+        i = pos
+        pos += len(x)
+        kind = lexer.kinds.get(x[0])
+        if kind is None: # an atom
+            if x == '[':
+                return None
+            level_counts[-1] += 1
+            depth += 1
+            started = True
+            ans.append(bondchar + x)
+        elif kind == lexer.BOND:
+            bondchar = x
+            continue
+        elif kind == lexer.CLOSE:
+            if len(level_counts) == 1:
+                return None
+            lastbranch = level_counts.pop()
+            depth -= lastbranch
+            ans.append(')' * lastbranch)
+        elif kind == lexer.OPEN:
+            level_counts.append(0)
+            started = True
+        elif kind == lexer.RING:
+            if i == 0 or not started or x == '%':
+                return None
+            size = lexer.ring_number(x)
+            if size < 2 or size > depth:
+                return None
+            ans.append(bondchar + lexer.ring_symbol(size))
+        bondchar = ""
+    return "".join(ans)
+
+def both_to_rings(deepsmiles):
+    """Rewrite DeepSMILES/RS+PN as DeepSMILES/RS
+
+    Returns None if the input cannot be handled here (because it is
+    invalid, has a ring of size one, or has a '(').
+    """
+    stack = []
+    tree = decode.Tree()
+    idx = -1
+    last_depth = 0 # the length of the stack after adding the most recent atom
+    bondchar = ""
+    pos = 0
+    for x in lexer.token_re.findall(deepsmiles):
+        i = pos
+        pos += len(x)
+        kind = lexer.kinds.get(x[0])
+        if kind is None: # an atom
+            if x == '[':
+                return None
+            idx = tree.add_node(bondchar + x)
+            if stack:
+                tree.add_edge(stack[-1], idx)
+            stack.append(idx)
+            last_depth = len(stack)
+        elif kind == lexer.BOND:
+            bondchar = x
+            continue
+        elif kind == lexer.CLOSE:
+            if not stack:
+                return None
+            stack.pop()
+        elif kind == lexer.OPEN: # the decoder treats this as an atom, which the encoder would not
+            return None
+        elif kind == lexer.RING:
+            if i == 0 or x == '%':
+                return None
+            size = lexer.ring_number(x)
+            if size < 2 or size > last_depth:
+                return None
+            tree.annotate(idx, bondchar + lexer.ring_symbol(size))
+        bondchar = ""
+    return tree.to_smiles()
+
+def both_to_branches(deepsmiles):
+    """Rewrite DeepSMILES/RS+PN as DeepSMILES/PN
+
+    Returns None if the input has a '(', and raises a DecodeError if it
+    is invalid.
+    """
+    if '(' in deepsmiles:
+        return None
+    return decode.build_tree(deepsmiles, rings=True).to_smiles(branches=True)
+
+# The functions that handle the common cases, by (source, target) variant
+# given as (rings, branches)
+FAST_PATHS = {
+    ((True, False), (True, True)): rings_to_both,
+    ((True, True), (True, False)): both_to_rings,
+    ((True, True), (False, True)): both_to_branches,
+}
+
+def roundtrip(deepsmiles, source, target):
+    """Decode and encode again, with the variants given as (rings, branches)"""
+    return encode.encode(decode.decode(deepsmiles, *source), *target)
+
+def fast_path(deepsmiles, func, source, target):
+    """Use 'func' to convert the DeepSMILES, unless it returns None"""
+    ans = func(deepsmiles)
+    if ans is None:
+        ans = roundtrip(deepsmiles, source, target)
+    return ans
+
+def transcoder(source, target):
+    """Return a function that converts DeepSMILES from the variant of one Converter to another
+
+    The function can be pickled, and so sent to worker processes.
+    """
+    source = (bool(source.rings), bool(source.branches))
+    target = (bool(target.rings), bool(target.branches))
+    func = FAST_PATHS.get((source, target))
+    if func is None:
+        return functools.partial(roundtrip, source=source, target=target)
+    return functools.partial(fast_path, func=func, source=source, target=target)
+
+def transcode(deepsmiles, source, target):
+    """Convert DeepSMILES from the variant of one Converter to that of another
+
+    The result is the same as target.encode(source.decode(deepsmiles)).
+    A plain Converter() stands for SMILES.
+    """
+    return transcoder(source, target)(deepsmiles)
+
+def transcode_many(data, source, target, processes=1, chunksize=1000, errors="raise"):
+    """Convert an iterable of DeepSMILES from one variant to another
+
+    The results are yielded lazily, in input order. The keyword options
+    are the same as for Converter.encode_many(), except that by default
+    the work is done in the current process.
+    """
+    if errors not in ERROR_POLICIES:
+        raise ValueError("errors should be one of %s" % ", ".join(ERROR_POLICIES))
+    func = transcoder(source, target)
+    chunks = _chunks(data, chunksize)
+    if processes == 1:
+        return itertools.chain.from_iterable(
+                _convert_chunk(func, chunk, errors) for chunk in chunks)
+    return _convert_in_pool(func, chunks, errors, processes or os.cpu_count() or 1)
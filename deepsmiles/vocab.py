@@ -0,0 +1,296 @@
+# Copyright 2018 NextMove Software
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the 
+# Software is furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Vocabularies that map DeepSMILES tokens to integer IDs
+
+The tokens are those of deepsmiles.lexer, that is, the same tokens that
+the encoder and decoders use. ID 0 is always the padding token and ID 1
+the token used for anything not in the vocabulary.
+
+A Vocabulary can also be built from the token frequencies of a corpus,
+collected with build_stats(). Run as "python -m deepsmiles.vocab" to do
+this for a .smi file.
+"""
+import argparse
+import functools
+import json
+import sys
+from collections import Counter
+
+from . import lexer
+from .converter import Converter, _chunks, _convert_in_pool
+from .encode import encode
+from .fileio import open_file, split_line
+
+PAD = "<pad>"
+UNK = "<unk>"
+
+# A general-purpose vocabulary covering the organic subset, the common
+# charged, chiral and isotopic bracket atoms, and every ring size up to 99
+DEFAULT_TOKENS = (
+    ["B", "C", "N", "O", "P", "S", "F", "Cl", "Br", "I", "*",
+     "b", "c", "n", "o", "p", "s", "."] +
+    list("-=#$:/\\()") +
+    [str(i) for i in range(1, 10)] + ["%%%d" % i for i in range(10, 100)] +
+    ["[H]", "[2H]", "[nH]", "[NH]", "[CH]", "[CH2]", "[C@]", "[C@@]", "[C@H]", "[C@@H]",
+     "[S@]", "[S@@]", "[N@]", "[N@@]", "[N@+]", "[N@@+]", "[P@]", "[P@@]", "[Si]", "[Se]",
+     "[se]", "[te]", "[B-]", "[C-]", "[CH-]", "[N+]", "[N-]", "[NH+]", "[NH-]", "[NH2+]",
+     "[NH3+]", "[n+]", "[n-]", "[nH+]", "[O+]", "[O-]", "[OH+]", "[o+]", "[P+]", "[S+]",
+     "[S-]", "[s+]", "[Cl-]", "[Br-]", "[I-]", "[Li+]", "[Na+]", "[K+]", "[Mg+2]", "[Ca+2]",
+     "[Zn+2]", "[Fe]", "[Pt]"])
+
+class Vocabulary:
+    def __init__(self, tokens):
+        """Initialise a Vocabulary from a sequence of token strings.
+
+        The padding and unknown tokens are added at the start, so the
+        IDs of the given tokens start from 2.
+        """
+        self.tokens = [PAD, UNK]
+        for token in tokens:
+            if token not in (PAD, UNK):
+                self.tokens.append(token)
+        self.index = dict((token, i) for i, token in enumerate(self.tokens))
+        if len(self.index) != len(self.tokens):
+            raise ValueError("The tokens of a Vocabulary must be unique")
+        self.pad_id = 0
+        self.unk_id = 1
+    @classmethod
+    def default(cls):
+        """Return the built-in general-purpose Vocabulary"""
+        return cls(DEFAULT_TOKENS)
+    def __len__(self):
+        return len(self.tokens)
+    def __contains__(self, token):
+        return token in self.index
+    def ids(self, text):
+        """Return the list of token IDs for a DeepSMILES string"""
+        get = self.index.get
+        unk_id = self.unk_id
+        return [get(token, unk_id) for token in lexer.token_re.findall(text)]
+    def text(self, ids):
+        """Return the DeepSMILES string for a sequence of token IDs
+
+        Padding is skipped. An unknown token cannot be turned back into
+        text, so a ValueError is raised.
+        """
+        tokens = self.tokens
+        ans = []
+        for i in ids:
+            if i > self.unk_id:
+                ans.append(tokens[i])
+            elif i == self.unk_id:
+                raise ValueError("Cannot convert the unknown token back to text")
+        return "".join(ans)
+    def save(self, filename):
+        """Write the Vocabulary to a JSON file"""
+        with open(filename, "w") as out:
+            json.dump({"tokens": self.tokens}, out, indent=0)
+            out.write("\n")
+    @classmethod
+    def load(cls, filename):
+        """Read a Vocabulary written by save(), keeping the same IDs"""
+        with open(filename) as inp:
+            return cls(json.load(inp)["tokens"])
+    def __str__(self):
+        """Return a string representation"""
+        return "Vocabulary(%d tokens)" % len(self.tokens)
+
+class TokenStats:
+    """Token frequencies and sequence lengths for a corpus of DeepSMILES
+
+    Statistics for parts of a corpus (for example, from different
+    processes) can be combined with merge().
+    """
+    def __init__(self):
+        self.counts = Counter()  # token -> number of occurrences
+        self.lengths = Counter() # number of tokens -> number of sequences
+        self.invalid = 0         # the number of SMILES that could not be encoded
+
+    def add(self, deepsmiles):
+        """Add the tokens of a DeepSMILES string"""
+        tokens = lexer.token_re.findall(deepsmiles)
+        self.counts.update(tokens)
+        self.lengths[len(tokens)] += 1
+
+    def merge(self, other):
+        """Add the statistics from another TokenStats"""
+        self.counts.update(other.counts)
+        self.lengths.update(other.lengths)
+        self.invalid += other.invalid
+        return self
+
+    @property
+    def sequences(self):
+        return sum(self.lengths.values())
+
+    @property
+    def total(self):
+        """The total number of tokens"""
+        return sum(self.counts.values())
+
+    def length_percentile(self, p):
+        """Return the p-th percentile of the sequence length (in tokens)"""
+        target = self.sequences * p / 100.0
+        seen = 0
+        for length in sorted(self.lengths):
+            seen += self.lengths[length]
+            if seen >= target:
+                return length
+        return None
+
+    def oov_rate(self, vocab):
+        """Return the fraction of the tokens that are not in 'vocab'"""
+        total = self.total
+        if not total:
+            return 0.0
+        return sum(n for token, n in self.counts.items() if token not in vocab) / total
+
+    def vocabulary(self, min_count=1, max_size=None):
+        """Return a Vocabulary of the tokens seen at least 'min_count' times
+
+        The tokens are in order of decreasing frequency (ties are broken
+        alphabetically), and if 'max_size' is given, only that many
+        tokens (including padding and unknown) are kept.
+        """
+        tokens = sorted((token for token, n in self.counts.items() if n >= min_count),
+                        key=lambda token: (-self.counts[token], token))
+        if max_size is not None:
+            tokens = tokens[:max(max_size - 2, 0)]
+        return Vocabulary(tokens)
+
+    def to_dict(self, vocab=None):
+        """Return the statistics as a dict, including the OOV rate for 'vocab' if given"""
+        ans = {
+            "sequences": self.sequences,
+            "invalid": self.invalid,
+            "tokens": self.total,
+            "counts": dict(self.counts.most_common()),
+            "lengths": sorted(self.lengths.items()),
+            "length_percentiles": dict(("p%d" % p, self.length_percentile(p)) for p in (50, 90, 99, 100)),
+        }
+        if vocab is not None:
+            ans["oov_rate"] = self.oov_rate(vocab)
+        return ans
+
+    @classmethod
+    def from_dict(cls, data):
+        ans = cls()
+        ans.counts.update(data["counts"])
+        ans.lengths.update(dict(data["lengths"]))
+        ans.invalid = data["invalid"]
+        return ans
+
+    def __str__(self):
+        """Return a string representation"""
+        return "TokenStats(%d sequences, %d tokens, %d distinct)" % (
+                self.sequences, self.total, len(self.counts))
+
+def _chunk_stats(chunk, rings, branches):
+    """Return the TokenStats for a list of strings (for use by worker processes)
+
+    If 'rings' or 'branches' is True, the strings are SMILES to be
+    encoded first; otherwise they are already DeepSMILES.
+    """
+    ans = TokenStats()
+    if rings or branches:
+        for smi in chunk:
+            try:
+                deepsmiles = encode(smi, rings, branches)
+            except Exception:
+                ans.invalid += 1
+                continue
+            ans.add(deepsmiles)
+    else:
+        for deepsmiles in chunk:
+            ans.add(deepsmiles)
+    return ans
+
+def build_stats(data, converter=None, processes=1, chunksize=10000):
+    """Collect the TokenStats for an iterable of strings
+
+    If a Converter is given, 'data' is SMILES, which is encoded (SMILES
+    that cannot be encoded are counted as invalid); otherwise it is
+    DeepSMILES. The input is read lazily, a chunk at a time, and only
+    the counts are kept, so the corpus can be of any size. If
+    'processes' is more than 1, the chunks are shared out across a pool
+    of worker processes and the results are merged.
+    """
+    rings = converter is not None and converter.rings
+    branches = converter is not None and converter.branches
+    func = functools.partial(_chunk_stats, rings=rings, branches=branches)
+    ans = TokenStats()
+    if processes == 1:
+        for chunk in _chunks(data, chunksize):
+            ans.merge(func(chunk))
+    else:
+        # Each unit of work is a whole chunk, giving one TokenStats
+        chunks = ([chunk] for chunk in _chunks(data, chunksize))
+        for stats in _convert_in_pool(func, chunks, "raise", processes):
+            ans.merge(stats)
+    return ans
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m deepsmiles.vocab",
+            description="Build a DeepSMILES token vocabulary and statistics from a .smi file")
+    parser.add_argument("input", nargs="?", default="-",
+            help="a .smi or .smi.gz file of SMILES, or of DeepSMILES with --encoded (default: stdin)")
+    parser.add_argument("-r", "--rings", action="store_true",
+            help="use the DeepSMILES ring syntax")
+    parser.add_argument("-b", "--branches", action="store_true",
+            help="use the DeepSMILES branch syntax")
+    parser.add_argument("--encoded", action="store_true",
+            help="the input is already DeepSMILES")
+    parser.add_argument("-o", "--output",
+            help="write the vocabulary to this JSON file")
+    parser.add_argument("--stats",
+            help="write the token frequencies, length distribution and OOV rate to this JSON file")
+    parser.add_argument("--min-count", type=int, default=1,
+            help="leave out tokens seen fewer times than this (default: 1)")
+    parser.add_argument("--max-size", type=int,
+            help="maximum number of tokens in the vocabulary, including padding and unknown")
+    parser.add_argument("-j", "--processes", type=int, default=1,
+            help="number of worker processes (default: 1)")
+    parser.add_argument("--chunksize", type=int, default=10000,
+            help="number of lines per unit of work (default: 10000)")
+    args = parser.parse_args(args)
+    if not args.encoded and not args.rings and not args.branches:
+        parser.error("at least one of --rings and --branches is required, unless the input is --encoded")
+
+    converter = None if args.encoded else Converter(rings=args.rings, branches=args.branches)
+    inp = open_file(args.input, "r")
+    try:
+        data = (smi for smi, title in (split_line(line) for line in inp) if smi)
+        stats = build_stats(data, converter, args.processes, args.chunksize)
+    finally:
+        if inp is not sys.stdin:
+            inp.close()
+    vocab = stats.vocabulary(args.min_count, args.max_size)
+    if args.output:
+        vocab.save(args.output)
+    if args.stats:
+        with open(args.stats, "w") as out:
+            json.dump(stats.to_dict(vocab), out, indent=2, sort_keys=True)
+            out.write("\n")
+    sys.stderr.write("%s; %s; OOV rate %.4g\n" % (stats, vocab, stats.oov_rate(vocab)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -52,6 +52,12 @@ setup(
         'Programming Language :: Python',
     ],
     description=DOCSTRING,
+    entry_points={
+        'console_scripts': ['deepsmiles = deepsmiles.__main__:main'],
+    },
+    extras_require={
+        'numpy': ['numpy'],
+    },
     license='License :: OSI Approved :: MIT License',
     long_description=long_description,
     name=PKG_NAME,